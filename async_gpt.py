@@ -0,0 +1,161 @@
+# async_gpt.py
+#
+# asyncio counterpart of GPT for batch jobs
+#   all requests share one httpx connection pool, at most max_concurrency are in flight,
+#   429, 5xx and connection errors are retried with exponential backoff honoring retry-after
+#
+# async with AsyncGPT() as gpt:
+#     replies = await asyncio.gather(*[gpt.complete([{"role": "user", "content": p}]) for p in prompts])
+
+import asyncio
+import datetime
+import email.utils
+import random
+import time
+
+import httpx
+import openai
+
+from context_window import ContextWindow
+from gpt import GPT, StreamPrinter
+
+class AsyncGPT:
+    retryable = (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)
+
+    # an AsyncGPT belongs to the event loop it's first used on
+    def __init__(self, model="gpt-4-1106-preview", embedding_model="text-embedding-ada-002", api_key=None, base_url=None,
+                 max_concurrency=16, max_retries=5, backoff=0.5, max_backoff=30.0, timeout=600.0,
+                 max_context_tokens=None, token_counter=None, output=None):
+        self.model = model
+        self.embedding_model = embedding_model
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        limits = httpx.Limits(max_connections=max_concurrency, max_keepalive_connections=max_concurrency)
+        self.http_client = httpx.AsyncClient(limits=limits, timeout=timeout)
+        self.client = openai.AsyncOpenAI(api_key=api_key or GPT.get_openai_key(), base_url=base_url,
+                                         http_client=self.http_client, max_retries=0)
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.messages = [
+            {"role": "system", "content": GPT.system_prompt},
+        ]
+        self.context = ContextWindow(token_counter or GPT.count_tokens, model=model, max_tokens=max_context_tokens)
+        self.output = output or StreamPrinter()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        await self.client.close()
+
+    # seconds to wait before retrying after error e: retry-after-ms or retry-after if the server
+    # sent one, exponential backoff with jitter otherwise
+    def retry_delay(self, e, attempt):
+        response = getattr(e, "response", None)
+        headers = response is not None and response.headers or {}
+        delay = None
+        # retry-after is seconds or an HTTP date, read as UTC without a zone; unparseable values fall back to backoff
+        try:
+            if "retry-after-ms" in headers:
+                delay = float(headers["retry-after-ms"]) / 1000
+            elif "retry-after" in headers:
+                try:
+                    delay = float(headers["retry-after"])
+                except ValueError:
+                    date = email.utils.parsedate_to_datetime(headers["retry-after"])
+                    if date.tzinfo is None:
+                        date = date.replace(tzinfo=datetime.timezone.utc)
+                    delay = date.timestamp() - time.time()
+        except (TypeError, ValueError):
+            delay = None
+        if delay is None or delay < 0:
+            delay = self.backoff * (2 ** attempt) * random.uniform(0.5, 1.0)
+        return min(delay, self.max_backoff)
+
+    # await create(**kwargs) within the concurrency limit, retrying retryable errors
+    async def request(self, create, **kwargs):
+        attempt = 0
+        while True:
+            async with self.semaphore:
+                try:
+                    return await create(**kwargs)
+                except self.retryable as e:
+                    if attempt >= self.max_retries:
+                        raise
+                    delay = self.retry_delay(e, attempt)
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    # async generator of reply deltas for messages, holding a concurrency slot while streaming
+    async def stream(self, messages):
+        attempt = 0
+        while True:
+            await self.semaphore.acquire()
+            try:
+                reply = await self.client.chat.completions.create(model=self.model, messages=messages, stream=True)
+                break
+            except self.retryable as e:
+                self.semaphore.release()
+                if attempt >= self.max_retries:
+                    raise
+                delay = self.retry_delay(e, attempt)
+            except BaseException:
+                self.semaphore.release()
+                raise
+            attempt += 1
+            await asyncio.sleep(delay)
+        try:
+            async for chunk in reply:
+                if chunk.choices and chunk.choices[0].delta.content is not None:
+                    yield chunk.choices[0].delta.content
+        finally:
+            self.semaphore.release()
+
+    # one-off completion of messages, not recorded in self.messages
+    async def complete(self, messages):
+        reply = await self.request(self.client.chat.completions.create, model=self.model, messages=messages)
+        return reply.choices[0].message.content
+
+    # with stream=True, the reply is written to self.output as it arrives
+    async def send(self, msg, stream=True):
+        if stream:
+            try:
+                async for delta in self.send_stream(msg):
+                    self.output.write(delta)
+            finally:
+                self.output.end()
+            return self.messages[-1]["content"]
+        self.messages.append({"role": "user", "content": msg})
+        self.context.fit(self.messages)
+        content = await self.complete(list(self.messages))
+        self.messages.append({"role": "assistant", "content": content})
+        return content
+
+    # async generator of reply deltas, like GPT.send_stream
+    async def send_stream(self, msg):
+        self.messages.append({"role": "user", "content": msg})
+        self.context.fit(self.messages)
+        parts, complete = [], False
+        try:
+            async for delta in self.stream(list(self.messages)):
+                parts.append(delta)
+                yield delta
+            complete = True
+        finally:
+            if parts or complete:
+                self.messages.append({"role": "assistant", "content": "".join(parts)})
+
+    # texts are split into batch_size requests sent concurrently
+    async def get_embeddings(self, texts, batch_size=256):
+        batches = [texts[i:i+batch_size] for i in range(0, len(texts), batch_size)]
+        replies = await asyncio.gather(*[self.request(self.client.embeddings.create, input=batch, model=self.embedding_model)
+                                         for batch in batches])
+        return [item.embedding for reply in replies for item in reply.data]
+
+    async def get_embedding(self, text):
+        return (await self.get_embeddings([text]))[0]
+
+# EoF
@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+# bench.py
+#
+# offline benchmark suite, using deterministic fake embeddings and the stub chat server
+#
+# python bench.py                               # run all benchmarks, results as JSON on stdout
+# python bench.py -o baseline.json              # save results
+# python bench.py --baseline baseline.json      # compare against saved results, exit 1 on regressions
+# python bench.py --quick chunking query        # smaller sizes, selected benchmarks
+#
+# metrics with "per_second" in their name are better higher, all others (seconds, ms, kb) lower
+# each benchmark runs in a fresh process so that peak_rss_kb is its own
+
+import argparse
+import concurrent.futures
+import contextlib
+import fnmatch
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from gpt import GPT
+from scanner import Scanner
+from stub_openai import StubOpenAI
+from vector_db import ChromaDB, NumpyDB
+
+class FakeEmbeddingFunc:
+    def __init__(self, dim=64):
+        self.dim = dim
+        self.model_name = f"fake-{dim}"
+
+    def __call__(self, input):
+        embeddings = []
+        for text in input:
+            digest = hashlib.sha256(text.encode()).digest()
+            embeddings.append([(digest[i % len(digest)] - 128) / 128 for i in range(self.dim)])
+        return embeddings
+
+def synthetic_text(size, seed=0):
+    rand = random.Random(seed)
+    words = ["def", "return", "self", "import", "class", "for", "in", "if", "else", "value", "index", "result", "\n", "    "]
+    parts, length = [], 0
+    while length < size:
+        word = rand.choice(words) + rand.choice([" ", " ", "(", ")\n", ", "])
+        parts.append(word)
+        length += len(word)
+    return "".join(parts)[:size]
+
+def synthetic_tree(dir, files, size, seed=0):
+    for i in range(files):
+        sub = os.path.join(dir, f"pkg{i % 10}")
+        os.makedirs(sub, exist_ok=True)
+        with open(os.path.join(sub, f"module_{i}.py"), 'w') as f:
+            f.write(synthetic_text(size, seed + i))
+
+# silence stdout at the file descriptor level, so that worker processes are quiet too
+@contextlib.contextmanager
+def quiet():
+    sys.stdout.flush()
+    saved = os.dup(1)
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    try:
+        os.dup2(devnull, 1)
+        with contextlib.redirect_stdout(io.StringIO()):
+            yield
+    finally:
+        os.dup2(saved, 1)
+        os.close(devnull)
+        os.close(saved)
+
+def percentiles(samples, unit=1000):
+    samples = sorted(samples)
+    pick = lambda p: samples[min(len(samples) - 1, int(p / 100 * len(samples)))] * unit
+    return {"p50_ms": pick(50), "p95_ms": pick(95), "p99_ms": pick(99), "mean_ms": sum(samples) / len(samples) * unit}
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    func(*args, **kwargs)
+    return time.perf_counter() - start
+
+def bench_chunking(quick):
+    result = {}
+    for size in quick and [1 << 20] or [1 << 20, 10 << 20]:
+        text = synthetic_text(size)
+        duration = timed(GPT.text_to_chunks, text)
+        result[f"{size >> 20}mb_seconds"] = duration
+        result[f"{size >> 20}mb_chars_per_second"] = size / duration
+    return result
+
+def bench_embed_files(quick):
+    files = quick and 30 or 300
+    result = {}
+    dir = tempfile.mkdtemp()
+    try:
+        src = os.path.join(dir, "src")
+        synthetic_tree(src, files, 4000)
+        with quiet():
+            for mode, parallel in [("serial", False), ("parallel", True)]:
+                db = NumpyDB(os.path.join(dir, mode + ".db"), "bench")
+                duration = timed(GPT.embed_files, src, db, FakeEmbeddingFunc(), token_counter=len, parallel=parallel)
+                result[f"{mode}_files_per_second"] = files / duration
+                result[f"{mode}_chunks_per_second"] = db.count() / duration
+            # nothing changed, the manifest skips every file
+            result["unchanged_seconds"] = timed(GPT.embed_files, src, db, FakeEmbeddingFunc(), token_counter=len)
+    finally:
+        shutil.rmtree(dir)
+    return result
+
+# source tree where most files sit in node_modules, excluded by name, and in a gitignored build dir
+def scan_tree(dir, files):
+    names = ["index.js", "README.md", "logo.png", "data", "util.py", "style.css", "LICENSE", "font.woff"]
+    with open(os.path.join(dir, ".gitignore"), 'w') as f:
+        f.write("build/\n*.log\n")
+    for i in range(files):
+        top = i % 10 < 7 and "node_modules" or i % 10 < 8 and "build" or "src"
+        sub = os.path.join(dir, top, f"pkg{i % 97}", f"mod{i % 13}")
+        os.makedirs(sub, exist_ok=True)
+        with open(os.path.join(sub, f"{i}_{names[i % len(names)]}"), 'w') as f:
+            f.write("x = 1\n")
+
+def bench_scan(quick):
+    files = quick and 2000 or 100000
+    excludes = ["artifacts", "node_modules", ".git", ".gitignore", "__pycache__", "*.db"]
+    result = {}
+    dir = tempfile.mkdtemp()
+    try:
+        scan_tree(dir, files)
+
+        # what embed_files did before: os.walk with fnmatch excludes, a stat and libmagic for every file
+        def legacy():
+            magic = Scanner.get_magic()
+            for root, dirs, names in os.walk(dir):
+                dirs[:] = [d for d in dirs if not any(fnmatch.fnmatch(d, pattern) for pattern in excludes)]
+                for name in names:
+                    if any(fnmatch.fnmatch(name, pattern) for pattern in excludes):
+                        continue
+                    path = os.path.join(root, name)
+                    os.stat(path)
+                    magic.from_file(path)
+
+        def scanner():
+            for file in Scanner(excludes).scan(dir):
+                if file.kind is None:
+                    Scanner.file_type(file.path)
+
+        result["legacy_seconds"] = timed(legacy)
+        result["scanner_seconds"] = timed(scanner)
+        result["scanner_walk_files_per_second"] = files / timed(lambda: list(Scanner(excludes).scan(dir)))
+    finally:
+        shutil.rmtree(dir)
+    return result
+
+def bench_upsert(quick):
+    count = quick and 500 or 5000
+    dim = 384
+    func = FakeEmbeddingFunc(dim)
+    ids = [str(i) for i in range(count)]
+    embeddings = func(ids)
+    result = {}
+    dir = tempfile.mkdtemp()
+    try:
+        for backend in ["chroma", "numpy"]:
+            db = ChromaDB.get_db(os.path.join(dir, backend + "_single.db"), "bench", backend=backend)
+            duration = timed(lambda: [db.add_one(id, embedding) for id, embedding in zip(ids, embeddings)])
+            result[f"{backend}_single_items_per_second"] = count / duration
+            db = ChromaDB.get_db(os.path.join(dir, backend + "_batch.db"), "bench", backend=backend)
+            duration = timed(lambda: [db.add(ids[i:i+256], embeddings[i:i+256]) for i in range(0, count, 256)])
+            result[f"{backend}_batch_items_per_second"] = count / duration
+            db = ChromaDB.get_db(os.path.join(dir, backend + "_writer.db"), "bench", backend=backend)
+
+            def write():
+                with db.writer() as writer:
+                    for id, embedding in zip(ids, embeddings):
+                        writer.add_one(id, embedding)
+            result[f"{backend}_writer_items_per_second"] = count / timed(write)
+    finally:
+        shutil.rmtree(dir)
+    return result
+
+def bench_query(quick):
+    sizes = quick and [1000] or [1000, 10000]
+    dims = quick and [64] or [64, 384, 1536]
+    queries = quick and 50 or 200
+    result = {}
+    dir = tempfile.mkdtemp()
+    try:
+        for size in sizes:
+            for dim in dims:
+                func = FakeEmbeddingFunc(dim)
+                ids = [str(i) for i in range(size)]
+                embeddings = func(ids)
+                vectors = func([f"query {i}" for i in range(queries)])
+                for backend in ["chroma", "numpy"]:
+                    db = ChromaDB.get_db(os.path.join(dir, f"{backend}_{size}_{dim}.db"), "bench", backend=backend)
+                    for i in range(0, size, 1000):
+                        db.add(ids[i:i+1000], embeddings[i:i+1000])
+                    samples = [timed(db.query, vector, n_results=10) for vector in vectors]
+                    for key, value in percentiles(samples).items():
+                        result[f"{backend}_{size}x{dim}_{key}"] = value
+    finally:
+        shutil.rmtree(dir)
+    return result
+
+def bench_send(quick):
+    count = quick and 10 or 50
+    words = 500
+    server = StubOpenAI(reply_words=words).start()
+    result = {}
+    try:
+        gpt = GPT(api_key="stub", base_url=server.base_url, token_counter=lambda text: len(text.split()))
+        with quiet():
+            for mode, stream in [("stream", True), ("complete", False)]:
+                samples = []
+                for i in range(count):
+                    gpt.messages[1:] = []
+                    samples.append(timed(gpt.send, f"question {i}", stream=stream))
+                for key, value in percentiles(samples).items():
+                    result[f"{mode}_{key}"] = value
+                result[f"{mode}_tokens_per_second"] = count * words / sum(samples)
+        result["stream_overhead_ms"] = result["stream_p50_ms"] - result["complete_p50_ms"]
+    finally:
+        server.stop()
+    return result
+
+# seconds a fresh interpreter spends running statements, and the heavy modules they loaded
+def startup_seconds(statements):
+    script = "\n".join([
+        "import sys, time",
+        "start = time.perf_counter()",
+        statements,
+        "elapsed = time.perf_counter() - start",
+        "heavy = [m for m in ['openai', 'chromadb', 'tiktoken', 'magic', 'numpy'] if m in sys.modules]",
+        "print(elapsed, ' '.join(heavy))",
+    ])
+    output = subprocess.run([sys.executable, "-c", script], cwd=os.path.dirname(os.path.abspath(__file__)),
+                            capture_output=True, text=True, check=True).stdout.split()
+    return float(output[0]), output[1:]
+
+def bench_startup(quick):
+    runs = quick and 3 or 10
+    result = {}
+    sessions = {
+        "chat": "import gpt; gpt.GPT(api_key='x')",
+        "chunking": "import gpt; gpt.GPT.text_to_chunks('x' * 10000)",
+        "numpy_db": "import vector_db",
+        "chroma_db": "import vector_db, tempfile; vector_db.ChromaDB(tempfile.mkdtemp(), 'bench')",
+    }
+    for name, statements in sessions.items():
+        samples = [startup_seconds(statements)[0] for i in range(runs)]
+        result[f"{name}_p50_ms"] = percentiles(samples)["p50_ms"]
+    return result
+
+BENCHMARKS = {
+    "startup": bench_startup,
+    "chunking": bench_chunking,
+    "embed_files": bench_embed_files,
+    "scan": bench_scan,
+    "upsert": bench_upsert,
+    "query": bench_query,
+    "send": bench_send,
+}
+
+def run_benchmark(name, quick):
+    result = BENCHMARKS[name](quick)
+    result["peak_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return result
+
+def run_isolated(name, quick):
+    context = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        return executor.submit(run_benchmark, name, quick).result()
+
+def run(names=None, quick=False, isolate=True):
+    results = {}
+    for name in names or BENCHMARKS:
+        print(f"running {name}", file=sys.stderr)
+        results[name] = run_isolated(name, quick) if isolate else run_benchmark(name, quick)
+    return {
+        "meta": {"time": time.time(), "python": platform.python_version(), "platform": platform.platform(), "quick": quick},
+        "benchmarks": results,
+    }
+
+def higher_is_better(metric):
+    return "per_second" in metric
+
+# metrics more than tolerance worse than in baseline, as [(benchmark.metric, baseline, current, change)]
+def compare(results, baseline, tolerance=0.2):
+    regressions = []
+    for name, metrics in results["benchmarks"].items():
+        for metric, value in metrics.items():
+            base = baseline["benchmarks"].get(name, {}).get(metric)
+            if not base:
+                continue
+            change = (value - base) / abs(base)
+            if (higher_is_better(metric) and change < -tolerance) or (not higher_is_better(metric) and change > tolerance):
+                regressions.append((f"{name}.{metric}", base, value, change))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="offline benchmarks for gpt.py and vector_db.py")
+    parser.add_argument("names", nargs="*", choices=[[]] + list(BENCHMARKS), help="benchmarks to run, all by default")
+    parser.add_argument("--quick", action="store_true", help="smaller inputs")
+    parser.add_argument("-o", "--output", help="write results to this JSON file")
+    parser.add_argument("--baseline", help="compare against this JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative change before a metric counts as regressed")
+    args = parser.parse_args()
+
+    results = run(args.names, quick=args.quick)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for metric, base, value, change in regressions:
+            print(f"REGRESSION {metric}: {base:.4g} -> {value:.4g} ({change:+.0%})", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
+
+# EoF
@@ -0,0 +1,245 @@
+# cache.py
+#
+# on-disk caches backed by sqlite3
+
+import array
+import functools
+import hashlib
+import json
+import math
+import sqlite3
+import threading
+import time
+import types
+
+class EmbeddingCache:
+    # vectors are keyed by (model, sha256(text)) and stored as float32 blobs
+    # least recently used entries are evicted once the vectors take more than max_bytes
+    def __init__(self, path, max_bytes=1 << 30):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits, self.misses = 0, 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS embeddings (model TEXT, hash TEXT, vector BLOB, used REAL, PRIMARY KEY (model, hash))")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS embeddings_used ON embeddings (used)")
+        self.size = self.conn.execute("SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings").fetchone()[0]
+
+    @staticmethod
+    def hash(text):
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    @staticmethod
+    def pack(vector):
+        return array.array('f', vector).tobytes()
+
+    @staticmethod
+    def unpack(blob):
+        vector = array.array('f')
+        vector.frombytes(blob)
+        return vector.tolist()
+
+    # returns a list with a vector or None for each text
+    def get_many(self, model, texts):
+        hashes = [self.hash(text) for text in texts]
+        found = {}
+        with self.lock:
+            for i in range(0, len(hashes), 500):
+                keys = hashes[i:i+500]
+                rows = self.conn.execute(
+                    f"SELECT hash, vector FROM embeddings WHERE model = ? AND hash IN ({','.join('?' * len(keys))})",
+                    [model] + keys).fetchall()
+                found.update(rows)
+            if found:
+                now = time.time()
+                self.conn.executemany("UPDATE embeddings SET used = ? WHERE model = ? AND hash = ?", [(now, model, h) for h in found])
+                self.conn.commit()
+        return [h in found and self.unpack(found[h]) or None for h in hashes]
+
+    def put_many(self, model, texts, vectors):
+        now = time.time()
+        rows = [(model, self.hash(text), self.pack(vector), now) for text, vector in zip(texts, vectors)]
+        with self.lock:
+            old = self.conn.execute(
+                f"SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings WHERE model = ? AND hash IN ({','.join('?' * len(rows))})",
+                [model] + [row[1] for row in rows]).fetchone()[0] if rows else 0
+            self.conn.executemany("INSERT OR REPLACE INTO embeddings (model, hash, vector, used) VALUES (?, ?, ?, ?)", rows)
+            self.size += sum(len(row[2]) for row in rows) - old
+            self.evict()
+            self.conn.commit()
+
+    # drop least recently used entries until the cache is back under max_bytes
+    def evict(self):
+        while self.size > self.max_bytes:
+            row = self.conn.execute("SELECT AVG(LENGTH(vector)) FROM embeddings").fetchone()
+            if not row[0]:
+                self.size = 0
+                break
+            count = max(1, math.ceil((self.size - self.max_bytes) / row[0]))
+            freed = self.conn.execute(
+                "SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM (SELECT vector FROM embeddings ORDER BY used LIMIT ?)", (count,)).fetchone()[0]
+            self.conn.execute("DELETE FROM embeddings WHERE rowid IN (SELECT rowid FROM embeddings ORDER BY used LIMIT ?)", (count,))
+            self.size -= freed
+
+    # embed texts with func, calling it only for texts not in the cache
+    def embed(self, model, texts, func):
+        texts = list(texts)
+        vectors = self.get_many(model, texts)
+        missing = list(dict.fromkeys(text for text, vector in zip(texts, vectors) if vector is None))
+        self.hits += len(texts) - vectors.count(None)
+        self.misses += vectors.count(None)
+        if missing:
+            embedded = [list(vector) for vector in func(missing)]
+            if len(embedded) != len(missing):
+                raise ValueError(f"embedding function returned {len(embedded)} embeddings for {len(missing)} texts")
+            self.put_many(model, missing, embedded)
+            embedded = dict(zip(missing, embedded))
+            vectors = [vector if vector is not None else embedded[text] for text, vector in zip(texts, vectors)]
+        return vectors
+
+    # wrap a chroma style embedding function, i.e. func(input) -> list of embeddings
+    # vectors are cached under model, func.model_name, or the class of a callable object;
+    # plain functions and methods need an explicit model, they'd all share one namespace otherwise
+    def wrap(self, func, model=None):
+        model = model or getattr(func, "model_name", None)
+        if model is None:
+            if isinstance(func, (types.FunctionType, types.BuiltinFunctionType, types.MethodType, functools.partial)):
+                raise ValueError(f"model is required to cache embeddings of {func!r}")
+            model = f"{type(func).__module__}.{type(func).__qualname__}"
+        return CachedEmbeddingFunction(self, func, model)
+
+    def stats(self):
+        with self.lock:
+            entries = self.conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        return {"hits": self.hits, "misses": self.misses, "entries": entries, "bytes": self.size}
+
+    def close(self):
+        self.conn.close()
+
+class CachedEmbeddingFunction:
+    def __init__(self, cache, func, model):
+        self.cache = cache
+        self.func = func
+        self.model_name = model
+
+    def __call__(self, input):
+        return self.cache.embed(self.model_name, input, self.func)
+
+class ResponseCache:
+    # chat replies keyed by sha256 of the model, the normalized messages and the sampling parameters
+    # entries older than ttl seconds are misses, least recently used entries are evicted
+    # once the replies take more than max_bytes
+    def __init__(self, path, ttl=7 * 24 * 3600, max_bytes=1 << 28):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits, self.misses = 0, 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, content TEXT, size INTEGER, created REAL, used REAL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_used ON responses (used)")
+        self.size = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    # only role, content and name take part in the key, so message objects and dicts with extra fields match
+    @staticmethod
+    def key(model, messages, params=None):
+        normalized = []
+        for message in messages:
+            get = isinstance(message, dict) and message.get or (lambda field: getattr(message, field, None))
+            normalized.append({field: get(field) for field in ["role", "content", "name"] if get(field) is not None})
+        data = json.dumps({"model": model, "messages": normalized, "params": params or {}}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    # returns the cached reply or None
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute("SELECT content, size, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None and now - row[2] > self.ttl:
+                self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.size -= row[1]
+                self.conn.commit()
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self.conn.execute("UPDATE responses SET used = ? WHERE key = ?", (now, key))
+            self.conn.commit()
+            self.hits += 1
+        return row[0]
+
+    def put(self, key, content):
+        now = time.time()
+        size = len(content.encode())
+        with self.lock:
+            old = self.conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self.conn.execute("INSERT OR REPLACE INTO responses (key, content, size, created, used) VALUES (?, ?, ?, ?, ?)",
+                              (key, content, size, now, now))
+            self.size += size - (old and old[0] or 0)
+            self.evict()
+            self.conn.commit()
+
+    # drop expired entries, then least recently used ones until the cache is back under max_bytes
+    def evict(self):
+        expired = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses WHERE created < ?", (time.time() - self.ttl,)).fetchone()[0]
+        if expired:
+            self.conn.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.ttl,))
+            self.size -= expired
+        while self.size > self.max_bytes:
+            row = self.conn.execute("SELECT key, size FROM responses ORDER BY used LIMIT 1").fetchone()
+            if row is None:
+                self.size = 0
+                break
+            self.conn.execute("DELETE FROM responses WHERE key = ?", (row[0],))
+            self.size -= row[1]
+
+    def stats(self):
+        with self.lock:
+            entries = self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        return {"hits": self.hits, "misses": self.misses, "entries": entries, "bytes": self.size}
+
+    def close(self):
+        self.conn.close()
+
+class TokenCountCache:
+    # token counts keyed by (encoding name, sha256(text)), small enough to keep forever
+    def __init__(self, path):
+        self.path = path
+        self.hits, self.misses = 0, 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS token_counts (encoding TEXT, hash TEXT, count INTEGER, PRIMARY KEY (encoding, hash))")
+
+    # returns a list with a count or None for each hash
+    def get_many(self, encoding, hashes):
+        found = {}
+        with self.lock:
+            for i in range(0, len(hashes), 500):
+                keys = hashes[i:i+500]
+                rows = self.conn.execute(
+                    f"SELECT hash, count FROM token_counts WHERE encoding = ? AND hash IN ({','.join('?' * len(keys))})",
+                    [encoding] + keys).fetchall()
+                found.update(rows)
+        counts = [found.get(h) for h in hashes]
+        self.hits += len(counts) - counts.count(None)
+        self.misses += counts.count(None)
+        return counts
+
+    def put_many(self, encoding, hashes, counts):
+        with self.lock:
+            self.conn.executemany("INSERT OR REPLACE INTO token_counts (encoding, hash, count) VALUES (?, ?, ?)",
+                                  [(encoding, h, count) for h, count in zip(hashes, counts)])
+            self.conn.commit()
+
+    def stats(self):
+        with self.lock:
+            entries = self.conn.execute("SELECT COUNT(*) FROM token_counts").fetchone()[0]
+        return {"hits": self.hits, "misses": self.misses, "entries": entries}
+
+    def close(self):
+        self.conn.close()
+
+# EoF
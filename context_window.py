@@ -0,0 +1,63 @@
+# context_window.py
+#
+# token-budgeted chat history
+#   each message is tokenized once, old turns are dropped to keep the prompt under budget,
+#   leading system messages are always kept
+
+class ContextWindow:
+    # context sizes in tokens
+    model_contexts = {
+        "gpt-4": 8192,
+        "gpt-4-32k": 32768,
+        "gpt-4-1106-preview": 128000,
+        "gpt-4-1106-vision-preview": 128000,
+        "gpt-4-vision-preview": 128000,
+        "gpt-3.5-turbo": 16385,
+        "gpt-3.5-turbo-1106": 16385,
+    }
+    default_context = 8192
+    # tokens the chat format adds per message
+    message_overhead = 4
+
+    # max_tokens: prompt budget, defaults to the model's context minus reply_tokens
+    def __init__(self, token_counter, model=None, max_tokens=None, reply_tokens=4096):
+        self.token_counter = token_counter
+        if max_tokens is None:
+            context = self.model_contexts.get(model, self.default_context)
+            max_tokens = context - min(reply_tokens, context // 4)
+        self.max_tokens = max_tokens
+        self.counts = {}    # id(message) -> (message, token count)
+
+    def count(self, message):
+        entry = self.counts.get(id(message))
+        if entry is None or entry[0] is not message:
+            content = message["content"] if isinstance(message, dict) else message.content
+            tokens = self.message_overhead + self.token_counter(content if isinstance(content, str) else str(content or ""))
+            entry = self.counts[id(message)] = (message, tokens)
+        return entry[1]
+
+    def total(self, messages):
+        return sum(self.count(message) for message in messages)
+
+    # drop the oldest turns from messages in place, i.e. a user message and the replies following it,
+    # until they fit max_tokens; the leading system messages and the last message stay
+    # returns the token count of what's left
+    def fit(self, messages):
+        total = self.total(messages)
+        first = 0
+        while first < len(messages) and self.role(messages[first]) == "system":
+            first += 1
+        while total > self.max_tokens and first < len(messages) - 1:
+            end = first + 1
+            while end < len(messages) - 1 and self.role(messages[end]) != "user":
+                end += 1
+            total -= sum(self.count(message) for message in messages[first:end])
+            del messages[first:end]
+        self.counts = {id(message): self.counts[id(message)] for message in messages}
+        return total
+
+    @staticmethod
+    def role(message):
+        return message["role"] if isinstance(message, dict) else message.role
+
+# EoF
@@ -1,36 +1,107 @@
 #!/usr/bin/env python3
 
 import atexit
+import codecs
 import code
-import fnmatch
+import collections
+import concurrent.futures
+import functools
 import hashlib
-import magic
-import openai
+import io
+import mmap
 import os
+import re
 import readline
 import shutil
-import tiktoken
+import sys
+import threading
 
-import chromadb
-from vector_db import ChromaDB
+from cache import EmbeddingCache, ResponseCache, TokenCountCache
+from context_window import ContextWindow
+from manifest import Manifest
+from metrics import metrics
+from scanner import Scanner
+
+# terminal sink for streamed replies: deltas are buffered and written together once flush_size
+# characters or a newline arrive, instead of one write and flush per token
+# a timer writes out whatever is buffered after flush_interval seconds, so a stalled reply isn't held back
+# any object with write(delta) and end() can stand in for it, e.g. to feed a UI or a pipe
+class StreamPrinter:
+    def __init__(self, file=None, flush_size=256, flush_interval=0.05):
+        self.file = file
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.buffer = []
+        self.size = 0
+        self.timer = None
+        self.lock = threading.RLock()
+
+    def write(self, delta):
+        with self.lock:
+            self.buffer.append(delta)
+            self.size += len(delta)
+            if self.size >= self.flush_size or "\n" in delta:
+                self.flush()
+            elif self.timer is None:
+                self.timer = threading.Timer(self.flush_interval, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            file = self.file or sys.stdout
+            if self.buffer:
+                file.write("".join(self.buffer))
+                self.buffer, self.size = [], 0
+            file.flush()
+
+    # end of a reply
+    def end(self):
+        self.write("\n")
 
 class GPT:
+    system_prompt = "You're an expert coder and a sharp critic. If you don't know, don't make up, just say you don't know."
+
     # chat models
     #   gpt-4, gpt-4-32k
     #   gpt-4-1106-preview, a.k.a. gpt-4-turbo
     #   gpt-4-1106-vision-preview
     # embedding model
     #   text-embedding-ada-002 
-    def __init__(self, model="gpt-4-1106-preview", embedding_model="text-embedding-ada-002"):
+    # embedding_cache: EmbeddingCache or a path to one
+    # max_context_tokens: prompt budget for send, defaults to the model's context size minus room for the reply
+    # api_key, base_url: default to OPENAI_API_KEY or ~/.openai_api_key, and the OpenAI API
+    #   the client is created on first use, so a session that doesn't reach the API never loads openai
+    # response_cache: ResponseCache or a path to one, replies to a conversation sent before are served from it
+    # output: where send(stream=True) writes replies, a StreamPrinter on stdout by default
+    def __init__(self, model="gpt-4-1106-preview", embedding_model="text-embedding-ada-002", embedding_cache=None,
+                 max_context_tokens=None, token_counter=None, api_key=None, base_url=None, response_cache=None, output=None):
         self.model = model
         self.embedding_model = embedding_model
-        api_key_path = os.path.expanduser("~/.openai_api_key")
-        key = "OPENAI_API_KEY" in os.environ and os.environ["OPENAI_API_KEY"] or (os.path.isfile(api_key_path) and self.load_file(api_key_path).strip())
-        self.client = openai.OpenAI(api_key=key)
-        del key, api_key_path
+        self.embedding_cache = isinstance(embedding_cache, str) and EmbeddingCache(embedding_cache) or embedding_cache
+        self.response_cache = isinstance(response_cache, str) and ResponseCache(response_cache) or response_cache
+        self.output = output or StreamPrinter()
+        self.api_key = api_key
+        self.base_url = base_url
+        self._client = None
         self.messages = [
-            {"role": "system", "content": "You're an expert coder and a sharp critic. If you don't know, don't make up, just say you don't know."},
+            {"role": "system", "content": self.system_prompt},
         ]
+        self.context = ContextWindow(token_counter or self.count_tokens, model=model, max_tokens=max_context_tokens)
+
+    @property
+    def client(self):
+        if self._client is None:
+            import openai
+            self._client = openai.OpenAI(api_key=self.api_key or self.get_openai_key(), base_url=self.base_url)
+        return self._client
+
+    @client.setter
+    def client(self, client):
+        self._client = client
 
     @staticmethod
     def load_file(file_path):
@@ -44,158 +115,548 @@ class GPT:
             script = file.read()
         exec(script, globals())
 
-    def send(self, msg, stream=True):
+    # old turns are dropped from self.messages to keep the prompt within self.context.max_tokens
+    # params, e.g. temperature or seed, are passed on to the chat completion
+    # with a response_cache, a conversation sent before with the same params is answered from the cache
+    # with stream=True, the reply is written to self.output as it arrives, see send_stream
+    # with metrics enabled, records gpt_send_seconds, gpt_first_token_seconds (streaming),
+    # gpt_reply_tokens_total, gpt_tokens_per_second and gpt_response_cache_hits_total
+    def send(self, msg, stream=True, **params):
+        if stream:
+            try:
+                for delta in self.send_stream(msg, **params):
+                    self.output.write(delta)
+            finally:
+                self.output.end()
+            return self.messages[-1]["content"]
+        timer = metrics.timer("gpt_send_seconds", model=self.model, stream=False)
+        with timer:
+            key, content = self.start_turn(msg, params)
+            if content is None:
+                reply = self.client.chat.completions.create(
+                    model=self.model, messages=self.messages, **params
+                )
+                content = reply.choices[0].message.content
+                if key and content is not None:
+                    self.response_cache.put(key, content)
+            self.messages.append({"role": "assistant", "content": content})
+        self.record_reply(content, timer.elapsed)
+        return content
+
+    # generator of reply deltas as they arrive, e.g. for delta in gpt.send_stream(msg): ...
+    # a cached reply comes as one delta; the reply is added to self.messages once the generator
+    # is exhausted or closed, and only a complete one is cached
+    def send_stream(self, msg, **params):
+        timer = metrics.timer("gpt_send_seconds", model=self.model, stream=True)
+        parts, complete = [], False
+        with timer:
+            key, content = self.start_turn(msg, params)
+            try:
+                if content is not None:
+                    parts.append(content)
+                    yield content
+                else:
+                    reply = self.client.chat.completions.create(
+                        model=self.model, messages=self.messages, stream=True, **params
+                    )
+                    for delta in self.stream_deltas(reply):
+                        parts.append(delta)
+                        yield delta
+                    if key:
+                        self.response_cache.put(key, "".join(parts))
+                complete = True
+            finally:
+                if parts or complete:
+                    self.messages.append({"role": "assistant", "content": "".join(parts)})
+        self.record_reply(self.messages[-1]["content"], timer.elapsed)
+
+    # appends the user turn and fits the history, returns (response cache key, cached reply or None)
+    def start_turn(self, msg, params):
         self.messages.append({"role": "user", "content": msg})
-        if not stream:
-            reply = self.client.chat.completions.create(
-                model=self.model, messages=self.messages
-            )
-            response_message = reply.choices[0].message
-            self.messages.append(response_message)
-            return response_message.content
-        else:
-            reply = self.client.chat.completions.create(
-                model=self.model, messages=self.messages, stream=True
-            )
-            content = ""
+        self.context.fit(self.messages)
+        if self.response_cache is None:
+            return None, None
+        key = self.response_cache.key(self.model, self.messages, params)
+        content = self.response_cache.get(key)
+        if content is not None:
+            metrics.count("gpt_response_cache_hits_total", model=self.model)
+        return key, content
+
+    def record_reply(self, content, elapsed):
+        if not metrics.enabled:
+            return
+        tokens = self.context.token_counter(content or "")
+        metrics.count("gpt_reply_tokens_total", tokens, model=self.model)
+        if elapsed:
+            metrics.observe("gpt_tokens_per_second", tokens / elapsed, model=self.model)
+
+    # content deltas of a streamed chat completion
+    def stream_deltas(self, reply):
+        first = metrics.timer("gpt_first_token_seconds", model=self.model)
+        with first:
             for chunk in reply:
                 delta = chunk.choices[0].delta
                 if delta.content is not None:
-                    content += delta.content
-                    print(delta.content, end='', flush=True)
-            print()
-            self.messages.append({"role": "assistant", "content": content})
-            return content
-        
+                    if first.elapsed is None:
+                        first.stop()
+                    yield delta.content
+
     def get_embeddings(self, texts):
+        with metrics.timer("gpt_embeddings_seconds", model=self.embedding_model):
+            metrics.count("gpt_embedded_texts_total", len(texts), model=self.embedding_model)
+            if self.embedding_cache is not None:
+                return self.embedding_cache.embed(self.embedding_model, texts, self.create_embeddings)
+            return self.create_embeddings(texts)
+
+    def create_embeddings(self, texts):
         embeddings = self.client.embeddings.create(input=texts, model=self.embedding_model)
         return [item.embedding for item in embeddings.data]
 
     def get_embedding(self, text):
         return self.get_embeddings([text])[0]
 
+    whitespace = re.compile(r'\s')
+    word_start = re.compile(r'(?<=\s)\S')
+
+    @classmethod
+    def text_to_chunks(cls, text, chunk_size=500, overlap_size=100, tokens=False, encoder=None):
+        return list(cls.iter_chunks(text, chunk_size=chunk_size, overlap_size=overlap_size, tokens=tokens, encoder=encoder))
+
+    # yields (start, end, chunk) with chunk_size and overlap_size in characters, or in tokens with tokens=True
+    @classmethod
+    def iter_chunks(cls, text, chunk_size=500, overlap_size=100, tokens=False, encoder=None):
+        if tokens:
+            return cls.iter_token_chunks([text], chunk_size=chunk_size, overlap_size=overlap_size, encoder=encoder)
+        return cls.iter_char_chunks([text], chunk_size=chunk_size, overlap_size=overlap_size)
+
+    # chunks the concatenation of blocks, holding only the current window of text in memory
     @classmethod
-    def text_to_chunks(cls, text, chunk_size=500, overlap_size=100):
+    def iter_char_chunks(cls, blocks, chunk_size=500, overlap_size=100):
         if chunk_size < overlap_size or chunk_size < 10 or overlap_size < 0:
             raise ValueError("chunk_size must be at least 10 and greater than overlap_size")
 
         overfill_size = overlap_size > 0 and int(overlap_size / 2) or int(chunk_size / 2)
-        chunks = []
+        # enough text past start to place end and decide whether it's the last chunk
+        lookahead = chunk_size + max(overlap_size, overfill_size) + 2
+        blocks = iter(blocks)
+        text, base, eof = "", 0, False
         start = 0
-        while start < len(text):
+        while True:
+            while not eof and base + len(text) - start < lookahead:
+                block = next(blocks, None)
+                if block is None:
+                    eof = True
+                else:
+                    text += block
+            length = base + len(text)
+            if start >= length:
+                break
+
             # Find the end of the chunk
             end = start + chunk_size
-            if end > len(text) or len(text) - end <= overlap_size:
-                end = len(text)
+            if eof and (end > length or length - end <= overlap_size):
+                end = length
             else:
                 # Make sure to end the chunk at a space, extending the chunk within overfill_size if necessary
-                next = end
-                while next < len(text) and next - end <= overfill_size and not text[next].isspace():
-                    next += 1
-                if text[next].isspace():
-                    end = next
-            chunk = text[start:end]
-            chunks.append((start, end, chunk))
-
-            if end >= len(text):
+                m = cls.whitespace.search(text, end - base, end + overfill_size + 2 - base)
+                if m:
+                    end = m.start() + base
+            yield start, end, text[start - base:end - base]
+
+            if end >= length:
                 break
 
             # Move the next start to the end minus the overlap size
             # Make sure to start at a non-whitespace character, shriniking the chunk within overfill_size if necessary
             start = end - overlap_size
-            next = max(start, 1)
-            while next < end - overfill_size and not (text[next-1].isspace() and not text[next].isspace()):
-                next += 1
-            if text[next-1].isspace() and not text[next].isspace():
-                start = next
-        return chunks
-    
+            pos = max(start, 1)
+            m = cls.word_start.search(text, pos - base, max(pos, end - overfill_size) + 1 - base)
+            if m:
+                start = m.start() + base
+
+            # drop consumed text once it's most of the buffer, keeping one character before start
+            # for the word boundary check
+            if start - 1 - base > len(text) // 2:
+                text = text[start - 1 - base:]
+                base = start - 1
+
+    # same as iter_char_chunks, with chunk_size and overlap_size counted in tokens of encoder
+    # text is tokenized in whitespace delimited segments, so memory stays bounded by the window
+    @classmethod
+    def iter_token_chunks(cls, blocks, chunk_size=500, overlap_size=100, encoder=None, max_segment=1 << 20):
+        if chunk_size <= overlap_size or chunk_size < 10 or overlap_size < 0:
+            raise ValueError("chunk_size must be at least 10 and greater than overlap_size")
+
+        encoder = encoder or cls.get_encoder()
+        blocks = iter(blocks)
+        text, base, eof = "", 0, False
+        offsets = collections.deque()   # start offsets of tokens from the current chunk on
+        encoded = 0                     # text up to this offset is tokenized
+        while True:
+            while not eof and len(offsets) <= chunk_size + overlap_size:
+                block = next(blocks, None)
+                if block is None:
+                    eof = True
+                else:
+                    text += block
+                pending = text[encoded - base:]
+                cut = len(pending)
+                if not eof:
+                    cut = max(pending.rfind(' '), pending.rfind('\n'), pending.rfind('\t'))
+                    if cut <= 0:
+                        cut = len(pending) >= max_segment and len(pending) or 0
+                if cut > 0:
+                    _, token_offsets = encoder.decode_with_offsets(encoder.encode_ordinary(pending[:cut]))
+                    offsets.extend(encoded + offset for offset in token_offsets)
+                    encoded += cut
+            if not offsets:
+                break
+
+            start = offsets[0]
+            last = eof and len(offsets) <= chunk_size + overlap_size
+            end = last and encoded or offsets[chunk_size]
+            yield start, end, text[start - base:end - base]
+            if last:
+                break
+
+            for _ in range(chunk_size - overlap_size):
+                offsets.popleft()
+            if offsets[0] - base > len(text) // 2:
+                text = text[offsets[0] - base:]
+                base = offsets[0]
+
+    # decoded text blocks of a file, read through mmap, newlines translated like open(file, 'r')
+    @staticmethod
+    def read_blocks(file_path, block_size=1 << 20):
+        with open(file_path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                decoder = io.IncrementalNewlineDecoder(codecs.getincrementaldecoder('utf-8')(), translate=True)
+                for i in range(0, len(m), block_size):
+                    yield decoder.decode(m[i:i+block_size])
+                yield decoder.decode(b"", final=True)
+
+    @classmethod
+    def iter_file_chunks(cls, file_path, chunk_size=500, overlap_size=100, tokens=False, encoder=None):
+        if tokens:
+            return cls.iter_token_chunks(cls.read_blocks(file_path), chunk_size=chunk_size, overlap_size=overlap_size, encoder=encoder)
+        return cls.iter_char_chunks(cls.read_blocks(file_path), chunk_size=chunk_size, overlap_size=overlap_size)
+
+    # yields ({ "role": "user", "content": "<file-name>\n\n<file-content>" }, token_count)
+    # from source files under dir/*/*, as each batch of batch_size files is counted
+    # token counts come from token_cache (TokenCountCache or a path to one) when the content was seen
+    # before, the rest are counted with encode_ordinary_batch on num_threads threads
+    # files matched by .gitignore files under dir are skipped unless gitignore=False
+    @classmethod
+    def iter_source_base(cls, dir, excludes=["artifacts", "node_modules", ".git", ".gitignore", "__pycache__"],
+                         token_cache=None, encoder=None, batch_size=64, num_threads=8, gitignore=True):
+        file_extensions = [".py", ".c", ".cpp", ".js", ".java", ".cs", ".go", ".rb", ".php", ".swift", ".ts", ".sol"]
+        encoder = encoder or cls.get_encoder()
+        if isinstance(token_cache, str):
+            token_cache = TokenCountCache(token_cache)
+
+        def count(batch):
+            hashes = [hashlib.sha256(content.encode()).hexdigest() for _, content in batch]
+            counts = token_cache is not None and token_cache.get_many(encoder.name, hashes) or [None] * len(batch)
+            missing = [i for i, c in enumerate(counts) if c is None]
+            if missing:
+                tokens = encoder.encode_ordinary_batch([batch[i][1] for i in missing], num_threads=num_threads)
+                for i, t in zip(missing, tokens):
+                    counts[i] = len(t)
+                del tokens
+                if token_cache is not None:
+                    token_cache.put_many(encoder.name, [hashes[i] for i in missing], [counts[i] for i in missing])
+            for (file_path, content), c in zip(batch, counts):
+                yield {"role": "user", "content": f"{file_path}\n\n{content}"}, c
+
+        batch = []
+        for file in Scanner(excludes, gitignore=gitignore).scan(dir):
+            if file.path.endswith(tuple(file_extensions)):
+                with open(file.path, 'r') as f:
+                    batch.append((file.path, f.read()))
+                if len(batch) >= batch_size:
+                    yield from count(batch)
+                    batch = []
+        if batch:
+            yield from count(batch)
+
     # prepare [{ "role": "user", "content": "<file-name>\n\n<file-content>" }]
     # from source files under dir/*/*
     @classmethod
-    def prep_source_base(cls, dir, excludes=["artifacts", "node_modules", ".git", ".gitignore", "__pycache__"]):
-        file_extensions = [".py", ".c", ".cpp", ".js", ".java", ".cs", ".go", ".rb", ".php", ".swift", ".ts", ".sol"]
+    def prep_source_base(cls, dir, excludes=["artifacts", "node_modules", ".git", ".gitignore", "__pycache__"],
+                         token_cache=None, encoder=None, num_threads=8, gitignore=True):
         count, size, token_count = 0, 0, 0
         msgs = []
-        enc = tiktoken.get_encoding("cl100k_base")
-        for root, dirs, files in os.walk(dir):
-            for file in files:
-                if any(s in root for s in excludes):
-                    continue
-                if any(file.endswith(ext) for ext in file_extensions):
-                    file_path = os.path.join(root, file)
-                    with open(file_path, 'r') as f:
-                        file_content = f.read()
-                        tokens = enc.encode(file_content)
-                    msgs.append({"role": "user", "content": f"{file_path}\n\n{file_content}"})
-                    count, size, token_count  = count + 1, size + len(file_content), token_count + len(tokens)
+        for msg, tokens in cls.iter_source_base(dir, excludes=excludes, token_cache=token_cache, encoder=encoder,
+                                                num_threads=num_threads, gitignore=gitignore):
+            msgs.append(msg)
+            file_size = len(msg["content"]) - msg["content"].index("\n\n") - 2
+            count, size, token_count = count + 1, size + file_size, token_count + tokens
         return {"count": count, "size": size, "token_count": token_count, "messages": msgs}
 
     @staticmethod
     def get_openai_key():
         api_key_path = os.path.expanduser("~/.openai_api_key")
-        key = "OPENAI_API_KEY" in os.environ and os.environ["OPENAI_API_KEY"] or (os.path.isfile(api_key_path) and self.load_file(api_key_path).strip())
+        key = "OPENAI_API_KEY" in os.environ and os.environ["OPENAI_API_KEY"] or (os.path.isfile(api_key_path) and GPT.load_file(api_key_path).strip())
         return key
 
     @staticmethod
-    def get_embedding_db(path, collection_name):
-        embedding_db = ChromaDB(path=path, name=collection_name)
+    def get_embedding_db(path, collection_name, backend='chroma'):
+        from vector_db import ChromaDB
+        embedding_db = ChromaDB.get_db(path=path, name=collection_name, backend=backend)
         return embedding_db
 
     @staticmethod
     def get_openai_embedding_func():
+        import chromadb.utils.embedding_functions
         embedding_func = chromadb.utils.embedding_functions.OpenAIEmbeddingFunction(api_key=api_key, model_name=model_name)
         return embedding_func
 
     @staticmethod
     def get_chroma_embedding_func():
+        import chromadb.utils.embedding_functions
         embedding_func = chromadb.utils.embedding_functions.ChromaEmbeddingFunction(embedding_db=embedding_db)
         return embedding_func
 
+    # cached tiktoken encoder, shared by everything that counts tokens
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def get_encoder(name="cl100k_base"):
+        import tiktoken
+        return tiktoken.get_encoding(name)
+
     @classmethod
-    def embed_files(cls, dir, db, embedding_func, excludes=["artifacts", "node_modules", ".git", ".gitignore", "__pycache__", "*.db"]):
-        magic_obj = magic.Magic(mime=True)
-        max_size = 100000
-        chunk_size = 500
-        overlap_size = 100
-        for root, dirs, files in os.walk(dir):
-            dirs[:] = [d for d in dirs if not any(fnmatch.fnmatch(d, pattern) for pattern in excludes)]
-            for file in files:
-                if any(fnmatch.fnmatch(file, pattern) for pattern in excludes):
-                    continue
-                file_path = os.path.join(root, file)
-                file_type = magic_obj.from_file(file_path)
-                if not file_type.startswith('text'):
-                    continue
-                print(file_path, '->', file_type)
-                chunks = []
-                try:
-                    with open(file_path, 'r', encoding='utf-8') as f:
-                        file_content = f.read()
-                    if len(file_content) >= max_size:
-                        continue
-                    chunks = cls.text_to_chunks(file_content, chunk_size=chunk_size, overlap_size=overlap_size)
-                except UnicodeDecodeError as e:
-                    print(file_path, e)
+    def count_tokens(cls, text):
+        return len(cls.get_encoder().encode_ordinary(text))
+
+    # pack (id, document, metadata) items into batches bounded by item count and token budget
+    # a single item larger than max_tokens goes out in a batch of its own
+    @classmethod
+    def batch_chunks(cls, items, max_items=256, max_tokens=100000, token_counter=None):
+        if max_items < 1 or max_tokens < 1:
+            raise ValueError("max_items and max_tokens must be positive")
+        token_counter = token_counter or cls.count_tokens
+        batch, batch_tokens = [], 0
+        for item in items:
+            tokens = token_counter(item[1])
+            if batch and (len(batch) >= max_items or batch_tokens + tokens > max_tokens):
+                yield batch
+                batch, batch_tokens = [], 0
+            batch.append(item)
+            batch_tokens += tokens
+        if batch:
+            yield batch
+
+    # embed one batch of (id, document, metadata) items with a single embedding_func call
+    @staticmethod
+    def embed_batch(embedding_func, batch):
+        docs = [item[1] for item in batch]
+        with metrics.timer("embed_files_stage_seconds", stage="embed"):
+            embeddings = embedding_func(docs)
+        metrics.count("embed_files_chunks_total", len(docs))
+        if len(embeddings) != len(docs):
+            raise ValueError(f"embedding_func returned {len(embeddings)} embeddings for {len(docs)} documents")
+        return embeddings
+
+    @staticmethod
+    def add_batch(db, batch, embeddings):
+        ids, docs, metadatas = (list(x) for x in zip(*batch))
+        with metrics.timer("embed_files_stage_seconds", stage="write"):
+            db.add(ids=ids, embeddings=list(embeddings), documents=docs, metadatas=metadatas)
+
+    # yields (arg, func(arg)) in order, keeping at most max_pending calls in flight on executor
+    @staticmethod
+    def ordered_map(func, args, executor=None, max_pending=16):
+        if executor is None:
+            for arg in args:
+                yield arg, func(arg)
+            return
+        pending = collections.deque()
+        for arg in args:
+            pending.append((arg, executor.submit(func, arg)))
+            if len(pending) >= max_pending:
+                arg, future = pending.popleft()
+                yield arg, future.result()
+        while pending:
+            arg, future = pending.popleft()
+            yield arg, future.result()
+
+    # embedded batches are upserted by a BufferedWriter, whose background thread writes up to
+    # max_items chunks per db.add while embedding goes on, with at most queue_size batches waiting
+    @staticmethod
+    def write_batches(db, embedded, queue_size=16, max_items=1024):
+        from vector_db import BufferedWriter
+        with BufferedWriter(db, max_batch=max_items, queue_size=queue_size) as writer:
+            for batch, embeddings in embedded:
+                ids, docs, metadatas = (list(x) for x in zip(*batch))
+                writer.add(ids, embeddings=list(embeddings), metadatas=metadatas, documents=docs)
+
+    @staticmethod
+    def scan_files(dir, excludes, gitignore=True):
+        for file in Scanner(excludes, gitignore=gitignore).scan(dir):
+            yield file.path
+
+    # (id, document, metadata) for each chunk of a file, streamed through iter_file_chunks
+    @classmethod
+    def file_items(cls, file_path, chunk_size=500, overlap_size=100, tokens=False, encoder=None, text=None):
+        if text is not None:
+            chunks = cls.iter_chunks(text, chunk_size=chunk_size, overlap_size=overlap_size, tokens=tokens, encoder=encoder)
+        else:
+            chunks = cls.iter_file_chunks(file_path, chunk_size=chunk_size, overlap_size=overlap_size, tokens=tokens, encoder=encoder)
+        for chunk in chunks:
+            id = f"{file_path}:{chunk[0]}:{chunk[1]}:{chunk[2]}"
+            id = hashlib.sha256(id.encode()).hexdigest()
+            yield id, chunk[2], {"file": file_path, "start": chunk[0], "end": chunk[1]}
+
+    # detect, hash and chunk one file, returns (sha256, items)
+    # items are [] if the file isn't indexable text, None if its content hash equals known_sha,
+    # and False if the file is stream_size or larger, to be streamed by the caller with file_items
+    # kind and size come from the scanner when known, libmagic only looks at files the name doesn't settle
+    @classmethod
+    def load_chunks(cls, file_path, known_sha=None, chunk_size=500, overlap_size=100, tokens=False, encoder=None, stream_size=1 << 22,
+                    kind=None, size=None):
+        file_type = kind or Scanner.kind_from_name(os.path.basename(file_path))
+        if file_type is None:
+            with metrics.timer("embed_files_stage_seconds", stage="magic"):
+                file_type = Scanner.file_type(file_path)
+        if not file_type.startswith('text'):
+            return None, []
+        print(file_path, '->', file_type)
+        large = (size if size is not None else os.path.getsize(file_path)) >= stream_size
+        try:
+            with metrics.timer("embed_files_stage_seconds", stage="read"):
+                sha = hashlib.sha256()
+                blocks = []
+                for block in cls.read_blocks(file_path):
+                    sha.update(block.encode())
+                    if not large:
+                        blocks.append(block)
+        except UnicodeDecodeError as e:
+            print(file_path, e)
+            return None, []
+        sha = sha.hexdigest()
+        if sha == known_sha:
+            return sha, None
+        if large:
+            return sha, False
+        with metrics.timer("embed_files_stage_seconds", stage="chunk"):
+            return sha, list(cls.file_items(file_path, chunk_size=chunk_size, overlap_size=overlap_size, tokens=tokens, encoder=encoder, text="".join(blocks)))
+
+    # load_chunks for a (file_path, ScannedFile, manifest entry) tuple, picklable for process pools
+    # with reuse=False, an unchanged content hash doesn't skip the file
+    @classmethod
+    def load_file_chunks(cls, file, reuse=True, **kwargs):
+        file_path, scanned, entry = file
+        known_sha = reuse and entry and entry["sha256"] or None
+        return cls.load_chunks(file_path, known_sha, kind=scanned.kind, size=scanned.st_size, **kwargs)
+
+    # yields (id, document, metadata) for chunks of text files under dir
+    # with a manifest, files whose size & mtime or content hash are unchanged are skipped,
+    # chunks already in db are not yielded again, and chunks of changed or deleted files are removed from db
+    # an outdated manifest, i.e. one saved with other chunking or embedding settings, skips nothing
+    # with an executor, files are detected and chunked there, up to queue_size files at a time
+    # files of stream_size or more are chunked as they're read, so memory doesn't grow with file size
+    # files with binary extensions are skipped without being opened
+    @classmethod
+    def file_chunks(cls, dir, excludes, db=None, manifest=None, executor=None, queue_size=16,
+                    chunk_size=500, overlap_size=100, tokens=False, encoder=None, stream_size=1 << 22, gitignore=True):
+        seen = set()
+
+        def files():
+            scanned = Scanner(excludes, gitignore=gitignore).scan(dir)
+            for file in metrics.timed_iter("embed_files_stage_seconds", scanned, stage="walk"):
+                seen.add(file.path)
+                if manifest is not None and manifest.is_unchanged(file.path, file):
                     continue
-                if len(chunks) == 0:
+                entry = manifest is not None and manifest.get(file.path) or None
+                if file.kind == "binary" and entry is None:
                     continue
-                ids, embeddings, docs, metadatas = [], [], [], []
-                for chunk in chunks:
-                    id = f"{file_path}:{chunk[0]}:{chunk[1]}:{chunk[2]}"
-                    id = hashlib.sha256(id.encode()).hexdigest()
-                    embedding = embedding_func([chunk[2]])[0]
-                    ids.append(id)
-                    embeddings.append(embedding)
-                    docs.append(chunk[2])
-                    metadatas.append({"file": file_path, "start": chunk[0], "end": chunk[1]})
-                db.add(ids=ids, embeddings=embeddings, documents=docs, metadatas=metadatas)
+                yield file.path, file, entry
+
+        reuse = manifest is None or not manifest.outdated
+        chunking = {"chunk_size": chunk_size, "overlap_size": overlap_size, "tokens": tokens, "encoder": encoder}
+        load = functools.partial(cls.load_file_chunks, reuse=reuse, stream_size=stream_size, **chunking)
+        loaded = cls.ordered_map(load, files(), executor=executor, max_pending=queue_size)
+        for (file_path, stat, entry), (sha, items) in loaded:
+            if items is None:
+                manifest.set(file_path, stat.st_size, stat.st_mtime_ns, sha, entry["ids"])
+                continue
+            if items is False:
+                items = metrics.timed_iter("embed_files_stage_seconds", cls.file_items(file_path, **chunking), stage="chunk")
+            old_ids = set(entry["ids"]) if entry else set()
+            new_ids = []
+            for item in items:
+                new_ids.append(item[0])
+                if not reuse or item[0] not in old_ids:
+                    yield item
+            if manifest is not None:
+                stale_ids = old_ids.difference(new_ids)
+                if stale_ids:
+                    db.delete(ids=sorted(stale_ids))
+                manifest.set(file_path, stat.st_size, stat.st_mtime_ns, sha, new_ids)
+        if manifest is not None:
+            for file_path in manifest.files_under(dir):
+                if file_path not in seen:
+                    entry = manifest.remove(file_path)
+                    if entry["ids"]:
+                        db.delete(ids=entry["ids"])
+
+    # chunks from many files are packed into batches, so that one embedding_func call
+    # and one db.add serve up to batch_size chunks / batch_tokens tokens
+    # with incremental=True, a manifest next to the db tracks indexed files, so that
+    # only new or changed files are embedded again; all of them are when chunk_size, overlap_size,
+    # chunk_tokens, the encoder or the embedding model differ from the last run
+    # the embedding model is embedding_model, or embedding_func.model_name when it has one
+    # with an embedding_cache, texts embedded before are served from the cache, keyed by embedding_model,
+    # which plain function embedding_funcs need, see EmbeddingCache.wrap
+    # with parallel=True, ingest is pipelined through bounded queues: chunk_workers processes detect
+    # and chunk files, embed_workers threads keep embedding requests in flight, and one writer
+    # thread upserts to db
+    # chunk_size and overlap_size are in characters, or in tokens with chunk_tokens=True
+    # files matched by .gitignore files under dir are skipped unless gitignore=False
+    # with metrics enabled, embed_files_stage_seconds is recorded per stage: walk, magic, read, chunk, embed
+    # and write; with parallel=True, magic, read and chunk run in worker processes and aren't recorded
+    @classmethod
+    def embed_files(cls, dir, db, embedding_func, excludes=["artifacts", "node_modules", ".git", ".gitignore", "__pycache__", "*.db"],
+                    batch_size=256, batch_tokens=100000, token_counter=None, incremental=True, embedding_cache=None,
+                    embedding_model=None, parallel=False, chunk_workers=None, embed_workers=4, queue_size=16,
+                    chunk_size=500, overlap_size=100, chunk_tokens=False, encoder=None, gitignore=True):
+        with metrics.timer("embed_files_seconds", parallel=parallel):
+            if embedding_cache is not None:
+                embedding_func = embedding_cache.wrap(embedding_func, embedding_model)
+            settings = {"chunk_size": chunk_size, "overlap_size": overlap_size, "chunk_tokens": chunk_tokens,
+                        "encoder": chunk_tokens and getattr(encoder, "name", None) or None,
+                        "embedding_model": embedding_model or getattr(embedding_func, "model_name", None)}
+            manifest = incremental and Manifest(Manifest.path_for(db), settings) or None
+            chunker = parallel and concurrent.futures.ProcessPoolExecutor(max_workers=chunk_workers) or None
+            embedder = parallel and concurrent.futures.ThreadPoolExecutor(max_workers=embed_workers) or None
+            try:
+                chunks = cls.file_chunks(dir, excludes, db=db, manifest=manifest, executor=chunker, queue_size=queue_size,
+                                         chunk_size=chunk_size, overlap_size=overlap_size, tokens=chunk_tokens, encoder=encoder,
+                                         gitignore=gitignore)
+                batches = cls.batch_chunks(chunks, max_items=batch_size, max_tokens=batch_tokens, token_counter=token_counter)
+                embedded = cls.ordered_map(lambda batch: cls.embed_batch(embedding_func, batch), batches,
+                                           executor=embedder, max_pending=embed_workers * 2)
+                if parallel:
+                    cls.write_batches(db, embedded, queue_size=queue_size)
+                else:
+                    for batch, embeddings in embedded:
+                        cls.add_batch(db, batch, embeddings)
+            finally:
+                if embedder is not None:
+                    embedder.shutdown(cancel_futures=True)
+                if chunker is not None:
+                    chunker.shutdown(cancel_futures=True)
+            if manifest is not None:
+                manifest.save()
 
     @staticmethod
     def setup_embed_test():
         path = "/mnt/tmp/test.db"
         collection_name = "test"
         distance_space = "cosine"
+        from vector_db import ChromaDB
         db = ChromaDB.get_db(path=path, name=collection_name, distance_space=distance_space)
         ef = ChromaDB.get_openai_embedding_func()
         # ef = ChromaDB.get_default_embedding_func()
@@ -207,10 +668,15 @@ class GPT:
         if os.path.exists(path):
             shutil.rmtree(path)
 
+    # embeds all texts with one ef call and searches them with one db.query_many
     @staticmethod
-    def query_embedding(db, ef, text, n_results=10):
+    def query_texts(db, ef, texts, n_results=10, where=None):
+        return db.query_many(list(ef(texts)), n_results=n_results, where=where)
+
+    @staticmethod
+    def query_embedding(db, ef, text, n_results=10, where=None):
         embedding = ef([text])[0]
-        data = db.query(embedding, n_results=n_results)
+        data = db.query(embedding, n_results=n_results, where=where)
         metadatas = data['metadatas'][0]
         documents = data['documents'][0]
         distances = data['distances'][0]
@@ -218,6 +684,73 @@ class GPT:
             metadata = metadatas[i]
             print(f"{i}: {distances[i]:.2f} {metadata['file']}:{metadata['start']}-{metadata['end']}\n{documents[i]}")
         return data
+
+    # context for a prompt from one query's results, i.e. db.query(embedding)
+    # chunks of the same file whose file/start/end spans overlap or touch are merged into one span,
+    # a text contained in a span packed before isn't repeated, and spans are taken in relevance order while they fit in max_tokens
+    # returns (context, spans) with spans as [{"file", "start", "end", "text", "distance"}] in relevance order
+    @classmethod
+    def pack_context(cls, data, max_tokens=4000, token_counter=None):
+        token_counter = token_counter or cls.count_tokens
+        ids = data["ids"][0]
+        distances = data.get("distances") and data["distances"][0] or [0.0] * len(ids)
+        metadatas = data.get("metadatas") and data["metadatas"][0] or [None] * len(ids)
+        documents = data["documents"][0]
+
+        spans, by_file = [], collections.defaultdict(list)
+        for rank, (distance, metadata, document) in enumerate(zip(distances, metadatas, documents)):
+            if document is None:
+                continue
+            span = {"file": None, "start": None, "end": None, "text": document, "distance": distance, "rank": rank}
+            if metadata and all(key in metadata for key in ["file", "start", "end"]):
+                span.update(file=metadata["file"], start=metadata["start"], end=metadata["end"])
+                by_file[span["file"]].append(span)
+            else:
+                spans.append(span)
+        for file_spans in by_file.values():
+            file_spans.sort(key=lambda span: (span["start"], -span["end"]))
+            merged = dict(file_spans[0])
+            for span in file_spans[1:]:
+                if span["start"] <= merged["end"]:
+                    if span["end"] > merged["end"]:
+                        merged["text"] += span["text"][merged["end"] - span["start"]:]
+                        merged["end"] = span["end"]
+                    merged["distance"] = min(merged["distance"], span["distance"])
+                    merged["rank"] = min(merged["rank"], span["rank"])
+                else:
+                    spans.append(merged)
+                    merged = dict(span)
+            spans.append(merged)
+        spans.sort(key=lambda span: span["rank"])
+
+        blocks, packed, used = [], [], 0
+        for span in spans:
+            key = span["text"].strip()
+            if not key or any(key in other["text"] for other in packed):
+                continue
+            block = span["file"] is None and span["text"] or f"{span['file']}:{span['start']}-{span['end']}\n{span['text']}"
+            tokens = token_counter(block)
+            if used + tokens > max_tokens:
+                continue
+            used += tokens
+            blocks.append(block)
+            packed.append({key: span[key] for key in ["file", "start", "end", "text", "distance"]})
+        metrics.observe("gpt_context_tokens", used)
+        return "\n\n".join(blocks), packed
+
+    context_prompt = "Answer the question using the context below.\n\n{context}\n\nQuestion: {question}"
+
+    # retrieval augmented send: queries db for the n_results chunks nearest to question, packs them
+    # with pack_context into at most context_tokens tokens and sends them along with question
+    # embedding_func: chroma style func(texts) -> embeddings, defaults to get_embeddings
+    def ask(self, question, db, n_results=20, context_tokens=4000, where=None, embedding_func=None, stream=True, **params):
+        if embedding_func is not None:
+            embedding = list(embedding_func([question])[0])
+        else:
+            embedding = self.get_embedding(question)
+        data = db.query(embedding, n_results=n_results, where=where)
+        context, spans = self.pack_context(data, max_tokens=context_tokens, token_counter=self.context.token_counter)
+        return self.send(self.context_prompt.format(context=context, question=question), stream=stream, **params)
     
 def main():
     global gpt
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# hnsw_tune.py
+#
+# recall / latency / build time of ChromaDB HNSW settings, measured on a sample of a collection
+#
+# python hnsw_tune.py /mnt/tmp/test.db test --target 0.95         # sample an existing collection
+# python hnsw_tune.py --synthetic 20000x384 --target 0.99         # random vectors, no collection needed
+# python hnsw_tune.py ... --M 8 16 32 --search-ef 10 50 100 -o tune.json
+#
+# each setting is built from the sample in a scratch collection, recall@k is against exact
+# brute force results over the same sample
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from vector_db import ChromaDB, space_distances
+
+default_grid = {
+    "construction_ef": [64, 128, 256],
+    "M": [8, 16, 32],
+    "search_ef": [10, 20, 50, 100, 200],
+}
+
+# (vectors, queries) from up to sample_size + query_count random vectors of db, queries held out of vectors
+def sample_collection(db, sample_size=10000, query_count=200, seed=0):
+    ids = db.collection.get(include=[])["ids"]
+    rand = np.random.default_rng(seed)
+    picked = [ids[i] for i in rand.permutation(len(ids))[:sample_size + query_count]]
+    embeddings = []
+    for start in range(0, len(picked), 1000):
+        embeddings += list(db.collection.get(ids=picked[start:start+1000], include=["embeddings"])["embeddings"])
+    vectors = np.asarray(embeddings, dtype=np.float32)
+    query_count = min(query_count, len(vectors) // 2)
+    return vectors[query_count:], vectors[:query_count]
+
+def synthetic_sample(count, dim, query_count=200, seed=0):
+    rand = np.random.default_rng(seed)
+    # clustered, like real embeddings, so that recall isn't trivially high or low
+    centers = rand.normal(size=(max(1, count // 100), dim)).astype(np.float32)
+    vectors = centers[rand.integers(len(centers), size=count + query_count)] + 0.3 * rand.normal(size=(count + query_count, dim)).astype(np.float32)
+    return vectors[query_count:], vectors[:query_count]
+
+# indices of the exact k nearest vectors for each query
+def exact_neighbors(vectors, queries, k, space):
+    products = queries @ vectors.T
+    distances = space_distances(space, products, np.linalg.norm(vectors, axis=1), np.linalg.norm(queries, axis=1))
+    return np.argsort(distances, axis=1, kind="stable")[:, :k]
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(p / 100 * len(samples)))]
+
+# one row per setting: construction_ef, M, search_ef, recall, p50_ms, p95_ms, build_seconds
+# chroma keeps a loaded index's search_ef, so every setting gets its own scratch collection
+def tune(vectors, queries, k=10, space="cosine", grid=None, dir=None):
+    grid = dict(default_grid, **(grid or {}))
+    truth = exact_neighbors(vectors, queries, k, space)
+    ids = [str(i) for i in range(len(vectors))]
+    results = []
+    scratch = tempfile.mkdtemp(dir=dir)
+    try:
+        for construction_ef in grid["construction_ef"]:
+            for M in grid["M"]:
+                for search_ef in grid["search_ef"]:
+                    name = f"tune-{construction_ef}-{M}-{search_ef}"
+                    hnsw = {"construction_ef": construction_ef, "M": M, "search_ef": search_ef}
+                    db = ChromaDB(os.path.join(scratch, name), name, distance_space=space, query_cache_size=0, hnsw=hnsw)
+                    start = time.perf_counter()
+                    for i in range(0, len(ids), db.max_batch_size):
+                        db.add(ids[i:i+db.max_batch_size], vectors[i:i+db.max_batch_size].tolist())
+                    build_seconds = time.perf_counter() - start
+                    hits, latencies = 0, []
+                    for query, expected in zip(queries, truth):
+                        start = time.perf_counter()
+                        found = db.query(query.tolist(), n_results=k)["ids"][0]
+                        latencies.append(time.perf_counter() - start)
+                        hits += len(set(int(id) for id in found) & set(expected.tolist()))
+                    results.append({
+                        "construction_ef": construction_ef, "M": M, "search_ef": search_ef,
+                        "recall": hits / (len(queries) * k),
+                        "p50_ms": percentile(latencies, 50) * 1000, "p95_ms": percentile(latencies, 95) * 1000,
+                        "build_seconds": build_seconds,
+                    })
+                    print(json.dumps(results[-1]), file=sys.stderr)
+                    db.client.delete_collection(name)
+                    del db
+                    shutil.rmtree(os.path.join(scratch, name), ignore_errors=True)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+    return results
+
+# fastest p50 setting reaching target recall, build time breaking ties, or the best recall if none does
+def recommend(results, target_recall):
+    reaching = [r for r in results if r["recall"] >= target_recall]
+    if reaching:
+        return min(reaching, key=lambda r: (r["p50_ms"], r["build_seconds"]))
+    return max(results, key=lambda r: (r["recall"], -r["p50_ms"]))
+
+def main():
+    parser = argparse.ArgumentParser(description="recall@k, query latency and build time over a grid of HNSW settings")
+    parser.add_argument("path", nargs="?", help="ChromaDB path to sample")
+    parser.add_argument("name", nargs="?", help="collection name")
+    parser.add_argument("--synthetic", help="COUNTxDIM random vectors instead of a collection")
+    parser.add_argument("--space", default=None, help="distance space, defaults to the collection's or cosine")
+    parser.add_argument("--sample", type=int, default=10000, help="vectors to index")
+    parser.add_argument("--queries", type=int, default=200, help="held out query vectors")
+    parser.add_argument("-k", type=int, default=10, help="recall@k")
+    parser.add_argument("--target", type=float, default=0.95, help="recall to reach")
+    parser.add_argument("--construction-ef", type=int, nargs="+", default=default_grid["construction_ef"])
+    parser.add_argument("--M", type=int, nargs="+", default=default_grid["M"])
+    parser.add_argument("--search-ef", type=int, nargs="+", default=default_grid["search_ef"])
+    parser.add_argument("-o", "--output", help="write results and recommendation to this JSON file")
+    args = parser.parse_args()
+
+    if args.synthetic:
+        count, dim = (int(x) for x in args.synthetic.lower().split("x"))
+        vectors, queries = synthetic_sample(count, dim, args.queries)
+        space = args.space or "cosine"
+    elif args.path and args.name:
+        db = ChromaDB(args.path, args.name)
+        space = args.space or (db.collection.metadata or {}).get("hnsw:space", "cosine")
+        vectors, queries = sample_collection(db, args.sample, args.queries)
+    else:
+        parser.error("a collection path and name, or --synthetic, is required")
+
+    grid = {"construction_ef": args.construction_ef, "M": args.M, "search_ef": args.search_ef}
+    results = tune(vectors, queries, k=args.k, space=space, grid=grid)
+    best = recommend(results, args.target)
+    report = {"space": space, "vectors": len(vectors), "queries": len(queries), "k": args.k,
+              "target_recall": args.target, "results": results, "recommended": best}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    reached = best["recall"] >= args.target and "reaches" or "misses"
+    print(f"recommended: hnsw={{'construction_ef': {best['construction_ef']}, 'M': {best['M']}, 'search_ef': {best['search_ef']}}} "
+          f"{reached} recall@{args.k} {args.target} with {best['recall']:.3f}, p50 {best['p50_ms']:.2f} ms, build {best['build_seconds']:.1f} s")
+
+if __name__ == "__main__":
+    main()
+
+# EoF
@@ -0,0 +1,58 @@
+# manifest.py
+#
+# per-file content manifest for incremental re-indexing
+#   { "settings": { chunking and embedding settings },
+#     "files": { file_path: { "size": ..., "mtime": ..., "sha256": ..., "ids": [chunk ids] } } }
+
+import json
+import os
+
+class Manifest:
+    # settings: what the indexed chunks were made with, e.g. chunk size and embedding model
+    #   when they differ from the saved ones, every file is outdated: none is unchanged, and its
+    #   chunks are all embedded again
+    def __init__(self, path, settings=None):
+        self.path = path
+        self.settings = settings
+        self.files = {}
+        saved = None
+        if os.path.isfile(path):
+            with open(path, 'r') as f:
+                data = json.load(f)
+            if isinstance(data.get("files"), dict) and "settings" in data:
+                saved, self.files = data["settings"], data["files"]
+            else:
+                self.files = data   # without settings, from before they were saved
+        self.outdated = bool(self.files) and settings is not None and saved != settings
+
+    # kept inside the db directory, so removing the db removes its manifest too
+    @staticmethod
+    def path_for(db):
+        return os.path.join(db.path, f"manifest-{db.name}.json")
+
+    def get(self, file_path):
+        return self.files.get(file_path)
+
+    def set(self, file_path, size, mtime, sha256, ids):
+        self.files[file_path] = {"size": size, "mtime": mtime, "sha256": sha256, "ids": list(ids)}
+
+    def remove(self, file_path):
+        return self.files.pop(file_path, None)
+
+    # True if size and mtime are unchanged, i.e. the file doesn't need to be read
+    def is_unchanged(self, file_path, stat):
+        entry = self.files.get(file_path)
+        return not self.outdated and entry is not None and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime_ns
+
+    def files_under(self, dir):
+        prefix = os.path.join(dir, '')
+        return [file_path for file_path in self.files if file_path.startswith(prefix)]
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({"settings": self.settings, "files": self.files}, f)
+        os.replace(tmp_path, self.path)
+
+# EoF
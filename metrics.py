@@ -0,0 +1,258 @@
+# metrics.py
+#
+# counters, histograms and timers for hot paths, reported to pluggable sinks
+#
+#   from metrics import metrics, MemorySink, JsonLinesSink, PrometheusSink
+#   sink = MemorySink()
+#   metrics.enable(sink)                  # or JsonLinesSink("metrics.jsonl"), PrometheusSink(), several at once
+#   ...
+#   print(sink.summary())
+#
+# disabled by default: count() and observe() return right away and timer() returns a shared no-op,
+# so instrumented code pays one attribute check per call
+# metrics aren't collected in forked worker processes
+
+import bisect
+import collections
+import json
+import os
+import re
+import threading
+import time
+
+class NullTimer:
+    elapsed = 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def stop(self):
+        return 0.0
+
+null_timer = NullTimer()
+
+# observes elapsed seconds on exit, or on stop() which also returns them
+class Timer:
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+        self.elapsed = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.elapsed is None:
+            self.stop()
+        return False
+
+    def stop(self):
+        self.elapsed = time.perf_counter() - self.start
+        self.metrics.observe(self.name, self.elapsed, **self.labels)
+        return self.elapsed
+
+class Metrics:
+    def __init__(self):
+        self.sinks = []
+        self.enabled = False
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self.disable)
+
+    def enable(self, *sinks):
+        self.sinks = list(sinks)
+        self.enabled = bool(self.sinks)
+
+    def disable(self):
+        self.enabled = False
+        self.sinks = []
+
+    def count(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        for sink in self.sinks:
+            sink.record("counter", name, value, labels)
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        for sink in self.sinks:
+            sink.record("histogram", name, value, labels)
+
+    # with metrics.timer("db_query_seconds", backend="chroma"): ...
+    def timer(self, name, **labels):
+        if not self.enabled:
+            return null_timer
+        return Timer(self, name, labels)
+
+    # yields from iterable, observing the total seconds spent producing items once it's exhausted or closed
+    def timed_iter(self, name, iterable, **labels):
+        if not self.enabled:
+            yield from iterable
+            return
+        elapsed = 0.0
+        iterator = iter(iterable)
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    elapsed += time.perf_counter() - start
+                    break
+                elapsed += time.perf_counter() - start
+                yield item
+        finally:
+            self.observe(name, elapsed, **labels)
+
+def label_key(labels):
+    return tuple(sorted(labels.items()))
+
+# aggregates per metric and labels: counters as totals, histograms as count, sum, min, max
+# and percentiles over the last `samples` observations
+class MemorySink:
+    def __init__(self, samples=1024):
+        self.samples = samples
+        self.counters = collections.defaultdict(float)
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def record(self, kind, name, value, labels):
+        key = (name, label_key(labels))
+        with self.lock:
+            if kind == "counter":
+                self.counters[key] += value
+                return
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {"count": 0, "sum": 0.0, "min": value, "max": value,
+                                                    "recent": collections.deque(maxlen=self.samples)}
+            histogram["count"] += 1
+            histogram["sum"] += value
+            histogram["min"] = min(histogram["min"], value)
+            histogram["max"] = max(histogram["max"], value)
+            histogram["recent"].append(value)
+
+    @staticmethod
+    def format_key(key):
+        name, labels = key
+        if not labels:
+            return name
+        return name + "{" + ",".join(f"{k}={v}" for k, v in labels) + "}"
+
+    # {"counters": {name{labels}: total}, "histograms": {name{labels}: {count, sum, mean, min, max, p50, p95, p99}}}
+    def summary(self):
+        with self.lock:
+            counters = {self.format_key(key): value for key, value in self.counters.items()}
+            histograms = {}
+            for key, histogram in self.histograms.items():
+                recent = sorted(histogram["recent"])
+                pick = lambda p: recent[min(len(recent) - 1, int(p / 100 * len(recent)))]
+                histograms[self.format_key(key)] = {
+                    "count": histogram["count"], "sum": histogram["sum"], "mean": histogram["sum"] / histogram["count"],
+                    "min": histogram["min"], "max": histogram["max"], "p50": pick(50), "p95": pick(95), "p99": pick(99),
+                }
+        return {"counters": counters, "histograms": histograms}
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+# one JSON object per event: {"time", "kind", "name", "value", "labels"}
+class JsonLinesSink:
+    def __init__(self, path):
+        self.file = open(path, 'a')
+        self.lock = threading.Lock()
+
+    def record(self, kind, name, value, labels):
+        line = json.dumps({"time": time.time(), "kind": kind, "name": name, "value": value, "labels": labels})
+        with self.lock:
+            self.file.write(line + "\n")
+
+    def flush(self):
+        with self.lock:
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+# cumulative counters and bucketed histograms, rendered in the Prometheus text exposition format by text()
+class PrometheusSink:
+    default_buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+    invalid_chars = re.compile(r'[^a-zA-Z0-9_:]')
+
+    # buckets: upper bounds for histograms, or {name: upper bounds} with "default" as the fallback
+    def __init__(self, buckets=None, prefix=""):
+        self.buckets = buckets or self.default_buckets
+        self.prefix = prefix
+        self.counters = collections.defaultdict(float)
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def buckets_for(self, name):
+        if isinstance(self.buckets, dict):
+            return self.buckets.get(name, self.buckets.get("default", self.default_buckets))
+        return self.buckets
+
+    def record(self, kind, name, value, labels):
+        key = (self.invalid_chars.sub("_", self.prefix + name), label_key(labels))
+        with self.lock:
+            if kind == "counter":
+                self.counters[key] += value
+                return
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                bounds = tuple(self.buckets_for(name))
+                histogram = self.histograms[key] = {"bounds": bounds, "buckets": [0] * len(bounds), "count": 0, "sum": 0.0}
+            index = bisect.bisect_left(histogram["bounds"], value)
+            if index < len(histogram["buckets"]):
+                histogram["buckets"][index] += 1
+            histogram["count"] += 1
+            histogram["sum"] += value
+
+    @staticmethod
+    def format_labels(labels, extra=()):
+        labels = list(labels) + list(extra)
+        if not labels:
+            return ""
+        escape = lambda v: str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in labels) + "}"
+
+    def text(self):
+        lines = []
+        with self.lock:
+            typed = set()
+            for (name, labels), value in sorted(self.counters.items()):
+                if name not in typed:
+                    typed.add(name)
+                    lines.append(f"# TYPE {name} counter")
+                lines.append(f"{name}{self.format_labels(labels)} {value:g}")
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                if name not in typed:
+                    typed.add(name)
+                    lines.append(f"# TYPE {name} histogram")
+                cumulative = 0
+                for bound, count in zip(histogram["bounds"], histogram["buckets"]):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{self.format_labels(labels, [('le', f'{bound:g}')])} {cumulative}")
+                lines.append(f"{name}_bucket{self.format_labels(labels, [('le', '+Inf')])} {histogram['count']}")
+                lines.append(f"{name}_sum{self.format_labels(labels)} {histogram['sum']:g}")
+                lines.append(f"{name}_count{self.format_labels(labels)} {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        tmp = path + ".tmp"
+        with open(tmp, 'w') as f:
+            f.write(self.text())
+        os.replace(tmp, path)
+
+# process wide instance used by gpt.py and vector_db.py
+metrics = Metrics()
+
+# EoF
@@ -0,0 +1,189 @@
+# scanner.py
+#
+# file tree scanner built on os.scandir
+#   excludes are fnmatch patterns on file and directory names, compiled into one regex
+#   .gitignore files are honored as they're found, with the usual git rules: last match wins,
+#   ! negates, a trailing / matches directories only, a pattern with a / is anchored to its .gitignore
+#   size and mtime come from the same scandir pass, file types are guessed from the extension,
+#   and libmagic is only asked about files the extension doesn't settle
+
+import collections
+import fnmatch
+import functools
+import os
+import re
+import stat
+
+# stat-like, so it can be passed to Manifest.is_unchanged
+# kind: "text" or "binary" when the name settles it, None when libmagic has to look
+ScannedFile = collections.namedtuple("ScannedFile", ["path", "st_size", "st_mtime_ns", "kind"])
+
+class Gitignore:
+    def __init__(self, lines):
+        self.rules = []     # (regex, negate, dir_only)
+        for line in lines:
+            line = line.rstrip("\n")
+            if not line.strip() or line.startswith("#"):
+                continue
+            line = line.rstrip() if not line.endswith("\\ ") else line
+            negate = line.startswith("!")
+            if negate:
+                line = line[1:]
+            elif line.startswith("\\"):
+                line = line[1:]
+            dir_only = line.endswith("/")
+            line = line.rstrip("/")
+            if not line:
+                continue
+            anchored = "/" in line
+            self.rules.append((re.compile(self.translate(line.lstrip("/"), anchored)), negate, dir_only))
+        # one regex telling whether any rule matches at all, so the common case is a single search
+        self.any = self.rules and re.compile("|".join(f"(?:{regex.pattern})" for regex, _, _ in self.rules)) or None
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r', errors='replace') as f:
+            return cls(f.readlines())
+
+    # regex for a pattern, matched against paths relative to the .gitignore directory
+    @staticmethod
+    def translate(pattern, anchored):
+        parts, i = [], 0
+        while i < len(pattern):
+            if pattern.startswith("**/", i):
+                parts.append("(?:.*/)?")
+                i += 3
+            elif pattern.startswith("/**", i) and i + 3 == len(pattern):
+                parts.append("/.*")
+                i += 3
+            elif pattern.startswith("**", i):
+                parts.append(".*")
+                i += 2
+            elif pattern[i] == "*":
+                parts.append("[^/]*")
+                i += 1
+            elif pattern[i] == "?":
+                parts.append("[^/]")
+                i += 1
+            elif pattern[i] == "[":
+                end = pattern.find("]", i + 2)
+                if end < 0:
+                    parts.append(re.escape(pattern[i]))
+                    i += 1
+                else:
+                    body = pattern[i+1:end]
+                    if body.startswith("!"):
+                        body = "^" + body[1:]
+                    parts.append(f"[{body}]")
+                    i = end + 1
+            elif pattern[i] == "\\" and i + 1 < len(pattern):
+                parts.append(re.escape(pattern[i+1]))
+                i += 2
+            else:
+                parts.append(re.escape(pattern[i]))
+                i += 1
+        return ("^" if anchored else "(?:^|/)") + "".join(parts) + "$"
+
+    # True if ignored, False if re-included by a negation, None if no rule matches
+    def match(self, rel_path, is_dir):
+        if self.any is None or not self.any.search(rel_path):
+            return None
+        for regex, negate, dir_only in reversed(self.rules):
+            if dir_only and not is_dir:
+                continue
+            if regex.search(rel_path):
+                return not negate
+        return None
+
+class Scanner:
+    # only extensions libmagic reports as text/*, so the fast path indexes the same files libmagic would;
+    # .json, .svg and javascript (application/json, image/svg+xml, application/javascript) are left to libmagic
+    text_extensions = {
+        ".py", ".pyi", ".pyx", ".c", ".h", ".cc", ".cpp", ".hpp", ".cxx", ".m", ".mm",
+        ".java", ".kt", ".kts", ".scala", ".cs", ".go", ".rs", ".rb", ".php", ".swift", ".sol", ".lua",
+        ".pl", ".pm", ".r", ".jl", ".sh", ".bash", ".zsh", ".fish", ".ps1", ".bat", ".sql", ".proto", ".graphql",
+        ".txt", ".md", ".rst", ".adoc", ".tex", ".csv", ".tsv", ".yaml", ".yml", ".toml", ".ini",
+        ".cfg", ".conf", ".env", ".xml", ".html", ".htm", ".css", ".scss", ".less",
+        ".dockerfile", ".make", ".cmake", ".gradle", ".properties", ".lock", ".diff", ".patch",
+    }
+    text_names = {"makefile", "dockerfile", "license", "readme", "changelog", "authors", "gemfile", "rakefile", "procfile"}
+    binary_extensions = {
+        ".png", ".jpg", ".jpeg", ".gif", ".bmp", ".ico", ".webp", ".tif", ".tiff", ".psd", ".pdf", ".zip", ".gz",
+        ".tgz", ".bz2", ".xz", ".7z", ".rar", ".tar", ".jar", ".war", ".whl", ".egg", ".so", ".dylib", ".dll", ".exe",
+        ".o", ".a", ".lib", ".obj", ".pyc", ".pyo", ".class", ".wasm", ".bin", ".db", ".sqlite", ".sqlite3",
+        ".npy", ".npz", ".pkl", ".pt", ".onnx", ".parquet", ".woff", ".woff2", ".ttf", ".otf", ".eot", ".mp3",
+        ".mp4", ".wav", ".ogg", ".flac", ".avi", ".mov", ".mkv", ".webm", ".doc", ".docx", ".xls", ".xlsx", ".ppt",
+        ".pptx", ".dmg", ".iso", ".deb", ".rpm",
+    }
+
+    # excludes: fnmatch patterns on names, gitignore: honor .gitignore files found under the scanned dir
+    def __init__(self, excludes=[], gitignore=True):
+        self.gitignore = gitignore
+        self.excludes = excludes and re.compile("|".join(fnmatch.translate(pattern) for pattern in excludes)) or None
+
+    # "text", "binary" or None from the file name alone
+    @classmethod
+    def kind_from_name(cls, name):
+        ext = os.path.splitext(name)[1].lower()
+        if ext in cls.text_extensions:
+            return "text"
+        if ext in cls.binary_extensions:
+            return "binary"
+        if name.lower() in cls.text_names:
+            return "text"
+        return None
+
+    # one libmagic handle per process
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def get_magic():
+        import magic
+        return magic.Magic(mime=True)
+
+    # the file's kind, or its libmagic mime type when the name doesn't settle it
+    @classmethod
+    def file_type(cls, path, kind=None):
+        kind = kind or cls.kind_from_name(os.path.basename(path))
+        return kind or cls.get_magic().from_file(path)
+
+    def ignored(self, rules, path, is_dir):
+        ignored = False
+        for base, gitignore in rules:
+            match = gitignore.match(path[len(base):], is_dir)
+            if match is not None:
+                ignored = match
+        return ignored
+
+    # yields ScannedFile for files under dir, depth first in name order
+    # symlinked directories aren't followed, broken symlinks and special files are skipped
+    def scan(self, dir):
+        stack = [(dir, ())]
+        while stack:
+            root, rules = stack.pop()
+            try:
+                with os.scandir(root) as it:
+                    entries = sorted(it, key=lambda entry: entry.name)
+            except (PermissionError, FileNotFoundError, NotADirectoryError):
+                continue
+            if self.gitignore and any(entry.name == ".gitignore" and entry.is_file() for entry in entries):
+                rules = rules + ((os.path.join(root, ""), Gitignore.load(os.path.join(root, ".gitignore"))),)
+            dirs = []
+            for entry in entries:
+                if self.excludes is not None and self.excludes.match(entry.name):
+                    continue
+                try:
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                    if rules and self.ignored(rules, entry.path, is_dir):
+                        continue
+                    if is_dir:
+                        dirs.append(entry.path)
+                        continue
+                    st = entry.stat()
+                except OSError:
+                    continue
+                if not stat.S_ISREG(st.st_mode):
+                    continue
+                yield ScannedFile(entry.path, st.st_size, st.st_mtime_ns, self.kind_from_name(entry.name))
+            stack.extend((path, rules) for path in reversed(dirs))
+
+# EoF
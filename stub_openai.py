@@ -0,0 +1,120 @@
+# stub_openai.py
+#
+# local stand-in for the OpenAI HTTP API, for tests and benchmarks
+#   POST /v1/chat/completions   echoes the last message back, streamed as SSE when stream=true
+#   POST /v1/embeddings         deterministic vectors derived from sha256 of each input
+#
+# server = StubOpenAI(); server.start(); ... server.base_url ...; server.stop()
+
+import hashlib
+import http.server
+import json
+import socket
+import threading
+import time
+
+class StubOpenAI(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    # rate_limit: number of requests answered with 429 and retry_after before serving normally
+    # delay: seconds to wait before answering, reply_words: words per chat reply
+    def __init__(self, host="127.0.0.1", port=0, dim=8, delay=0.0, rate_limit=0, retry_after=0.01, reply_words=None):
+        super().__init__((host, port), StubHandler)
+        self.dim = dim
+        self.delay = delay
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.reply_words = reply_words
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.requests = 0
+        self.rate_limited = 0
+        self.thread = None
+
+    @property
+    def base_url(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}/v1"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def embedding(self, text):
+        digest = hashlib.sha256(text.encode()).digest()
+        return [(digest[i % len(digest)] - 128) / 128 for i in range(self.dim)]
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        with self.server.lock:
+            self.server.requests += 1
+            limited = self.server.rate_limited < self.server.rate_limit
+            if limited:
+                self.server.rate_limited += 1
+        if limited:
+            return self.send_json(429, {"error": {"message": "rate limited", "type": "rate_limit_error"}},
+                                  {"retry-after-ms": str(int(self.server.retry_after * 1000))})
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        if self.path.endswith("/embeddings"):
+            inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+            data = [{"object": "embedding", "index": i, "embedding": self.server.embedding(text)} for i, text in enumerate(inputs)]
+            return self.send_json(200, {"object": "list", "data": data, "model": body.get("model"),
+                                        "usage": {"prompt_tokens": 0, "total_tokens": 0}})
+        if self.path.endswith("/chat/completions"):
+            content = body["messages"][-1]["content"]
+            if self.server.reply_words:
+                content = " ".join(f"w{i}" for i in range(self.server.reply_words))
+            if body.get("stream"):
+                return self.send_stream(body.get("model"), content)
+            message = {"role": "assistant", "content": content}
+            return self.send_json(200, {"id": "stub", "object": "chat.completion", "created": 0, "model": body.get("model"),
+                                        "choices": [{"index": 0, "message": message, "finish_reason": "stop"}]})
+        self.send_json(404, {"error": {"message": "not found"}})
+
+    def send_json(self, status, data, headers={}):
+        payload = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    # server-sent events over chunked transfer encoding, one event per word
+    def send_stream(self, model, content):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        words = content.split(" ")
+        for i, word in enumerate(words):
+            delta = {"content": i and " " + word or word}
+            chunk = {"id": "stub", "object": "chat.completion.chunk", "created": 0, "model": model,
+                     "choices": [{"index": 0, "delta": delta, "finish_reason": None}]}
+            self.write_chunk(f"data: {json.dumps(chunk)}\n\n".encode())
+        self.write_chunk(b"data: [DONE]\n\n")
+        self.write_chunk(b"")
+
+    def write_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+# EoF
@@ -0,0 +1,123 @@
+# test_async_gpt.py
+#
+# python -m unittest test_async_gpt.py
+
+import asyncio
+import os
+import time
+import unittest
+import openai
+from async_gpt import AsyncGPT
+from stub_openai import StubOpenAI
+
+def word_count(text):
+    return len(text.split())
+
+class TestAsyncGPT(unittest.TestCase):
+    def setUp(self):
+        self.server = StubOpenAI().start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def gpt(self, **kwargs):
+        return AsyncGPT(api_key="test", base_url=self.server.base_url, token_counter=word_count, **kwargs)
+
+    def test_concurrent_complete(self):
+        self.server.delay = 0.01
+
+        async def run():
+            async with self.gpt(max_concurrency=8) as gpt:
+                return await asyncio.gather(*[gpt.complete([{"role": "user", "content": f"prompt {i}"}]) for i in range(200)])
+
+        replies = asyncio.run(run())
+        self.assertEqual(replies, [f"prompt {i}" for i in range(200)])
+        self.assertEqual(self.server.requests, 200)
+        self.assertLessEqual(self.server.connections, 8)
+
+    def test_rate_limit_retry(self):
+        self.server.rate_limit = 3
+
+        async def run():
+            async with self.gpt(backoff=0.001) as gpt:
+                return await gpt.complete([{"role": "user", "content": "hello"}])
+
+        self.assertEqual(asyncio.run(run()), "hello")
+        self.assertEqual(self.server.rate_limited, 3)
+
+        self.server.rate_limit, self.server.rate_limited = 10, 0
+
+        async def fail():
+            async with self.gpt(max_retries=2) as gpt:
+                return await gpt.complete([{"role": "user", "content": "hello"}])
+
+        with self.assertRaises(openai.RateLimitError):
+            asyncio.run(fail())
+        self.assertEqual(self.server.rate_limited, 3)
+
+    def test_retry_delay(self):
+        gpt = self.gpt(backoff=1.0, max_backoff=5.0)
+        error = type("Error", (), {"response": type("Response", (), {"headers": {"retry-after": "2"}})()})()
+        self.assertEqual(gpt.retry_delay(error, 0), 2.0)
+        error.response.headers = {"retry-after-ms": "250"}
+        self.assertEqual(gpt.retry_delay(error, 0), 0.25)
+        error.response.headers = {}
+        self.assertTrue(0.5 <= gpt.retry_delay(error, 0) <= 1.0)
+        self.assertEqual(gpt.retry_delay(error, 10), 5.0)
+        # unparseable values fall back to backoff
+        for headers in [{"retry-after": "soon"}, {"retry-after-ms": "later"}]:
+            error.response.headers = headers
+            self.assertTrue(0.5 <= gpt.retry_delay(error, 0) <= 1.0)
+        # a date without a zone is UTC, whatever the local time zone
+        tz = os.environ.get("TZ")
+        os.environ["TZ"] = "Asia/Seoul"
+        time.tzset()
+        try:
+            error.response.headers = {"retry-after": time.strftime("%a, %d %b %Y %H:%M:%S", time.gmtime(time.time() + 4))}
+            self.assertTrue(2.5 <= gpt.retry_delay(error, 0) <= 4.0)
+        finally:
+            if tz is None:
+                del os.environ["TZ"]
+            else:
+                os.environ["TZ"] = tz
+            time.tzset()
+
+    def test_send_stream(self):
+        self.server.rate_limit = 1
+
+        async def run():
+            async with self.gpt(backoff=0.001) as gpt:
+                deltas = [delta async for delta in gpt.stream([{"role": "user", "content": "one two three"}])]
+                reply = await gpt.send("four five", stream=True)
+                return deltas, reply, gpt.messages
+
+        deltas, reply, messages = asyncio.run(run())
+        self.assertEqual(deltas, ["one", " two", " three"])
+        self.assertEqual(reply, "four five")
+        self.assertEqual([m["role"] for m in messages], ["system", "user", "assistant"])
+
+    def test_send_stream_history(self):
+        async def run():
+            async with self.gpt() as gpt:
+                deltas = [delta async for delta in gpt.send_stream("one two three")]
+                return deltas, gpt.messages
+
+        deltas, messages = asyncio.run(run())
+        self.assertEqual(deltas, ["one", " two", " three"])
+        self.assertEqual(messages[-1], {"role": "assistant", "content": "one two three"})
+
+    def test_embeddings(self):
+        async def run():
+            async with self.gpt(max_concurrency=4) as gpt:
+                return await gpt.get_embeddings([f"text {i}" for i in range(100)], batch_size=10), await gpt.get_embedding("text 3")
+
+        embeddings, embedding = asyncio.run(run())
+        self.assertEqual(len(embeddings), 100)
+        self.assertEqual(embeddings[3], embedding)
+        self.assertEqual(embedding, self.server.embedding("text 3"))
+        self.assertLessEqual(self.server.connections, 4)
+
+if __name__ == '__main__':
+    unittest.main()
+
+# EoF
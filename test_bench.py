@@ -0,0 +1,29 @@
+# test_bench.py
+
+import unittest
+
+import bench
+
+class TestBench(unittest.TestCase):
+    def test_compare(self):
+        baseline = {"benchmarks": {"query": {"numpy_p50_ms": 10.0, "items_per_second": 1000.0, "peak_rss_kb": 0}}}
+        results = {"benchmarks": {"query": {"numpy_p50_ms": 11.0, "items_per_second": 1100.0, "peak_rss_kb": 5}}}
+        self.assertEqual(bench.compare(results, baseline), [])
+
+        results = {"benchmarks": {"query": {"numpy_p50_ms": 13.0, "items_per_second": 700.0}, "new": {"seconds": 1.0}}}
+        regressions = bench.compare(results, baseline)
+        self.assertEqual([r[0] for r in regressions], ["query.numpy_p50_ms", "query.items_per_second"])
+        self.assertEqual(bench.compare(results, baseline, tolerance=0.5), [])
+
+    def test_run(self):
+        results = bench.run(["chunking"], quick=True, isolate=False)
+        self.assertTrue(results["meta"]["quick"])
+        metrics = results["benchmarks"]["chunking"]
+        self.assertGreater(metrics["1mb_chars_per_second"], 0)
+        self.assertGreater(metrics["peak_rss_kb"], 0)
+        self.assertEqual(bench.compare(results, results), [])
+
+if __name__ == "__main__":
+    unittest.main()
+
+# EoF
@@ -0,0 +1,162 @@
+# test_cache.py
+#
+# python -m unittest test_cache.py
+
+import contextlib
+import io
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from cache import EmbeddingCache, ResponseCache, TokenCountCache
+from gpt import GPT
+from stub_openai import StubOpenAI
+
+class FakeEmbeddingFunc:
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, input):
+        self.calls.append(list(input))
+        return [[float(len(text)), 0.5, -1.25] for text in input]
+
+class TestEmbeddingCache(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "embeddings.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_embed(self):
+        cache = EmbeddingCache(self.path)
+        func = FakeEmbeddingFunc()
+        vectors = cache.embed("model", ["a", "bb", "a"], func)
+        self.assertEqual(vectors, [[1.0, 0.5, -1.25], [2.0, 0.5, -1.25], [1.0, 0.5, -1.25]])
+        self.assertEqual(func.calls, [["a", "bb"]])
+
+        vectors = cache.embed("model", ["bb", "ccc"], func)
+        self.assertEqual(vectors, [[2.0, 0.5, -1.25], [3.0, 0.5, -1.25]])
+        self.assertEqual(func.calls[-1], ["ccc"])
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.assertEqual(cache.stats()["misses"], 4)
+
+        # model is part of the key
+        cache.embed("other-model", ["a"], func)
+        self.assertEqual(func.calls[-1], ["a"])
+
+        # persisted as float32 blobs
+        cache.close()
+        cache = EmbeddingCache(self.path)
+        self.assertEqual(cache.get_many("model", ["a", "zzz"]), [[1.0, 0.5, -1.25], None])
+        self.assertEqual(cache.stats()["bytes"], 4 * 12)
+
+    def test_eviction(self):
+        cache = EmbeddingCache(self.path, max_bytes=12 * 3)
+        func = FakeEmbeddingFunc()
+        for text in ["a", "b", "c"]:
+            cache.embed("model", [text], func)
+        cache.embed("model", ["a"], func)
+        cache.embed("model", ["d"], func)
+        self.assertEqual(cache.stats()["entries"], 3)
+        self.assertIsNone(cache.get_many("model", ["b"])[0])
+        self.assertIsNotNone(cache.get_many("model", ["a"])[0])
+
+    def test_wrap(self):
+        cache = EmbeddingCache(self.path)
+        func = FakeEmbeddingFunc()
+        func.model_name = "fake"
+        wrapped = cache.wrap(func)
+        self.assertEqual(wrapped(["x", "x"]), [[1.0, 0.5, -1.25]] * 2)
+        self.assertEqual(wrapped(["x"]), [[1.0, 0.5, -1.25]])
+        self.assertEqual(len(func.calls), 1)
+        self.assertEqual(cache.get_many("fake", ["x"]), [[1.0, 0.5, -1.25]])
+
+        # plain functions don't share a namespace
+        small, big = lambda texts: [[1.0] * 3 for _ in texts], lambda texts: [[2.0] * 5 for _ in texts]
+        with self.assertRaises(ValueError):
+            cache.wrap(small)
+        self.assertEqual(cache.wrap(small, "small")(["hi"]), [[1.0] * 3])
+        self.assertEqual(cache.wrap(big, "big")(["hi"]), [[2.0] * 5])
+        self.assertEqual(cache.wrap(FakeEmbeddingFunc()).model_name, f"{__name__}.FakeEmbeddingFunc")
+
+    def test_gpt_get_embeddings(self):
+        os.environ.setdefault("OPENAI_API_KEY", "test")
+        gpt = GPT(embedding_cache=self.path)
+        func = FakeEmbeddingFunc()
+        gpt.create_embeddings = func
+        self.assertEqual(gpt.get_embedding("hello"), [5.0, 0.5, -1.25])
+        self.assertEqual(gpt.get_embeddings(["hello", "hi"]), [[5.0, 0.5, -1.25], [2.0, 0.5, -1.25]])
+        self.assertEqual(func.calls, [["hello"], ["hi"]])
+        self.assertEqual(gpt.embedding_cache.stats()["hits"], 1)
+
+class TestTokenCountCache(unittest.TestCase):
+    def test_get_put(self):
+        dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(dir, "tokens.db")
+            cache = TokenCountCache(path)
+            self.assertEqual(cache.get_many("cl100k_base", ["a", "b"]), [None, None])
+            cache.put_many("cl100k_base", ["a", "b"], [3, 5])
+            cache.close()
+            cache = TokenCountCache(path)
+            self.assertEqual(cache.get_many("cl100k_base", ["b", "c", "a"]), [5, None, 3])
+            self.assertEqual(cache.get_many("p50k_base", ["a"]), [None])
+            self.assertEqual(cache.stats(), {"hits": 2, "misses": 2, "entries": 2})
+        finally:
+            shutil.rmtree(dir)
+
+class TestResponseCache(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "responses.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_key(self):
+        messages = [{"role": "system", "content": "be brief"}, {"role": "user", "content": "hi"}]
+        key = ResponseCache.key("gpt-4", messages)
+        self.assertEqual(ResponseCache.key("gpt-4", [dict(m, extra=1) for m in messages], {}), key)
+        self.assertNotEqual(ResponseCache.key("gpt-4", messages, {"temperature": 0}), key)
+        self.assertNotEqual(ResponseCache.key("gpt-3.5-turbo", messages), key)
+        self.assertNotEqual(ResponseCache.key("gpt-4", messages[1:]), key)
+
+    def test_ttl_and_eviction(self):
+        cache = ResponseCache(self.path, ttl=3600, max_bytes=10)
+        cache.put("a", "12345")
+        cache.put("b", "67890")
+        self.assertEqual(cache.get("a"), "12345")
+        cache.put("c", "xyz")
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), "xyz")
+        self.assertEqual(cache.stats(), {"hits": 2, "misses": 1, "entries": 2, "bytes": 8})
+
+        cache.ttl = 0
+        time.sleep(0.01)
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.stats()["bytes"], 3)
+
+    def test_gpt_send(self):
+        server = StubOpenAI(reply_words=30).start()
+        try:
+            out = io.StringIO()
+            with contextlib.redirect_stdout(out):
+                gpt = GPT(api_key="test", base_url=server.base_url, token_counter=len, response_cache=self.path)
+                streamed = gpt.send("hello", stream=True)
+                gpt = GPT(api_key="test", base_url=server.base_url, token_counter=len, response_cache=self.path)
+                replayed = gpt.send("hello", stream=True)
+                completed = gpt.send("again", stream=False, temperature=0)
+                self.assertEqual(gpt.send("again", stream=False, temperature=1), completed)
+            self.assertEqual(replayed, streamed)
+            self.assertEqual(out.getvalue(), streamed + "\n" + streamed + "\n")
+            self.assertEqual(server.requests, 3)
+            self.assertEqual(gpt.response_cache.stats()["hits"], 1)
+        finally:
+            server.stop()
+
+if __name__ == '__main__':
+    unittest.main()
+
+# EoF
@@ -0,0 +1,78 @@
+# test_context_window.py
+#
+# python -m unittest test_context_window.py
+
+import os
+import unittest
+from types import SimpleNamespace
+from context_window import ContextWindow
+from gpt import GPT
+
+def word_count(text):
+    return len(text.split())
+
+# records the messages of each chat.completions.create call
+class FakeChatClient:
+    def __init__(self):
+        self.requests = []
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, model, messages, stream=False, **kwargs):
+        self.requests.append(list(messages))
+        content = "reply " * 10
+        if stream:
+            return iter([SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=word))]) for word in content.split(" ")])
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(role="assistant", content=content))])
+
+class TestContextWindow(unittest.TestCase):
+    def test_fit(self):
+        calls = []
+        def counter(text):
+            calls.append(text)
+            return word_count(text)
+
+        window = ContextWindow(counter, max_tokens=30)
+        system = {"role": "system", "content": "be brief"}
+        messages = [system]
+        for i in range(10):
+            messages.append({"role": "user", "content": f"question {i}"})
+            messages.append({"role": "assistant", "content": f"answer {i}"})
+        self.assertLessEqual(window.fit(messages), 30)
+        self.assertIs(messages[0], system)
+        self.assertEqual(messages[1]["role"], "user")
+        self.assertEqual(messages[-1]["content"], "answer 9")
+        self.assertEqual(len(messages), 1 + 2 * 2)
+
+        # messages are tokenized once
+        count = len(calls)
+        messages.append({"role": "user", "content": "question 10"})
+        window.fit(messages)
+        self.assertEqual(len(calls), count + 1)
+
+        # the last message is kept even if it's over budget by itself
+        messages.append({"role": "user", "content": "word " * 100})
+        window.fit(messages)
+        self.assertEqual(messages, [system, messages[-1]])
+
+    def test_model_budget(self):
+        self.assertEqual(ContextWindow(word_count, model="gpt-4").max_tokens, 8192 - 2048)
+        self.assertEqual(ContextWindow(word_count, model="gpt-4-1106-preview").max_tokens, 128000 - 4096)
+        self.assertEqual(ContextWindow(word_count, model="gpt-4", max_tokens=100).max_tokens, 100)
+
+    def test_send(self):
+        os.environ.setdefault("OPENAI_API_KEY", "test")
+        gpt = GPT(max_context_tokens=100, token_counter=word_count)
+        gpt.client = FakeChatClient()
+        sizes = []
+        for i in range(50):
+            gpt.send(f"question number {i}", stream=i % 2 == 0)
+            sizes.append(sum(ContextWindow.message_overhead + word_count(m["content"]) for m in gpt.client.requests[-1]))
+        self.assertTrue(all(size <= 100 for size in sizes))
+        self.assertEqual(gpt.messages[0]["role"], "system")
+        self.assertEqual(gpt.messages[-1]["role"], "assistant")
+        self.assertEqual(gpt.client.requests[-1][-1]["content"], "question number 49")
+
+if __name__ == '__main__':
+    unittest.main()
+
+# EoF
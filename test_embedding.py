@@ -2,10 +2,75 @@
 #
 # STRESS_TEST=1 python -m unittest test_embedding.py
 
+import contextlib
+import io
 import os
+import random
+import re
+import shutil
+import tempfile
 import unittest
+from cache import EmbeddingCache
 from gpt import GPT
 
+# deterministic stand-in for an embedding function, counts calls
+class FakeEmbeddingFunc:
+    def __init__(self, dim=4):
+        self.dim = dim
+        self.calls = []
+
+    def __call__(self, input):
+        self.calls.append(list(input))
+        return [[float(len(text) + i) for i in range(self.dim)] for text in input]
+
+# whitespace-attached words as tokens, with the tiktoken methods the chunker uses
+class FakeEncoder:
+    pattern = re.compile(r'\s*\S+|\s+')
+    name = "fake"
+
+    def __init__(self):
+        self.vocab = []
+        self.batches = []
+
+    def encode_ordinary(self, text):
+        tokens = []
+        for piece in self.pattern.findall(text):
+            tokens.append(len(self.vocab))
+            self.vocab.append(piece)
+        return tokens
+
+    def encode_ordinary_batch(self, texts, num_threads=8):
+        self.batches.append(len(texts))
+        return [self.encode_ordinary(text) for text in texts]
+
+    def decode_with_offsets(self, tokens):
+        offsets, text = [], ""
+        for token in tokens:
+            offsets.append(len(text))
+            text += self.vocab[token]
+        return text, offsets
+
+class FakeDB:
+    def __init__(self, path, name="test"):
+        self.path = path
+        self.name = name
+        self.adds = []
+        self.docs = {}
+
+    def add(self, ids, embeddings=None, metadatas=None, documents=None):
+        self.adds.append({"ids": ids, "embeddings": embeddings, "metadatas": metadatas, "documents": documents})
+        self.docs.update(zip(ids, metadatas))
+
+    def delete(self, ids):
+        for id in ids:
+            self.docs.pop(id, None)
+
+    def ids(self):
+        return [id for add in self.adds for id in add["ids"]]
+
+    def files(self):
+        return {metadata["file"] for metadata in self.docs.values()}
+
 class TestEmbedding(unittest.TestCase):
     def test_embedding(self):
         return
@@ -47,6 +112,343 @@ class TestEmbedding(unittest.TestCase):
         chunks = GPT.text_to_chunks(text, chunk_size=10, overlap_size=5)
         self.assertEqual(chunks, [(0, 10, '          '), (5, 15, '          '), (10, 20, '          '), (15, 25, '          '), (20, 30, '          '), (25, 35, '          '), (30, 40, '          '), (35, 50, '               ')])
 
+    # the streaming chunker must agree with the text_to_chunks it replaced
+    def test_iter_char_chunks(self):
+        def reference(text, chunk_size, overlap_size):
+            overfill_size = overlap_size > 0 and int(overlap_size / 2) or int(chunk_size / 2)
+            chunks, start = [], 0
+            while start < len(text):
+                end = start + chunk_size
+                if end > len(text) or len(text) - end <= overlap_size:
+                    end = len(text)
+                else:
+                    next = end
+                    while next < len(text) and next - end <= overfill_size and not text[next].isspace():
+                        next += 1
+                    if text[next].isspace():
+                        end = next
+                chunks.append((start, end, text[start:end]))
+                if end >= len(text):
+                    break
+                start = end - overlap_size
+                next = max(start, 1)
+                while next < end - overfill_size and not (text[next-1].isspace() and not text[next].isspace()):
+                    next += 1
+                if text[next-1].isspace() and not text[next].isspace():
+                    start = next
+            return chunks
+
+        rand = random.Random(0)
+        for _ in range(2000):
+            text = "".join(rand.choice("abcdef \n\t") for _ in range(rand.randint(0, 300)))
+            chunk_size = rand.randint(10, 50)
+            overlap_size = rand.randint(1, chunk_size - 1)
+            block_size = rand.randint(1, 40)
+            blocks = [text[i:i+block_size] for i in range(0, len(text), block_size)]
+            try:
+                expected = reference(text, chunk_size, overlap_size)
+            except IndexError:
+                # the old chunker overran the text on some whitespace-free tails
+                continue
+            self.assertEqual(GPT.text_to_chunks(text, chunk_size, overlap_size), expected)
+            self.assertEqual(list(GPT.iter_char_chunks(blocks, chunk_size, overlap_size)), expected)
+
+    def test_iter_token_chunks(self):
+        text = " ".join(f"w{i}" for i in range(100))
+        chunks = GPT.text_to_chunks(text, chunk_size=10, overlap_size=2, tokens=True, encoder=FakeEncoder())
+        self.assertEqual(chunks[0], (0, 29, "w0 w1 w2 w3 w4 w5 w6 w7 w8 w9"))
+        self.assertEqual(chunks[1][:2], (23, 61))
+        self.assertEqual(chunks[-1][1], len(text))
+        for start, end, chunk in chunks:
+            self.assertEqual(text[start:end], chunk)
+            self.assertLessEqual(len(FakeEncoder().encode_ordinary(chunk)), 12)
+
+        # small blocks tokenize the same as one block
+        blocks = [text[i:i+7] for i in range(0, len(text), 7)]
+        self.assertEqual(list(GPT.iter_token_chunks(blocks, chunk_size=10, overlap_size=2, encoder=FakeEncoder())), chunks)
+        self.assertEqual(GPT.text_to_chunks("", tokens=True, encoder=FakeEncoder()), [])
+        with self.assertRaises(ValueError):
+            GPT.text_to_chunks(text, chunk_size=10, overlap_size=10, tokens=True, encoder=FakeEncoder())
+
+    def test_iter_file_chunks(self):
+        dir = tempfile.mkdtemp()
+        try:
+            file_path = os.path.join(dir, "file.txt")
+            text = "".join(f"línea {i} ✓\r\n" for i in range(2000))
+            with open(file_path, 'w', encoding='utf-8', newline='') as f:
+                f.write(text)
+            with open(file_path, 'r', encoding='utf-8') as f:
+                expected = GPT.text_to_chunks(f.read())
+            self.assertEqual(list(GPT.iter_file_chunks(file_path)), expected)
+            self.assertEqual(list(GPT.iter_char_chunks(GPT.read_blocks(file_path, block_size=7))), expected)
+
+            # large files are streamed instead of skipped
+            items = list(GPT.file_chunks(dir, [], stream_size=1000))
+            self.assertEqual([(m["start"], m["end"], doc) for _, doc, m in items], expected)
+        finally:
+            shutil.rmtree(dir)
+
+    def test_batch_chunks(self):
+        items = [(str(i), "x" * (i + 1), None) for i in range(10)]
+        batches = list(GPT.batch_chunks(items, max_items=4, max_tokens=1000, token_counter=len))
+        self.assertEqual([len(b) for b in batches], [4, 4, 2])
+
+        # token budget closes a batch early, oversized items go out alone
+        batches = list(GPT.batch_chunks(items, max_items=100, max_tokens=12, token_counter=len))
+        self.assertEqual([[x[0] for x in b] for b in batches], [['0', '1', '2', '3'], ['4', '5'], ['6'], ['7'], ['8'], ['9']])
+        batches = list(GPT.batch_chunks([("a", "x" * 20, None), ("b", "x", None)], max_tokens=12, token_counter=len))
+        self.assertEqual([[x[0] for x in b] for b in batches], [['a'], ['b']])
+
+        self.assertEqual(list(GPT.batch_chunks([], token_counter=len)), [])
+        with self.assertRaises(ValueError):
+            list(GPT.batch_chunks(items, max_items=0, token_counter=len))
+
+    def test_embed_files_batched(self):
+        dir = tempfile.mkdtemp()
+        try:
+            for i in range(5):
+                with open(os.path.join(dir, f"file_{i}.txt"), 'w') as f:
+                    f.write(" ".join(f"word{i}_{j}" for j in range(300)))
+            db, ef = FakeDB(os.path.join(dir, "test.db")), FakeEmbeddingFunc()
+            GPT.embed_files(dir, db, ef, batch_size=16, token_counter=len, incremental=False)
+
+            docs = [doc for call in ef.calls for doc in call]
+            self.assertTrue(all(len(call) <= 16 for call in ef.calls))
+            self.assertLess(len(ef.calls), len(docs))
+            self.assertEqual(len(db.ids()), len(docs))
+            self.assertEqual(len(set(db.ids())), len(docs))
+            self.assertEqual(len({m["file"] for add in db.adds for m in add["metadatas"]}), 5)
+            for add in db.adds:
+                for doc, embedding in zip(add["documents"], add["embeddings"]):
+                    self.assertEqual(embedding[0], float(len(doc)))
+        finally:
+            shutil.rmtree(dir)
+
+    def test_embed_files_settings_changed(self):
+        dir = tempfile.mkdtemp()
+        try:
+            src = os.path.join(dir, "src")
+            os.mkdir(src)
+            with open(os.path.join(src, "file.txt"), 'w') as f:
+                f.write(" ".join(f"word{j}" for j in range(400)))
+            db, ef = FakeDB(os.path.join(dir, "test.db")), FakeEmbeddingFunc()
+            ef.model_name = "small"
+            GPT.embed_files(src, db, ef, token_counter=len)
+            self.assertTrue(all(m["end"] - m["start"] > 100 for m in db.docs.values()))
+
+            # other chunk settings: old chunks replaced by smaller ones
+            ef.calls.clear()
+            GPT.embed_files(src, db, ef, token_counter=len, chunk_size=100, overlap_size=20)
+            self.assertTrue(ef.calls)
+            self.assertTrue(all(m["end"] - m["start"] <= 120 for m in db.docs.values()))
+            count = len(db.docs)
+            ef.calls.clear()
+            GPT.embed_files(src, db, ef, token_counter=len, chunk_size=100, overlap_size=20)
+            self.assertEqual(ef.calls, [])
+
+            # another embedding model: same chunks, embedded again
+            ef.model_name = "big"
+            GPT.embed_files(src, db, ef, token_counter=len, chunk_size=100, overlap_size=20)
+            self.assertEqual(sum(len(call) for call in ef.calls), count)
+            self.assertEqual(len(db.docs), count)
+        finally:
+            shutil.rmtree(dir)
+
+    def test_embed_files_cache(self):
+        dir = tempfile.mkdtemp()
+        try:
+            src = os.path.join(dir, "src")
+            os.mkdir(src)
+            with open(os.path.join(src, "file.txt"), 'w') as f:
+                f.write("some text")
+            cache = EmbeddingCache(os.path.join(dir, "cache.db"))
+            small, big = FakeEmbeddingFunc(dim=3), FakeEmbeddingFunc(dim=5)
+            embed = lambda texts: small(texts)
+            GPT.embed_files(src, FakeDB(os.path.join(dir, "small.db")), embed, token_counter=len,
+                            embedding_cache=cache, embedding_model="small")
+            GPT.embed_files(src, FakeDB(os.path.join(dir, "big.db")), lambda texts: big(texts), token_counter=len,
+                            embedding_cache=cache, embedding_model="big")
+            self.assertEqual((len(small.calls), len(big.calls)), (1, 1))
+            with self.assertRaises(ValueError):
+                GPT.embed_files(src, FakeDB(os.path.join(dir, "none.db")), embed, token_counter=len, embedding_cache=cache)
+            cache.close()
+        finally:
+            shutil.rmtree(dir)
+
+    def test_embed_files_incremental(self):
+        dir = tempfile.mkdtemp()
+        try:
+            src = os.path.join(dir, "src")
+            os.mkdir(src)
+            paths = [os.path.join(src, f"file_{i}.txt") for i in range(3)]
+            for i, path in enumerate(paths):
+                with open(path, 'w') as f:
+                    f.write(" ".join(f"word{i}_{j}" for j in range(200)))
+            db, ef = FakeDB(os.path.join(dir, "test.db")), FakeEmbeddingFunc()
+            GPT.embed_files(src, db, ef, token_counter=len)
+            self.assertEqual(db.files(), set(paths))
+            self.assertTrue(os.path.isfile(os.path.join(dir, "test.db", "manifest-test.json")))
+            count = len(db.docs)
+
+            # nothing changed, nothing embedded
+            ef.calls.clear()
+            GPT.embed_files(src, db, ef, token_counter=len)
+            self.assertEqual(ef.calls, [])
+
+            # same content with a new mtime, hash matches
+            os.utime(paths[0], (0, 0))
+            GPT.embed_files(src, db, ef, token_counter=len)
+            self.assertEqual(ef.calls, [])
+
+            # append to one file: only the new tail is embedded, stale tail chunk removed
+            with open(paths[1], 'a') as f:
+                f.write(" appended" * 100)
+            GPT.embed_files(src, db, ef, token_counter=len)
+            docs = [doc for call in ef.calls for doc in call]
+            self.assertTrue(len(docs) > 0)
+            self.assertTrue(all(db.docs[id]["file"] == paths[1] for add in db.adds[-1:] for id in add["ids"]))
+            self.assertGreater(len(db.docs), count)
+            ends = sorted(m["end"] for m in db.docs.values() if m["file"] == paths[1])
+            self.assertEqual(ends[-1], os.path.getsize(paths[1]))
+            self.assertEqual(len(ends), len(set(m["start"] for m in db.docs.values() if m["file"] == paths[1])))
+
+            # deleted file's chunks go away
+            os.remove(paths[2])
+            ef.calls.clear()
+            GPT.embed_files(src, db, ef, token_counter=len)
+            self.assertEqual(ef.calls, [])
+            self.assertEqual(db.files(), set(paths[:2]))
+        finally:
+            shutil.rmtree(dir)
+
+    def test_embed_files_parallel(self):
+        dir = tempfile.mkdtemp()
+        try:
+            src = os.path.join(dir, "src")
+            os.makedirs(os.path.join(src, "sub"))
+            for i in range(20):
+                with open(os.path.join(src, i % 2 and "sub" or "", f"file_{i}.txt"), 'w') as f:
+                    f.write(" ".join(f"word{i}_{j}" for j in range(100 + i * 10)))
+            with open(os.path.join(src, "data.bin"), 'wb') as f:
+                f.write(bytes(range(256)) * 4)
+
+            serial_db = FakeDB(os.path.join(dir, "serial.db"))
+            GPT.embed_files(src, serial_db, FakeEmbeddingFunc(), batch_size=8, token_counter=len)
+            parallel_db, ef = FakeDB(os.path.join(dir, "parallel.db")), FakeEmbeddingFunc()
+            GPT.embed_files(src, parallel_db, ef, batch_size=8, token_counter=len,
+                            parallel=True, chunk_workers=2, embed_workers=3, queue_size=2)
+            self.assertEqual(parallel_db.docs, serial_db.docs)
+            self.assertTrue(all(len(call) <= 8 for call in ef.calls))
+
+            # manifest written by the parallel run is honored
+            ef.calls.clear()
+            GPT.embed_files(src, parallel_db, ef, token_counter=len, parallel=True, chunk_workers=2)
+            self.assertEqual(ef.calls, [])
+        finally:
+            shutil.rmtree(dir)
+
+    def test_embed_files_parallel_error(self):
+        dir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(dir, "file.txt"), 'w') as f:
+                f.write("some text " * 200)
+
+            def failing_func(input):
+                raise RuntimeError("embedding failed")
+
+            db = FakeDB(os.path.join(dir, "test.db"))
+            with self.assertRaises(RuntimeError):
+                GPT.embed_files(dir, db, failing_func, token_counter=len, parallel=True, chunk_workers=1)
+            self.assertFalse(os.path.exists(os.path.join(dir, "test.db", "manifest-test.json")))
+        finally:
+            shutil.rmtree(dir)
+
+    def test_prep_source_base(self):
+        dir = tempfile.mkdtemp()
+        try:
+            src = os.path.join(dir, "src")
+            os.makedirs(os.path.join(src, "node_modules"))
+            for i in range(5):
+                with open(os.path.join(src, f"m{i}.py"), 'w') as f:
+                    f.write(f"def f{i}():\n    return {i}\n")
+            with open(os.path.join(src, "README.md"), 'w') as f:
+                f.write("not source")
+            with open(os.path.join(src, "node_modules", "x.js"), 'w') as f:
+                f.write("excluded")
+
+            encoder = FakeEncoder()
+            cache_path = os.path.join(dir, "tokens.db")
+            result = GPT.prep_source_base(src, token_cache=cache_path, encoder=encoder)
+            self.assertEqual(result["count"], 5)
+            self.assertEqual(result["token_count"], 5 * 5)
+            self.assertEqual(result["size"], sum(len(f"def f{i}():\n    return {i}\n") for i in range(5)))
+            self.assertEqual(sorted(m["content"].split("\n")[0] for m in result["messages"]),
+                             [os.path.join(src, f"m{i}.py") for i in range(5)])
+            self.assertEqual(encoder.batches, [5])
+
+            # counts for unchanged files come from the cache
+            encoder = FakeEncoder()
+            self.assertEqual(GPT.prep_source_base(src, token_cache=cache_path, encoder=encoder)["token_count"], 25)
+            self.assertEqual(encoder.batches, [])
+
+            # generator mode yields as batches are counted
+            messages = GPT.iter_source_base(src, encoder=FakeEncoder(), batch_size=2)
+            msg, tokens = next(messages)
+            self.assertEqual((msg["role"], tokens), ("user", 5))
+            self.assertEqual(len(list(messages)), 4)
+        finally:
+            shutil.rmtree(dir)
+
+    def test_pack_context(self):
+        text = " ".join(f"word{i}" for i in range(400))
+        chunks = GPT.text_to_chunks(text, chunk_size=200, overlap_size=50)
+        other = "unrelated text that stands alone"
+        # relevance order: chunks 2, 1, 3 of a.py, a duplicate of chunk 2 from b.py, a document without span, chunk 6
+        hits = [("a.py", chunks[2]), ("a.py", chunks[1]), ("a.py", chunks[3]), ("b.py", (0, len(chunks[2][2]), chunks[2][2])),
+                (None, (None, None, other)), ("a.py", chunks[6])]
+        data = {
+            "ids": [[str(i) for i in range(len(hits))]],
+            "distances": [[0.1 * i for i in range(len(hits))]],
+            "metadatas": [[file and {"file": file, "start": c[0], "end": c[1]} or {} for file, c in hits]],
+            "documents": [[c[2] for file, c in hits]],
+        }
+        context, spans = GPT.pack_context(data, max_tokens=10000, token_counter=len)
+        self.assertEqual([(s["file"], s["start"], s["end"]) for s in spans],
+                         [("a.py", chunks[1][0], chunks[3][1]), (None, None, None), ("a.py", chunks[6][0], chunks[6][1])])
+        self.assertEqual(spans[0]["text"], text[chunks[1][0]:chunks[3][1]])
+        self.assertAlmostEqual(spans[0]["distance"], 0.0)
+        self.assertLess(len(context), sum(len(c[2]) for file, c in hits))
+        self.assertEqual(context.count("word150 "), 1)
+
+        # spans that don't fit are skipped, smaller ones later in relevance order still go in
+        context, spans = GPT.pack_context(data, max_tokens=len(other) + 220, token_counter=len)
+        self.assertEqual([s["file"] for s in spans], ["b.py", None])
+        self.assertLessEqual(len(context), len(other) + 220 + 2)
+
+    def test_ask(self):
+        from stub_openai import StubOpenAI
+        from vector_db import NumpyDB
+        dir = tempfile.mkdtemp()
+        server = StubOpenAI().start()
+        try:
+            src = os.path.join(dir, "src")
+            os.makedirs(src)
+            with open(os.path.join(src, "notes.txt"), 'w') as f:
+                f.write(" ".join(f"fact{i}" for i in range(300)))
+            db = NumpyDB(os.path.join(dir, "test.db"), "test")
+            func = FakeEmbeddingFunc()
+            with contextlib.redirect_stdout(io.StringIO()):
+                GPT.embed_files(src, db, func, token_counter=len)
+                gpt = GPT(api_key="test", base_url=server.base_url, token_counter=len)
+                reply = gpt.ask("what is fact42?", db, n_results=50, context_tokens=100000, embedding_func=func, stream=False)
+            # the stub echoes the prompt: every chunk merged back into the file's text, once
+            self.assertIn(" ".join(f"fact{i}" for i in range(300)), reply)
+            self.assertEqual(reply.count("fact42 "), 1)
+            self.assertTrue(reply.endswith("Question: what is fact42?"))
+        finally:
+            server.stop()
+            shutil.rmtree(dir)
+
     @unittest.skipUnless(os.getenv('STRESS_TEST') == '1', 'skip stress test')
     def test_gpt_py(self):
         # Test 8: real file
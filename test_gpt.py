@@ -0,0 +1,52 @@
+# test_gpt.py
+#
+# python -m unittest test_gpt.py
+
+import os
+import time
+import unittest
+from types import SimpleNamespace
+from gpt import GPT, StreamPrinter
+from test_context_window import FakeChatClient, word_count
+
+class TestGPT(unittest.TestCase):
+    def test_send_stream(self):
+        os.environ.setdefault("OPENAI_API_KEY", "test")
+        gpt = GPT(max_context_tokens=100, token_counter=word_count)
+        gpt.client = FakeChatClient()
+        stream = gpt.send_stream("first")
+        self.assertEqual(next(stream), "reply")
+        self.assertEqual(gpt.messages[-1]["role"], "user")
+        deltas = ["reply"] + list(stream)
+        self.assertEqual(gpt.messages[-1], {"role": "assistant", "content": "".join(deltas)})
+        # closing early keeps the partial reply
+        stream = gpt.send_stream("second")
+        next(stream), next(stream)
+        stream.close()
+        self.assertEqual(gpt.messages[-1], {"role": "assistant", "content": "replyreply"})
+
+    def test_stream_printer(self):
+        writes = []
+        file = SimpleNamespace(write=writes.append, flush=lambda: None)
+        printer = StreamPrinter(file, flush_size=10, flush_interval=60)
+        for word in ["one ", "two ", "three ", "four"]:
+            printer.write(word)
+        self.assertEqual(writes, ["one two three "])
+        printer.end()
+        self.assertEqual("".join(writes), "one two three four\n")
+        self.assertEqual(len(writes), 2)
+
+        # a stalled reply is written out after flush_interval, and a newline is written right away
+        writes.clear()
+        printer = StreamPrinter(file, flush_size=100, flush_interval=0.05)
+        printer.write("partial")
+        time.sleep(0.3)
+        self.assertEqual(writes, ["partial"])
+        printer.write(" line\n")
+        self.assertEqual(writes, ["partial", " line\n"])
+        printer.end()
+
+if __name__ == '__main__':
+    unittest.main()
+
+# EoF
@@ -0,0 +1,54 @@
+# test_hnsw_tune.py
+#
+# python -m unittest test_hnsw_tune.py
+
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from hnsw_tune import exact_neighbors, recommend, synthetic_sample, tune
+from vector_db import ChromaDB
+
+class TestHnswTune(unittest.TestCase):
+    def test_hnsw_settings(self):
+        dir = tempfile.mkdtemp()
+        try:
+            db = ChromaDB(dir, 'test', distance_space='l2', hnsw={'construction_ef': 50, 'search_ef': 20, 'M': 8})
+            hnsw = db.collection.configuration['hnsw']
+            self.assertEqual((hnsw['space'], hnsw['ef_construction'], hnsw['max_neighbors'], hnsw['ef_search']), ('l2', 50, 8, 20))
+            db.set_search_ef(40)
+            self.assertEqual(db.client.get_collection('test').configuration['hnsw']['ef_search'], 40)
+            self.assertEqual(ChromaDB(dir, 'test').collection.configuration['hnsw']['ef_search'], 40)
+            for hnsw in [{'ef': 10}, {'batch_size': 50}, {'num_threads': 2}]:
+                with self.assertRaises(ValueError):
+                    ChromaDB(dir, 'other', hnsw=hnsw)
+        finally:
+            shutil.rmtree(dir)
+
+    def test_exact_neighbors(self):
+        vectors = np.array([[0.0, 1.0], [1.0, 0.0], [1.0, 1.0]], dtype=np.float32)
+        queries = np.array([[0.9, 0.1]], dtype=np.float32)
+        self.assertEqual(exact_neighbors(vectors, queries, 2, 'l2').tolist(), [[1, 2]])
+        self.assertEqual(exact_neighbors(vectors, queries, 2, 'cosine').tolist(), [[1, 2]])
+
+    def test_tune(self):
+        vectors, queries = synthetic_sample(500, 16, query_count=20)
+        results = tune(vectors, queries, k=5, grid={'construction_ef': [16], 'M': [4, 16], 'search_ef': [10, 100]})
+        self.assertEqual([(r['M'], r['search_ef']) for r in results], [(4, 10), (4, 100), (16, 10), (16, 100)])
+        self.assertTrue(all(0 <= r['recall'] <= 1 and r['p50_ms'] > 0 for r in results))
+        self.assertGreaterEqual(max(r['recall'] for r in results), 0.9)
+
+    def test_recommend(self):
+        results = [
+            {'recall': 0.90, 'p50_ms': 1.0, 'build_seconds': 1},
+            {'recall': 0.97, 'p50_ms': 3.0, 'build_seconds': 1},
+            {'recall': 0.99, 'p50_ms': 2.0, 'build_seconds': 5},
+            {'recall': 0.96, 'p50_ms': 2.0, 'build_seconds': 2},
+        ]
+        self.assertIs(recommend(results, 0.95), results[3])
+        self.assertIs(recommend(results, 0.999), results[2])
+
+if __name__ == "__main__":
+    unittest.main()
+
+# EoF
@@ -0,0 +1,118 @@
+# test_metrics.py
+#
+# python -m unittest test_metrics.py
+
+import contextlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from gpt import GPT
+from metrics import metrics, Metrics, MemorySink, JsonLinesSink, PrometheusSink, null_timer
+from stub_openai import StubOpenAI
+from test_embedding import FakeDB, FakeEmbeddingFunc
+from vector_db import ChromaDB
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        metrics.disable()
+        shutil.rmtree(self.dir)
+
+    def test_disabled(self):
+        m = Metrics()
+        self.assertIs(m.timer("x_seconds"), null_timer)
+        m.count("x_total")
+        self.assertEqual(list(m.timed_iter("x_seconds", range(3))), [0, 1, 2])
+
+    def test_sinks(self):
+        path = os.path.join(self.dir, "metrics.jsonl")
+        memory, lines, prometheus = MemorySink(), JsonLinesSink(path), PrometheusSink(buckets=[0.1, 1])
+        m = Metrics()
+        m.enable(memory, lines, prometheus)
+        m.count("requests_total", route="a")
+        m.count("requests_total", 2, route="a")
+        for value in [0.05, 0.5, 5]:
+            m.observe("latency_seconds", value)
+        with m.timer("block_seconds") as timer:
+            pass
+        self.assertGreaterEqual(timer.elapsed, 0)
+        self.assertEqual(list(m.timed_iter("walk_seconds", iter([1, 2]))), [1, 2])
+        lines.close()
+
+        summary = memory.summary()
+        self.assertEqual(summary["counters"], {"requests_total{route=a}": 3})
+        latency = summary["histograms"]["latency_seconds"]
+        self.assertEqual((latency["count"], latency["min"], latency["max"], latency["p50"]), (3, 0.05, 5, 0.5))
+        self.assertEqual(summary["histograms"]["walk_seconds"]["count"], 1)
+
+        with open(path) as f:
+            events = [json.loads(line) for line in f]
+        self.assertEqual([e["name"] for e in events[:2]], ["requests_total", "requests_total"])
+        self.assertEqual(events[0]["labels"], {"route": "a"})
+        self.assertEqual(len(events), 7)
+
+        text = prometheus.text()
+        self.assertIn("# TYPE requests_total counter\nrequests_total{route=\"a\"} 3\n", text)
+        self.assertIn("latency_seconds_bucket{le=\"0.1\"} 1\n", text)
+        self.assertIn("latency_seconds_bucket{le=\"1\"} 2\n", text)
+        self.assertIn("latency_seconds_bucket{le=\"+Inf\"} 3\n", text)
+        self.assertIn("latency_seconds_count 3\n", text)
+
+    def test_send(self):
+        server = StubOpenAI(reply_words=20).start()
+        try:
+            gpt = GPT(api_key="test", base_url=server.base_url, token_counter=lambda text: len(text.split()))
+            sink = MemorySink()
+            metrics.enable(sink)
+            with contextlib.redirect_stdout(io.StringIO()):
+                gpt.send("hello", stream=True)
+                gpt.send("hello", stream=False)
+        finally:
+            server.stop()
+        summary = sink.summary()
+        model = gpt.model
+        self.assertEqual(summary["histograms"][f"gpt_send_seconds{{model={model},stream=True}}"]["count"], 1)
+        self.assertEqual(summary["histograms"][f"gpt_send_seconds{{model={model},stream=False}}"]["count"], 1)
+        self.assertEqual(summary["histograms"][f"gpt_first_token_seconds{{model={model}}}"]["count"], 1)
+        self.assertEqual(summary["counters"][f"gpt_reply_tokens_total{{model={model}}}"], 40)
+        self.assertEqual(summary["histograms"][f"gpt_tokens_per_second{{model={model}}}"]["count"], 2)
+
+    def test_embed_files_stages(self):
+        src = os.path.join(self.dir, "src")
+        os.makedirs(src)
+        for i in range(3):
+            with open(os.path.join(src, f"file{i}"), 'w') as f:
+                f.write(f"file {i} " * 200)
+        sink = MemorySink()
+        metrics.enable(sink)
+        with contextlib.redirect_stdout(io.StringIO()):
+            GPT.embed_files(src, FakeDB(os.path.join(self.dir, "db")), FakeEmbeddingFunc(), token_counter=len)
+        histograms = sink.summary()["histograms"]
+        for stage in ["walk", "magic", "read", "chunk", "embed", "write"]:
+            self.assertIn(f"embed_files_stage_seconds{{stage={stage}}}", histograms)
+        self.assertEqual(histograms["embed_files_stage_seconds{stage=magic}"]["count"], 3)
+        self.assertEqual(histograms["embed_files_seconds{parallel=False}"]["count"], 1)
+
+    def test_chroma(self):
+        db = ChromaDB(os.path.join(self.dir, "chroma.db"), "test")
+        sink = MemorySink()
+        metrics.enable(sink)
+        db.add(["a", "b"], embeddings=[[1.0, 0.0], [0.0, 1.0]])
+        db.query([1.0, 0.0], n_results=1)
+        db.query([1.0, 0.0], n_results=1)
+        summary = sink.summary()
+        self.assertEqual(summary["counters"]["db_added_items_total{backend=chroma}"], 2)
+        self.assertEqual(summary["counters"]["db_queries_total{backend=chroma}"], 2)
+        self.assertEqual(summary["counters"]["db_query_cache_hits_total{backend=chroma}"], 1)
+        self.assertEqual(summary["histograms"]["db_query_seconds{backend=chroma}"]["count"], 1)
+        self.assertEqual(summary["histograms"]["db_add_seconds{backend=chroma}"]["count"], 1)
+
+if __name__ == "__main__":
+    unittest.main()
+
+# EoF
@@ -0,0 +1,101 @@
+# test_scanner.py
+#
+# python -m unittest test_scanner.py
+
+import contextlib
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from gpt import GPT
+from scanner import Gitignore, Scanner
+from test_embedding import FakeDB, FakeEmbeddingFunc
+
+class TestGitignore(unittest.TestCase):
+    def test_rules(self):
+        gitignore = Gitignore([
+            "# comment", "", "*.log", "!keep.log", "build/", "/top.txt", "docs/*.html", "**/cache", "a/**/z", "\\#hash",
+        ])
+        cases = [
+            ("x.log", False, True), ("sub/x.log", False, True), ("keep.log", False, False),
+            ("build", True, True), ("build", False, None), ("sub/build", True, True),
+            ("top.txt", False, True), ("sub/top.txt", False, None),
+            ("docs/a.html", False, True), ("docs/sub/a.html", False, None),
+            ("cache", True, True), ("x/y/cache", True, True),
+            ("a/z", False, True), ("a/b/c/z", False, True), ("#hash", False, True), ("main.py", False, None),
+        ]
+        for path, is_dir, expected in cases:
+            self.assertEqual(gitignore.match(path, is_dir), expected, path)
+
+class TestScanner(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, path, content="x"):
+        path = os.path.join(self.dir, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def scan(self, **kwargs):
+        return [os.path.relpath(file.path, self.dir) for file in Scanner(**kwargs).scan(self.dir)]
+
+    def test_scan(self):
+        self.write(".gitignore", "*.log\ndist/\n")
+        self.write("main.py", "print()\n")
+        self.write("debug.log")
+        self.write("dist/out.js")
+        self.write("node_modules/pkg/index.js")
+        self.write("src/.gitignore", "!important.log\ngenerated.py\n")
+        self.write("src/important.log")
+        self.write("src/generated.py")
+        self.write("src/lib.py")
+        self.write("src/deeper/generated.py")
+        os.symlink(os.path.join(self.dir, "src"), os.path.join(self.dir, "link"))
+        os.symlink(os.path.join(self.dir, "missing"), os.path.join(self.dir, "broken"))
+
+        self.assertEqual(self.scan(excludes=["node_modules", ".gitignore"]), ["main.py", "src/important.log", "src/lib.py"])
+        self.assertEqual(len(self.scan(excludes=["node_modules"], gitignore=False)), 9)
+
+        file = next(Scanner().scan(self.dir))
+        self.assertEqual(file.path, os.path.join(self.dir, ".gitignore"))
+        main = [f for f in Scanner().scan(self.dir) if f.path.endswith("main.py")][0]
+        stat = os.stat(main.path)
+        self.assertEqual((main.st_size, main.st_mtime_ns, main.kind), (stat.st_size, stat.st_mtime_ns, "text"))
+
+    def test_kinds(self):
+        self.assertEqual(Scanner.kind_from_name("a.PY"), "text")
+        self.assertEqual(Scanner.kind_from_name("Makefile"), "text")
+        self.assertEqual(Scanner.kind_from_name("logo.png"), "binary")
+        self.assertIsNone(Scanner.kind_from_name("data"))
+        # not text/* to libmagic, so libmagic decides as it did before the fast path
+        for name in ["package-lock.json", "data.jsonl", "logo.svg", "index.js", "app.tsx"]:
+            self.assertIsNone(Scanner.kind_from_name(name))
+        path = self.write("notes", "plain words\n")
+        self.assertTrue(Scanner.file_type(path).startswith("text"))
+        self.assertEqual(Scanner.file_type(path, "binary"), "binary")
+
+    def test_embed_files(self):
+        self.write("src/.gitignore", "secret.txt\n")
+        self.write("src/a.txt", "hello " * 50)
+        self.write("src/secret.txt", "password " * 50)
+        self.write("src/image.png", "not really a png")
+        self.write("src/package-lock.json", '{\n  "name": "x",\n  "lockfileVersion": 2\n}\n')
+        src = os.path.join(self.dir, "src")
+        db = FakeDB(os.path.join(self.dir, "db"))
+        with contextlib.redirect_stdout(io.StringIO()):
+            GPT.embed_files(src, db, FakeEmbeddingFunc(), token_counter=len)
+        self.assertEqual(db.files(), {os.path.join(src, "a.txt")})
+        with contextlib.redirect_stdout(io.StringIO()):
+            GPT.embed_files(src, db, FakeEmbeddingFunc(), token_counter=len, gitignore=False)
+        self.assertEqual(db.files(), {os.path.join(src, "a.txt"), os.path.join(src, "secret.txt")})
+
+if __name__ == "__main__":
+    unittest.main()
+
+# EoF
@@ -0,0 +1,31 @@
+# test_startup.py
+#
+# python -m unittest test_startup.py
+#
+# GPT_STARTUP_BUDGET: seconds allowed for importing gpt and creating a GPT, 0.5 by default
+
+import os
+import unittest
+from bench import startup_seconds
+
+class TestStartup(unittest.TestCase):
+    budget = float(os.environ.get("GPT_STARTUP_BUDGET", "0.5"))
+
+    def test_chat_session(self):
+        elapsed, heavy = startup_seconds("import gpt; gpt.GPT(api_key='x')")
+        self.assertEqual(heavy, [])
+        self.assertLess(elapsed, self.budget)
+
+    def test_chunking(self):
+        elapsed, heavy = startup_seconds("import gpt; gpt.GPT.text_to_chunks('x ' * 10000)")
+        self.assertEqual(heavy, [])
+        self.assertLess(elapsed, self.budget)
+
+    def test_numpy_db(self):
+        elapsed, heavy = startup_seconds("import vector_db")
+        self.assertEqual(heavy, ["numpy"])
+
+if __name__ == "__main__":
+    unittest.main()
+
+# EoF
@@ -5,9 +5,12 @@
 import hashlib
 import os
 import shutil
+import tempfile
+import threading
 import time
 import unittest
-from vector_db import ChromaDB
+import numpy as np
+from vector_db import BufferedWriter, ChromaDB, NumpyDB, ShardedDB
 
 class TestChromaDB(unittest.TestCase):
     @classmethod
@@ -60,8 +63,91 @@ class TestChromaDB(unittest.TestCase):
         embedding = [100, 100, 100, 100]
         data = cls.chroma_db.query(embedding, n_results=3)
         cls.assertEqual(['id_3', 'id_2', 'id_1'], data['ids'][0])
+
+        # delete test
+        cls.chroma_db.delete(['id_3'])
+        data = cls.chroma_db.query(embedding, n_results=3)
+        cls.assertEqual(['id_2', 'id_1'], data['ids'][0])
         return
     
+    def test_query_many(cls):
+        cls.chroma_db.client.delete_collection(cls.collection_name)
+        cls.chroma_db.collection = cls.chroma_db.client.create_collection(cls.collection_name)
+
+        ids = [f'id_{i}' for i in range(20)]
+        embeddings = [[float(i), 1.0, 2.0, 3.0] for i in range(20)]
+        metadatas = [{'file': i % 2 and 'odd' or 'even', 'start': i} for i in range(20)]
+        cls.chroma_db.add(ids, embeddings, metadatas, [f'doc {i}' for i in range(20)])
+
+        queries = [[0.0, 1.0, 2.0, 3.0], [19.0, 1.0, 2.0, 3.0], [10.0, 1.0, 2.0, 3.0]]
+        data = cls.chroma_db.query_many(queries, n_results=3)
+        for i, query in enumerate(queries):
+            single = cls.chroma_db.query(query, n_results=3)
+            cls.assertEqual(data['ids'][i], single['ids'][0])
+            cls.assertEqual(data['documents'][i], single['documents'][0])
+        cls.assertEqual(data['ids'][1], ['id_19', 'id_18', 'id_17'])
+
+        data = cls.chroma_db.query_many(queries, n_results=2, where={'file': 'odd'})
+        cls.assertEqual(data['ids'], [['id_1', 'id_3'], ['id_19', 'id_17'], ['id_9', 'id_11']])
+
+        # repeated queries come from the cache, only the new one goes to the collection
+        collection, calls = cls.chroma_db.collection, []
+        class CountingCollection:
+            def query(self, **kwargs):
+                calls.append(kwargs['query_embeddings'])
+                return collection.query(**kwargs)
+            def upsert(self, **kwargs):
+                return collection.upsert(**kwargs)
+        cls.chroma_db.collection = CountingCollection()
+        try:
+            new_query = [5.2, 1.0, 2.0, 3.0]
+            data = cls.chroma_db.query_many(queries + [new_query], n_results=3)
+            cls.assertEqual(calls, [[new_query]])
+            cls.assertEqual(data['ids'][3], ['id_5', 'id_6', 'id_4'])
+
+            # add invalidates the cache
+            cls.chroma_db.add(['id_new'], [new_query])
+            data = cls.chroma_db.query(new_query, n_results=1)
+            cls.assertEqual(len(calls), 2)
+            cls.assertEqual(data['ids'], [['id_new']])
+        finally:
+            cls.chroma_db.collection = collection
+
+    def test_query_cache_during_write(cls):
+        # a query overlapping a slow upsert reads the old rows, which must not stay cached
+        rows, started = {'ids': [['old']], 'distances': [[0.0]]}, threading.Event()
+        class SlowCollection:
+            def query(self, **kwargs):
+                started.set()
+                return {key: [list(value[0])] for key, value in rows.items()}
+            def upsert(self, **kwargs):
+                started.wait()
+                time.sleep(0.2)
+                rows['ids'] = [['new']]
+        collection = cls.chroma_db.collection
+        cls.chroma_db.collection = SlowCollection()
+        try:
+            cls.chroma_db.clear_query_cache()
+            add = threading.Thread(target=cls.chroma_db.add, args=(['new'], [[0.0, 1.0, 2.0, 3.0]]))
+            add.start()
+            cls.assertEqual(cls.chroma_db.query([0.0, 1.0, 2.0, 3.0])['ids'], [['old']])
+            add.join()
+            cls.assertEqual(cls.chroma_db.query([0.0, 1.0, 2.0, 3.0])['ids'], [['new']])
+        finally:
+            cls.chroma_db.collection = collection
+
+    def test_writer(cls):
+        cls.chroma_db.client.delete_collection(cls.collection_name)
+        cls.chroma_db.collection = cls.chroma_db.client.create_collection(cls.collection_name)
+
+        with cls.chroma_db.writer(max_batch=7) as writer:
+            for i in range(50):
+                writer.add_one(f'id_{i}', [float(i), 1.0], {'i': i}, f'doc {i}')
+            writer.add(['id_0', 'id_1'], [[100.0, 1.0], [101.0, 1.0]], documents=['new 0', 'new 1'])
+        cls.assertEqual(cls.chroma_db.collection.count(), 50)
+        data = cls.chroma_db.query([100.0, 1.0], n_results=1)
+        cls.assertEqual((data['ids'], data['documents']), ([['id_0']], [['new 0']]))
+
     def test_default_embedding(cls):
         cls.chroma_db.client.delete_collection(cls.collection_name)
         cls.chroma_db.collection = cls.chroma_db.client.create_collection(cls.collection_name)
@@ -125,13 +211,288 @@ class TestChromaDB(unittest.TestCase):
         cls.chroma_db.client.delete_collection(cls.collection_name)
         cls.chroma_db.collection = cls.chroma_db.client.create_collection(cls.collection_name)
 
+        start_time = time.time()
+        embedding_dimension = 1600
+        count = 10000
+        with cls.chroma_db.writer() as writer:
+            for i in range(count):
+                id = hashlib.sha256(str(i).encode()).hexdigest()
+                embedding = [i] * embedding_dimension
+                writer.add_one(id, embedding, None)
+        end_time = time.time()
+        duration = end_time - start_time
+        print(f"Adding {count} took {format(duration, '.2f')} seconds, {format(count / duration, '.2f')} items per second")
+
+        query_count = 10000
+        start_time = time.time()
+        for i in range(query_count):
+            data = cls.chroma_db.query([i] * embedding_dimension, n_results=10)
+        end_time = time.time()
+        duration = end_time - start_time
+        print(f"Querying {query_count} took {format(duration, '.2f')} seconds, {format(query_count / duration, '.2f')} items per second")
+    
+class RecordingDB:
+    def __init__(self, fail=False):
+        self.adds = []
+        self.fail = fail
+
+    def add(self, ids, embeddings=None, metadatas=None, documents=None):
+        if self.fail:
+            raise RuntimeError("write failed")
+        time.sleep(0.001)
+        self.adds.append({"ids": ids, "embeddings": embeddings, "metadatas": metadatas, "documents": documents})
+
+class TestBufferedWriter(unittest.TestCase):
+    def test_batches(self):
+        db = RecordingDB()
+        with BufferedWriter(db, max_batch=10, max_bytes=1 << 20, queue_size=1) as writer:
+            for i in range(25):
+                writer.add_one(f'id_{i}', [float(i)] * 4, document=f'doc {i}')
+            writer.flush()
+            self.assertEqual([len(add["ids"]) for add in db.adds], [10, 10, 5])
+            # a different set of fields starts a new batch
+            writer.add(['a', 'b'], [[1.0], [2.0]])
+            writer.add(['c'], [[3.0]], metadatas=[{'k': 1}])
+            # later upserts of an id replace pending ones
+            writer.add(['c'], [[4.0]], metadatas=[{'k': 2}])
+        self.assertEqual(db.adds[3], {"ids": ['a', 'b'], "embeddings": [[1.0], [2.0]], "metadatas": None, "documents": None})
+        self.assertEqual(db.adds[4], {"ids": ['c'], "embeddings": [[4.0]], "metadatas": [{'k': 2}], "documents": None})
+        self.assertEqual(db.adds[0]["documents"][:2], ['doc 0', 'doc 1'])
+
+    def test_max_bytes(self):
+        db = RecordingDB()
+        with BufferedWriter(db, max_batch=1000, max_bytes=3000) as writer:
+            for i in range(10):
+                writer.add_one(f'id_{i}', [0.0] * 100)
+        self.assertEqual(sum(len(add["ids"]) for add in db.adds), 10)
+        self.assertTrue(all(len(add["ids"]) <= 4 for add in db.adds))
+
+    def test_errors(self):
+        writer = BufferedWriter(RecordingDB(fail=True), max_batch=2)
+        writer.add(['a', 'b'], [[1.0], [2.0]])
+        with self.assertRaises(RuntimeError):
+            writer.flush()
+        with self.assertRaises(RuntimeError):
+            writer.add(['c'], [[3.0]])
+        with self.assertRaises(RuntimeError):
+            writer.close()
+
+class TestShardedDB(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def data(self, count=300, dim=8):
+        rand = np.random.default_rng(0)
+        ids = [f'id_{i}' for i in range(count)]
+        embeddings = rand.normal(size=(count, dim)).tolist()
+        metadatas = [{'file': f'/src/dir{i % 7}/file{i % 31}.py', 'start': i} for i in range(count)]
+        documents = [f'doc {i}' for i in range(count)]
+        return ids, embeddings, metadatas, documents
+
+    def test_hash_routing(self):
+        ids, embeddings, metadatas, documents = self.data()
+        single = NumpyDB(os.path.join(self.dir, 'single.db'), 'test', distance_space='l2')
+        single.add(ids, embeddings, metadatas, documents)
+        with ChromaDB.get_db(os.path.join(self.dir, 'sharded.db'), 'test', distance_space='l2', backend='numpy', shards=4) as db:
+            self.assertIsInstance(db, ShardedDB)
+            db.add(ids, embeddings, metadatas, documents)
+            self.assertEqual(db.count(), 300)
+            self.assertGreater(min(shard.count() for shard in db.shards), 40)
+
+            queries = np.random.default_rng(1).normal(size=(5, 8)).tolist()
+            data, expected = db.query_many(queries, n_results=10), single.query_many(queries, n_results=10)
+            self.assertEqual(data['ids'], expected['ids'])
+            self.assertEqual(data['documents'], expected['documents'])
+            np.testing.assert_allclose(data['distances'], expected['distances'], rtol=1e-5)
+            data = db.query(queries[0], n_results=5, where={'file': '/src/dir1/file1.py'})
+            self.assertTrue(all(m['file'] == '/src/dir1/file1.py' for m in data['metadatas'][0]))
+
+            db.delete(ids[:100])
+            self.assertEqual(db.count(), 200)
+            self.assertFalse(set(db.query(queries[0], n_results=300)['ids'][0]) & set(ids[:100]))
+
+    def test_path_routing(self):
+        ids, embeddings, metadatas, documents = self.data()
+        path = os.path.join(self.dir, 'sharded.db')
+        db = ShardedDB(path, 'test', shards=3, routing='path', separate_paths=True)
+        with db.writer(max_batch=50) as writer:
+            writer.add(ids, embeddings, metadatas, documents)
+        self.assertEqual(db.count(), 300)
+        for shard in db.shards:
+            files = {m['file'] for m in shard.collection.get()['metadatas']}
+            for other in db.shards:
+                if other is not shard:
+                    others = {m['file'] for m in other.collection.get()['metadatas']}
+                    self.assertFalse({os.path.dirname(f) for f in files} & {os.path.dirname(f) for f in others})
+        self.assertEqual(sorted(os.listdir(path)), ['shard-0', 'shard-1', 'shard-2'])
+        data = db.query(embeddings[5], n_results=3)
+        self.assertEqual(data['ids'][0][0], 'id_5')
+        db.delete(['id_5'])
+        self.assertEqual(db.count(), 299)
+        db.close()
+
+    def test_reopen_after_delete(self):
+        path = os.path.join(self.dir, 'sharded.db')
+        metadatas = [{'file': '/src/a/one.py'}, {'file': '/src/a/two.py'}]
+        with ShardedDB(path, 'test', shards=2, backend='numpy', routing='path') as db:
+            db.add(['one', 'two'], [[1, 0], [0, 1]], metadatas)
+            db.delete(['one'])
+        with ShardedDB(path, 'test', shards=2, backend='numpy', routing='path') as db:
+            self.assertEqual(db.count(), 1)
+            self.assertEqual(db.query([0, 1], n_results=2)['ids'][0], ['two'])
+
+class TestNumpyDB(unittest.TestCase):
+    def setUp(self):
+        self.db_name = 'test_numpy.db'
+        self.collection_name = 'test'
+
+    def tearDown(self):
+        if os.path.exists(self.db_name):
+            shutil.rmtree(self.db_name)
+
+    def test_add(self):
+        db = ChromaDB.get_db(self.db_name, self.collection_name, distance_space='l2', backend='numpy')
+        embedding_1 = [1.1, 2.1, 3.9, 4.3]
+        embedding_2 = [1.2, 2.1, 3.9, 4.3]
+        db.add(['id_1', 'id_2'], [embedding_1, embedding_2], [None, {'name': 'id_2'}])
+        db.add(['id_1', 'id_2'], [embedding_1, embedding_2], [None, {'name': 'id_2'}])
+        self.assertEqual(db.count(), 2)
+
+        with self.assertRaises(Exception):
+            db.add(['id_3'], [[2.2, 2.1, 3.9, 4.3, 5.1]], [None])
+        db.add_one('id_3', [2.2, 2.1, 3.9, 4.3], None)
+
+        # same answers as the chroma test_add
+        self.assertEqual(['id_3', 'id_2'], db.query([2.2, 2.1, 3.9, 4.3], n_results=2)['ids'][0])
+        self.assertEqual(['id_1', 'id_2', 'id_3'], db.query([1, 1, 1, 1], n_results=3)['ids'][0])
+        self.assertEqual(['id_3', 'id_2', 'id_1'], db.query([100, 100, 100, 100], n_results=3)['ids'][0])
+        data = db.query([2.2, 2.1, 3.9, 4.3], n_results=5)
+        self.assertEqual(len(data['ids'][0]), 3)
+        self.assertAlmostEqual(data['distances'][0][1], 1.0, places=5)
+        self.assertEqual(data['metadatas'][0][1], {'name': 'id_2'})
+
+        # persisted, upserts and deletes replayed
+        db.delete(['id_3'])
+        db = NumpyDB(self.db_name, self.collection_name)
+        self.assertEqual(db.distance_space, 'l2')
+        self.assertEqual(db.count(), 2)
+        self.assertEqual(['id_2', 'id_1'], db.query([100, 100, 100, 100], n_results=3)['ids'][0])
+
+    def test_reopen(self):
+        # a delete on an empty store writes nothing
+        NumpyDB(self.db_name, self.collection_name).delete(['x'])
+        self.assertEqual(NumpyDB(self.db_name, self.collection_name).count(), 0)
+
+        db = NumpyDB(self.db_name, self.collection_name, distance_space='l2', block_size=2)
+        db.add(['a', 'b', 'c'], [[1, 0], [0, 2], [3, 4]])
+        db.delete(['b'])
+        with open(db.index_path, 'a') as f:
+            f.write('{"id": "torn", "row"')
+        db = NumpyDB(self.db_name, self.collection_name, block_size=2)
+        np.testing.assert_allclose(db.norms, [1, 2, 5])
+        db.add_one('d', [0, 1])
+        self.assertEqual(db.count(), 3)
+        db = NumpyDB(self.db_name, self.collection_name)
+        self.assertEqual(sorted(db.rows), ['a', 'c', 'd'])
+        self.assertEqual(db.query([0, 1], n_results=1)['ids'][0], ['d'])
+
+    def test_exact_search(self):
+        rand = np.random.default_rng(0)
+        vectors = rand.normal(size=(1000, 16)).astype(np.float32)
+        queries = rand.normal(size=(5, 16)).astype(np.float32)
+        for space in ['l2', 'ip', 'cosine']:
+            db = NumpyDB(self.db_name, space, distance_space=space, block_size=128)
+            db.add([str(i) for i in range(1000)], vectors, [{'even': i % 2 == 0} for i in range(1000)])
+            if space == 'l2':
+                expected = ((vectors[None, :, :] - queries[:, None, :]) ** 2).sum(axis=2)
+            elif space == 'ip':
+                expected = 1 - queries @ vectors.T
+            else:
+                normalized = vectors / np.linalg.norm(vectors, axis=1)[:, None]
+                expected = 1 - (queries / np.linalg.norm(queries, axis=1)[:, None]) @ normalized.T
+            data = db.query_many(queries, n_results=10)
+            for i in range(5):
+                self.assertEqual(data['ids'][i], [str(j) for j in np.argsort(expected[i], kind='stable')[:10]])
+                np.testing.assert_allclose(data['distances'][i], np.sort(expected[i])[:10], rtol=1e-4, atol=1e-4)
+            data = db.query_many(queries, n_results=10, where={'even': True})
+            self.assertTrue(all(int(id) % 2 == 0 for ids in data['ids'] for id in ids))
+
+    def test_float16(self):
+        db = NumpyDB(self.db_name, self.collection_name, dtype='float16', distance_space='l2')
+        db.add(['a', 'b'], [[1.0, 0.0], [0.0, 1.0]])
+        self.assertEqual(os.path.getsize(db.vectors_path), 2 * 2 * 2)
+        self.assertEqual(db.query([0.9, 0.1], n_results=1)['ids'], [['a']])
+
+    @staticmethod
+    def clustered(count, dim, seed=1):
+        rand = np.random.default_rng(seed)
+        centers = rand.normal(size=(50, dim))
+        return (centers[rand.integers(0, 50, count)] + 0.3 * rand.normal(size=(count, dim))).astype(np.float32)
+
+    @staticmethod
+    def recall(expected, got):
+        return np.mean([len(set(a) & set(b)) / len(a) for a, b in zip(expected, got)])
+
+    def test_quantization(self):
+        vectors = self.clustered(3000, 32)
+        queries = self.clustered(20, 32, seed=2)
+        ids = [str(i) for i in range(3000)]
+        for space in ['l2', 'cosine']:
+            exact = NumpyDB(self.db_name, 'exact_' + space, distance_space=space)
+            exact.add(ids, vectors)
+            expected = exact.query_many(queries, n_results=10)['ids']
+            for quantization, ratio in [('int8', 4), ('pq', 16)]:
+                name = quantization + '_' + space
+                db = NumpyDB(self.db_name, name, distance_space=space, quantization=quantization, train_size=1000)
+                for i in range(0, 3000, 500):
+                    db.add(ids[i:i+500], vectors[i:i+500])
+                self.assertIsNotNone(db.quantizer)
+                self.assertEqual(exact.search_bytes() / db.search_bytes(), ratio)
+                data = db.query_many(queries, n_results=10)
+                self.assertGreaterEqual(self.recall(expected, data['ids']), 0.9)
+
+                # distances are exact after re-ranking
+                np.testing.assert_allclose(data['distances'][0], exact.query(queries[0], n_results=10)['distances'][0][:len(data['distances'][0])], rtol=1e-3, atol=1e-4)
+
+                # codes and quantizer are reloaded
+                reloaded = NumpyDB(self.db_name, name, quantization=quantization)
+                self.assertEqual(reloaded.query_many(queries, n_results=10)['ids'], data['ids'])
+
+    @unittest.skipUnless(os.getenv('STRESS_TEST') == '1', 'skip stress test')
+    def test_quantization_stress(self):
+        count, dim = 20000, 1536
+        vectors = self.clustered(count, dim)
+        queries = self.clustered(100, dim, seed=2)
+        ids = [str(i) for i in range(count)]
+        exact = NumpyDB(self.db_name, 'exact')
+        exact.add(ids, vectors)
+        start_time = time.time()
+        expected = exact.query_many(queries, n_results=10)['ids']
+        print(f"exact: {exact.search_bytes() / 2**20:.1f} MiB, {len(queries) / (time.time() - start_time):.2f} queries per second")
+        for quantization in ['int8', 'pq']:
+            db = NumpyDB(self.db_name, quantization, quantization=quantization, train_size=5000)
+            start_time = time.time()
+            db.add(ids, vectors)
+            build_time = time.time() - start_time
+            start_time = time.time()
+            got = db.query_many(queries, n_results=10)['ids']
+            query_rate = len(queries) / (time.time() - start_time)
+            print(f"{quantization}: {db.search_bytes() / 2**20:.1f} MiB ({exact.search_bytes() / db.search_bytes():.0f}x smaller), "
+                  f"recall@10 {self.recall(expected, got):.3f}, build {build_time:.2f} seconds, {query_rate:.2f} queries per second")
+
+    @unittest.skipUnless(os.getenv('STRESS_TEST') == '1', 'skip stress test')
+    def test_stress(self):
+        db = NumpyDB(self.db_name, self.collection_name)
         start_time = time.time()
         embedding_dimension = 1600
         count = 10000
         for i in range(count):
             id = hashlib.sha256(str(i).encode()).hexdigest()
             embedding = [i] * embedding_dimension
-            cls.chroma_db.add_one(id, embedding, None)
+            db.add_one(id, embedding, None)
         end_time = time.time()
         duration = end_time - start_time
         print(f"Adding {count} took {format(duration, '.2f')} seconds, {format(count / duration, '.2f')} items per second")
@@ -139,11 +500,11 @@ class TestChromaDB(unittest.TestCase):
         query_count = 10000
         start_time = time.time()
         for i in range(query_count):
-            data = cls.chroma_db.query([i] * embedding_dimension, n_results=10)
+            data = db.query([i] * embedding_dimension, n_results=10)
         end_time = time.time()
         duration = end_time - start_time
         print(f"Querying {query_count} took {format(duration, '.2f')} seconds, {format(query_count / duration, '.2f')} items per second")
-    
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -2,26 +2,81 @@
 #
 # pip install pysqlite3-binary
 # pip install chromadb
+#
+# chromadb is imported by the first ChromaDB, so NumpyDB alone doesn't load it
 
-import chromadb
+import array
+import collections
+import concurrent.futures
+import hashlib
+import json
+import numpy as np
 import os
+import queue
+import threading
+
+from metrics import metrics
 
 class ChromaDB:
-    def __init__(self, path, name, distance_space='cosine'):
+    result_keys = ["ids", "distances", "metadatas", "documents"]
+    # HNSW index settings, passed to chroma as hnsw:<name> collection metadata
+    #   construction_ef: candidates considered while inserting, higher builds a better graph, slower
+    #   search_ef: candidates considered while searching, higher is better recall, slower queries
+    #   M: links per node, higher is better recall, more memory and slower builds
+    #   sync_threshold: vectors added before the index is persisted
+    # hnsw:batch_size and hnsw:num_threads are ignored by chroma 1.x, so they're rejected here
+    hnsw_params = ["construction_ef", "search_ef", "M", "sync_threshold"]
+
+    # query_cache_size: number of query results kept in an LRU cache, 0 to disable
+    #   the cache is cleared by add and delete, writes by other clients aren't seen
+    # hnsw: {name: value} for hnsw_params, taking effect when the collection is created,
+    #   except search_ef which can be changed later with set_search_ef
+    # with metrics enabled, records db_add_seconds, db_added_items_total, db_query_seconds,
+    # db_queries_total and db_query_cache_hits_total
+    def __init__(self, path, name, distance_space='cosine', query_cache_size=1024, hnsw=None):
         if not distance_space in ["l2", "ip", "cosine"]:
             raise ValueError("distance_space must be one of 'l2', 'ip', 'cosine'")
+        unknown = set(hnsw or {}).difference(self.hnsw_params)
+        if unknown:
+            raise ValueError(f"unknown hnsw settings {sorted(unknown)}, expected some of {self.hnsw_params}")
         self.path = path
+        self.name = name
+        self.distance_space = distance_space
+        import chromadb
         self.client = chromadb.PersistentClient(path=path)
         metadata = {"hnsw:space": distance_space}
+        metadata.update({f"hnsw:{key}": value for key, value in (hnsw or {}).items()})
         self.collection = self.client.get_or_create_collection(name=name, metadata=metadata)
+        self.query_cache_size = query_cache_size
+        self.query_cache = collections.OrderedDict()
+        self.query_cache_lock = threading.Lock()
+        self.query_cache_generation = 0     # bumped by every write, results of queries overlapping one aren't cached
+        self._max_batch_size = None
+
+    # called once a write has returned, so queries that read the old rows during it don't cache them
+    def clear_query_cache(self):
+        with self.query_cache_lock:
+            self.query_cache_generation += 1
+            self.query_cache.clear()
+
+    # search_ef of an existing collection, a loaded index keeps its search_ef until the collection
+    # is opened again by a new process
+    def set_search_ef(self, search_ef):
+        self.collection.modify(configuration={"hnsw": {"ef_search": search_ef}})
+        self.clear_query_cache()
 
     def add(self, ids, embeddings=None, metadatas=None, documents=None):
-        return self.collection.upsert(
-            ids=ids,
-            embeddings=embeddings,
-            metadatas=metadatas,
-            documents=documents
-        )
+        metrics.count("db_added_items_total", len(ids), backend="chroma")
+        try:
+            with metrics.timer("db_add_seconds", backend="chroma"):
+                return self.collection.upsert(
+                    ids=ids,
+                    embeddings=embeddings,
+                    metadatas=metadatas,
+                    documents=documents
+                )
+        finally:
+            self.clear_query_cache()
     
     def add_one(self, id, embedding=None, metadata=None, document=None):
         embeddings = embedding and [embedding] or None
@@ -29,11 +84,62 @@ class ChromaDB:
         documents = document and [document] or None
         return self.add([id], embeddings=embeddings, metadatas=metadatas, documents=documents)
     
-    def query(self, embedding, n_results=10):
-        return self.collection.query(
-            query_embeddings=[embedding],
-            n_results=n_results
-        )
+    def delete(self, ids):
+        try:
+            return self.collection.delete(ids=ids)
+        finally:
+            self.clear_query_cache()
+
+    def count(self):
+        return self.collection.count()
+
+    # largest upsert the backend accepts in one call
+    @property
+    def max_batch_size(self):
+        if self._max_batch_size is None:
+            self._max_batch_size = self.client.get_max_batch_size()
+        return self._max_batch_size
+
+    # BufferedWriter for bulk upserts, e.g. with db.writer() as writer: writer.add_one(...)
+    def writer(self, **kwargs):
+        return BufferedWriter(self, **kwargs)
+
+    def query(self, embedding, n_results=10, where=None):
+        return self.query_many([embedding], n_results=n_results, where=where)
+
+    # one collection query for all embeddings not answered from the query cache
+    # returns the collection's result layout, i.e. data['ids'][i] are the ids for embeddings[i]
+    def query_many(self, embeddings, n_results=10, where=None):
+        params = (n_results, json.dumps(where, sort_keys=True))
+        keys = [(array.array('d', embedding).tobytes(), params) for embedding in embeddings]
+        rows = [None] * len(keys)
+        if self.query_cache_size > 0:
+            with self.query_cache_lock:
+                generation = self.query_cache_generation
+                for i, key in enumerate(keys):
+                    if key in self.query_cache:
+                        self.query_cache.move_to_end(key)
+                        rows[i] = self.query_cache[key]
+        missing = [i for i, row in enumerate(rows) if row is None]
+        metrics.count("db_queries_total", len(rows), backend="chroma")
+        metrics.count("db_query_cache_hits_total", len(rows) - len(missing), backend="chroma")
+        if missing:
+            with metrics.timer("db_query_seconds", backend="chroma"):
+                data = self.collection.query(
+                    query_embeddings=[embeddings[i] for i in missing],
+                    n_results=n_results,
+                    where=where
+                )
+            for j, i in enumerate(missing):
+                rows[i] = {key: data[key][j] for key in self.result_keys if data.get(key) is not None}
+            if self.query_cache_size > 0:
+                with self.query_cache_lock:
+                    if generation == self.query_cache_generation:
+                        for i in missing:
+                            self.query_cache[keys[i]] = rows[i]
+                    while len(self.query_cache) > self.query_cache_size:
+                        self.query_cache.popitem(last=False)
+        return {key: [list(row[key]) for row in rows] for key in self.result_keys if all(key in row for row in rows)}
 
     # static test methods
     @staticmethod
@@ -48,18 +154,677 @@ class ChromaDB:
         key = "OPENAI_API_KEY" in os.environ and os.environ["OPENAI_API_KEY"] or (os.path.isfile(api_key_path) and ChromaDB.load_file(api_key_path).strip())
         return key
 
+    # backend: 'chroma' or 'numpy' (NumpyDB), shards: a ShardedDB over that many collections of backend
     @staticmethod
-    def get_db(path, name, distance_space='cosine'):
-        return ChromaDB(path=path, name=name, distance_space=distance_space)
+    def get_db(path, name, distance_space='cosine', backend='chroma', shards=None, **kwargs):
+        if shards:
+            return ShardedDB(path=path, name=name, shards=shards, distance_space=distance_space, backend=backend, **kwargs)
+        if backend == 'numpy':
+            return NumpyDB(path=path, name=name, distance_space=distance_space, **kwargs)
+        if backend != 'chroma':
+            raise ValueError("backend must be one of 'chroma', 'numpy'")
+        return ChromaDB(path=path, name=name, distance_space=distance_space, **kwargs)
 
     @staticmethod
     def get_openai_embedding_func():
+        import chromadb.utils.embedding_functions
         api_key = ChromaDB.get_openai_key()
         model_name = "text-embedding-ada-002"
         return chromadb.utils.embedding_functions.OpenAIEmbeddingFunction(api_key=api_key, model_name=model_name)
 
     @staticmethod
     def get_default_embedding_func():
+        import chromadb.utils.embedding_functions
         return chromadb.utils.embedding_functions.DefaultEmbeddingFunction()
 
+# upserts collected across add calls, written to db.add by a background thread in batches of at most
+# max_batch items and about max_bytes of embeddings, documents and metadata
+# add blocks while queue_size batches wait for the writer, flush waits until everything is written
+# a write error is raised by the next add, flush or close; later upserts of an id win over earlier ones
+class BufferedWriter:
+    def __init__(self, db, max_batch=None, max_bytes=32 << 20, queue_size=4):
+        self.db = db
+        self.max_batch = max_batch or getattr(db, "max_batch_size", None) or 5000
+        self.max_bytes = max_bytes
+        self.pending = {}       # id -> (embedding, metadata, document)
+        self.pending_bytes = 0
+        self.shape = None       # which of embedding, metadata, document the pending items have
+        self.batches = queue.Queue(maxsize=queue_size)
+        self.errors = []
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.write, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close(raise_errors=exc_type is None)
+        return False
+
+    @staticmethod
+    def item_bytes(id, embedding, metadata, document):
+        size = len(id) + 64
+        if embedding is not None:
+            size += 8 * len(embedding)
+        if document is not None:
+            size += len(document)
+        if metadata:
+            size += sum(len(str(key)) + len(str(value)) for key, value in metadata.items())
+        return size
+
+    def add(self, ids, embeddings=None, metadatas=None, documents=None):
+        self.raise_errors()
+        with self.lock:
+            for i, id in enumerate(ids):
+                embedding = embeddings[i] if embeddings is not None else None
+                metadata = metadatas[i] if metadatas is not None else None
+                document = documents[i] if documents is not None else None
+                shape = (embedding is not None, metadata is not None, document is not None)
+                if self.shape is not None and shape != self.shape:
+                    self.hand_off()
+                self.shape = shape
+                old = self.pending.pop(id, None)
+                if old is not None:
+                    self.pending_bytes -= self.item_bytes(id, *old)
+                self.pending[id] = (embedding, metadata, document)
+                self.pending_bytes += self.item_bytes(id, embedding, metadata, document)
+                if len(self.pending) >= self.max_batch or self.pending_bytes >= self.max_bytes:
+                    self.hand_off()
+
+    def add_one(self, id, embedding=None, metadata=None, document=None):
+        return self.add([id], embeddings=embedding is not None and [embedding] or None,
+                        metadatas=metadata is not None and [metadata] or None,
+                        documents=document is not None and [document] or None)
+
+    # queue the pending items as one batch, blocking while the queue is full
+    def hand_off(self):
+        if not self.pending:
+            return
+        ids = list(self.pending)
+        has_embedding, has_metadata, has_document = self.shape
+        values = list(self.pending.values())
+        batch = {
+            "ids": ids,
+            "embeddings": has_embedding and [value[0] for value in values] or None,
+            "metadatas": has_metadata and [value[1] for value in values] or None,
+            "documents": has_document and [value[2] for value in values] or None,
+        }
+        self.pending, self.pending_bytes, self.shape = {}, 0, None
+        self.batches.put(batch)
+
+    def write(self):
+        while True:
+            batch = self.batches.get()
+            try:
+                if batch is None:
+                    return
+                if not self.errors:
+                    with metrics.timer("db_writer_flush_seconds"):
+                        self.db.add(**batch)
+                    metrics.count("db_writer_batches_total")
+            except Exception as e:
+                self.errors.append(e)
+            finally:
+                self.batches.task_done()
+
+    def raise_errors(self):
+        if self.errors:
+            raise self.errors[0]
+
+    # write everything added so far
+    def flush(self):
+        with self.lock:
+            self.hand_off()
+        self.batches.join()
+        self.raise_errors()
+
+    def close(self, raise_errors=True):
+        if self.thread is None:
+            return
+        with self.lock:
+            self.hand_off()
+        self.batches.put(None)
+        self.thread.join()
+        self.thread = None
+        if raise_errors:
+            self.raise_errors()
+
+# one logical collection over N shard collections, each with its own index
+# routing='hash' places each id by a hash of the id, routing='path' places all chunks of a directory,
+# i.e. os.path.dirname(metadata["file"]), on one shard, so a subtree can be re-indexed shard by shard
+# shards are collections {name}-{i} under path, or with separate_paths=True, collection name under path/shard-{i},
+# so that a shard can be rebuilt, moved or loaded on its own
+# writes to different shards and queries run in parallel on a pool of max_workers threads,
+# query results are the per-shard top n_results merged by distance
+class ShardedDB:
+    result_keys = ChromaDB.result_keys
+
+    def __init__(self, path, name, shards=4, distance_space='cosine', backend='chroma', routing='hash',
+                 separate_paths=False, max_workers=None, **kwargs):
+        if not routing in ["hash", "path"]:
+            raise ValueError("routing must be one of 'hash', 'path'")
+        self.path = path
+        self.name = name
+        self.routing = routing
+        self.shards = []
+        for i in range(shards):
+            if separate_paths:
+                shard_path, shard_name = os.path.join(path, f"shard-{i}"), name
+            else:
+                shard_path, shard_name = path, f"{name}-{i}"
+            self.shards.append(ChromaDB.get_db(shard_path, shard_name, distance_space=distance_space, backend=backend, **kwargs))
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers or shards)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    @staticmethod
+    def stable_hash(key):
+        return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'little')
+
+    # shard index for an id and its metadata
+    def shard_for(self, id, metadata=None):
+        key = id
+        if self.routing == "path" and metadata and metadata.get("file"):
+            key = os.path.dirname(metadata["file"])
+        return self.stable_hash(key) % len(self.shards)
+
+    # runs func(shard, *args) for the given {shard index: args} in parallel, results by shard index
+    def fan_out(self, func, calls):
+        if len(calls) == 1:
+            (i, args), = calls.items()
+            return {i: func(self.shards[i], *args)}
+        futures = {i: self.executor.submit(func, self.shards[i], *args) for i, args in calls.items()}
+        return {i: future.result() for i, future in futures.items()}
+
+    def add(self, ids, embeddings=None, metadatas=None, documents=None):
+        rows = collections.defaultdict(list)
+        for j, id in enumerate(ids):
+            rows[self.shard_for(id, metadatas[j] if metadatas is not None else None)].append(j)
+        pick = lambda values, js: [values[j] for j in js] if values is not None else None
+        calls = {i: ([ids[j] for j in js], pick(embeddings, js), pick(metadatas, js), pick(documents, js)) for i, js in rows.items()}
+        self.fan_out(lambda shard, *args: shard.add(*args), calls)
+
+    def add_one(self, id, embedding=None, metadata=None, document=None):
+        embeddings = embedding and [embedding] or None
+        metadatas = metadata and [metadata] or None
+        documents = document and [document] or None
+        return self.add([id], embeddings=embeddings, metadatas=metadatas, documents=documents)
+
+    # with routing='path' an id doesn't tell its shard, so deletes go to all shards
+    def delete(self, ids):
+        if self.routing == "path":
+            calls = {i: (list(ids),) for i in range(len(self.shards))}
+        else:
+            rows = collections.defaultdict(list)
+            for id in ids:
+                rows[self.shard_for(id)].append(id)
+            calls = {i: (shard_ids,) for i, shard_ids in rows.items()}
+        if calls:
+            self.fan_out(lambda shard, shard_ids: shard.delete(shard_ids), calls)
+
+    def count(self):
+        return sum(self.fan_out(lambda shard: shard.count(), {i: () for i in range(len(self.shards))}).values())
+
+    @property
+    def max_batch_size(self):
+        return min(getattr(shard, "max_batch_size", None) or 5000 for shard in self.shards)
+
+    def writer(self, **kwargs):
+        return BufferedWriter(self, **kwargs)
+
+    def query(self, embedding, n_results=10, where=None):
+        return self.query_many([embedding], n_results=n_results, where=where)
+
+    def query_many(self, embeddings, n_results=10, where=None):
+        calls = {i: () for i in range(len(self.shards))}
+        results = self.fan_out(lambda shard: shard.query_many(embeddings, n_results=n_results, where=where), calls)
+        keys = [key for key in self.result_keys if all(key in data for data in results.values())]
+        merged = {key: [] for key in keys}
+        for q in range(len(embeddings)):
+            hits = [(distance, i, j) for i, data in results.items() for j, distance in enumerate(data["distances"][q])]
+            hits.sort(key=lambda hit: (hit[0], hit[1], hit[2]))
+            for key in keys:
+                merged[key].append([results[i][key][q][j] for _, i, j in hits[:n_results]])
+        return merged
+
+    def close(self):
+        self.executor.shutdown()
+
+# chroma style distances from query x row inner products and norms:
+# squared l2, 1 - inner product, 1 - cosine similarity
+def space_distances(space, products, norms, query_norms):
+    if space == "l2":
+        return np.maximum(query_norms[:, None] ** 2 - 2 * products + norms[None, :] ** 2, 0)
+    if space == "ip":
+        return 1 - products
+    return 1 - products / np.maximum(query_norms[:, None] * norms[None, :], 1e-30)
+
+# int8 code per dimension, scaled between the per-dimension min and max of the training sample (4x smaller)
+class ScalarQuantizer:
+    kind = "int8"
+    code_dtype = np.dtype(np.int8)
+
+    def __init__(self, low=None, scale=None):
+        self.low = low
+        self.scale = scale
+
+    def code_size(self, dim):
+        return dim
+
+    def train(self, sample):
+        self.low = sample.min(axis=0)
+        self.scale = np.maximum(sample.max(axis=0) - self.low, 1e-12) / 255
+        return self
+
+    def encode(self, vectors):
+        codes = np.rint((vectors - self.low) / self.scale) - 128
+        return np.clip(codes, -128, 127).astype(np.int8)
+
+    def decode(self, codes):
+        return (codes.astype(np.float32) + 128) * self.scale + self.low
+
+    # q . decode(c) = (q * scale) . (c + 128) + q . low, without decoding the block
+    # norms are those of the original vectors
+    def distances(self, space, codes, norms, queries, query_norms):
+        products = (queries * self.scale) @ (codes.astype(np.float32) + 128).T + (queries @ self.low)[:, None]
+        return space_distances(space, products, norms, query_norms)
+
+    def save(self, path):
+        np.savez(path, kind=self.kind, low=self.low, scale=self.scale)
+
+# subvectors coded by the nearest of 256 k-means centroids, one byte each
+# distances are looked up per subvector from query x centroid tables (asymmetric distance computation)
+# for cosine, vectors are normalized before coding
+class ProductQuantizer:
+    kind = "pq"
+    code_dtype = np.dtype(np.uint8)
+
+    def __init__(self, subvectors, space, centroids=None):
+        self.subvectors = subvectors
+        self.space = space
+        self.centroids = centroids      # subvectors x 256 x (dim / subvectors)
+
+    def code_size(self, dim):
+        return self.subvectors
+
+    # largest subvector count that divides dim and leaves at least 4 dimensions per subvector (16x smaller)
+    @staticmethod
+    def default_subvectors(dim):
+        return max([m for m in range(1, max(dim // 4, 1) + 1) if dim % m == 0])
+
+    def prepare(self, vectors):
+        if self.space == "cosine":
+            vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1), 1e-30)[:, None]
+        return vectors.reshape(len(vectors), self.subvectors, -1)
+
+    def train(self, sample, iterations=20, seed=0):
+        rand = np.random.default_rng(seed)
+        parts = self.prepare(sample)
+        k = min(256, len(sample))
+        self.centroids = np.zeros((self.subvectors, 256, parts.shape[2]), dtype=np.float32)
+        for m in range(self.subvectors):
+            data = parts[:, m, :]
+            centroids = data[rand.choice(len(data), k, replace=False)].copy()
+            for _ in range(iterations):
+                assignment = self.nearest(data, centroids)
+                counts = np.bincount(assignment, minlength=k)
+                sums = np.stack([np.bincount(assignment, weights=data[:, d], minlength=k) for d in range(data.shape[1])], axis=1)
+                filled = counts > 0
+                centroids[filled] = sums[filled] / counts[filled][:, None]
+            self.centroids[m, :k] = centroids
+            self.centroids[m, k:] = np.inf
+        return self
+
+    @staticmethod
+    def nearest(data, centroids):
+        distances = (centroids ** 2).sum(axis=1)[None, :] - 2 * data @ centroids.T
+        return distances.argmin(axis=1)
+
+    def encode(self, vectors):
+        parts = self.prepare(vectors)
+        codes = np.zeros((len(vectors), self.subvectors), dtype=np.uint8)
+        for m in range(self.subvectors):
+            centroids = self.centroids[m]
+            finite = np.isfinite(centroids[:, 0])
+            codes[:, m] = self.nearest(parts[:, m, :], centroids[finite])
+        return codes
+
+    def distances(self, space, codes, norms, queries, query_norms):
+        centroids = np.where(np.isfinite(self.centroids), self.centroids, 0)
+        parts = self.prepare(queries)
+        # queries x subvectors x 256
+        if space == "l2":
+            tables = (parts ** 2).sum(axis=2)[:, :, None] - 2 * np.einsum('qmd,mcd->qmc', parts, centroids) + (centroids ** 2).sum(axis=2)[None, :, :]
+        else:
+            tables = -np.einsum('qmd,mcd->qmc', parts, centroids)
+        tables = tables.astype(np.float32)
+        distances = np.zeros((len(queries), len(codes)), dtype=np.float32)
+        for m in range(self.subvectors):
+            distances += tables[:, m, codes[:, m]]
+        return distances if space == "l2" else 1 + distances
+
+    def save(self, path):
+        np.savez(path, kind=self.kind, subvectors=self.subvectors, space=self.space, centroids=self.centroids)
+
+def load_quantizer(path):
+    data = np.load(path)
+    if str(data["kind"]) == ScalarQuantizer.kind:
+        return ScalarQuantizer(data["low"], data["scale"])
+    return ProductQuantizer(int(data["subvectors"]), str(data["space"]), data["centroids"])
+
+# exact search over an append-only matrix, with ChromaDB's add/add_one/query surface
+#   <path>/<name>.vectors      rows of float32 (or float16), memory-mapped for queries
+#   <path>/<name>.index.jsonl  one line per added row { "id", "row", "metadata", "document" } or deletion { "delete": id }
+#   <path>/<name>.meta.json    { "dim", "dtype", "distance_space" }
+# upserts append a new row and retire the old one, so the files only grow
+#
+# with quantization='int8' or 'pq', compressed codes of every row are kept in memory as well
+#   <path>/<name>.codes           int8 / uint8 codes, one row per vector row
+#   <path>/<name>.quantizer.npz   quantizer parameters, trained on a sample once train_size rows exist
+# queries scan the codes for a shortlist of rerank * n_results rows, then rank those exactly against
+# the memory-mapped vectors
+class NumpyDB:
+    result_keys = ChromaDB.result_keys
+
+    def __init__(self, path, name, distance_space='cosine', dtype='float32', block_size=65536,
+                 quantization=None, pq_subvectors=None, train_size=4096, rerank=10):
+        if not distance_space in ["l2", "ip", "cosine"]:
+            raise ValueError("distance_space must be one of 'l2', 'ip', 'cosine'")
+        if not dtype in ["float32", "float16"]:
+            raise ValueError("dtype must be one of 'float32', 'float16'")
+        if not quantization in [None, "int8", "pq"]:
+            raise ValueError("quantization must be one of None, 'int8', 'pq'")
+        self.quantization = quantization
+        self.pq_subvectors = pq_subvectors
+        self.train_size = train_size
+        self.rerank = rerank
+        self.quantizer = None
+        self.codes = None
+        self.path = path
+        self.name = name
+        self.distance_space = distance_space
+        self.dtype = np.dtype(dtype)
+        self.block_size = block_size
+        self.dim = None
+        self.lock = threading.Lock()
+        self.vectors_path = os.path.join(path, f"{name}.vectors")
+        self.index_path = os.path.join(path, f"{name}.index.jsonl")
+        self.meta_path = os.path.join(path, f"{name}.meta.json")
+        self.codes_path = os.path.join(path, f"{name}.codes")
+        self.quantizer_path = os.path.join(path, f"{name}.quantizer.npz")
+        self.rows = {}          # id -> row
+        self.row_ids = []       # row -> id
+        self.metadatas = []     # row -> metadata
+        self.documents = []     # row -> document
+        self.alive = np.zeros(0, dtype=bool)
+        self.norms = np.zeros(0, dtype=np.float32)
+        self.matrix = None
+        os.makedirs(path, exist_ok=True)
+        self.load()
+
+    def load(self):
+        if os.path.isfile(self.meta_path):
+            with open(self.meta_path, 'r') as f:
+                meta = json.load(f)
+            self.dim, self.dtype, self.distance_space = meta["dim"], np.dtype(meta["dtype"]), meta["distance_space"]
+        if not os.path.isfile(self.index_path):
+            return
+        alive = []
+        end = 0     # byte offset just past the last complete index line
+        with open(self.index_path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break   # torn write at the tail
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break
+                if "delete" in entry:
+                    row = self.rows.pop(entry["delete"], None)
+                    if row is not None:
+                        alive[row] = False
+                    end += len(line)
+                    continue
+                if entry["row"] != len(self.row_ids):
+                    break
+                old = self.rows.get(entry["id"])
+                if old is not None:
+                    alive[old] = False
+                self.rows[entry["id"]] = entry["row"]
+                self.row_ids.append(entry["id"])
+                self.metadatas.append(entry.get("metadata"))
+                self.documents.append(entry.get("document"))
+                alive.append(True)
+                end += len(line)
+        self.alive = np.array(alive, dtype=bool)
+        # lines and rows written after the last complete index line are dropped, so later appends follow it
+        if os.path.getsize(self.index_path) != end:
+            with open(self.index_path, 'r+b') as f:
+                f.truncate(end)
+        if self.dim is not None and os.path.isfile(self.vectors_path):
+            with open(self.vectors_path, 'r+b') as f:
+                f.truncate(len(self.row_ids) * self.dim * self.dtype.itemsize)
+        # norms block by block, so opening a store doesn't read the whole matrix into memory at once
+        matrix = self.get_matrix()
+        if len(matrix):
+            self.norms = np.concatenate([np.linalg.norm(np.asarray(matrix[start:start+self.block_size], dtype=np.float32), axis=1)
+                                         for start in range(0, len(matrix), self.block_size)])
+        if os.path.isfile(self.quantizer_path):
+            self.quantizer = load_quantizer(self.quantizer_path)
+            codes = np.fromfile(self.codes_path, dtype=self.quantizer.code_dtype)
+            codes = codes[:len(codes) - len(codes) % self.quantizer.code_size(self.dim)]
+            self.codes = codes.reshape(-1, self.quantizer.code_size(self.dim))[:len(self.row_ids)]
+            missing = self.get_matrix()[len(self.codes):]
+            if len(missing):
+                self.append_codes(np.asarray(missing, dtype=np.float32))
+
+    def count(self):
+        return int(self.alive.sum())
+
+    def get_matrix(self):
+        count = len(self.row_ids)
+        if self.matrix is None or self.matrix.shape[0] != count:
+            if count:
+                self.matrix = np.memmap(self.vectors_path, dtype=self.dtype, mode='r', shape=(count, self.dim))
+            else:
+                self.matrix = np.zeros((0, self.dim or 0), dtype=self.dtype)
+        return self.matrix
+
+    def add(self, ids, embeddings=None, metadatas=None, documents=None):
+        if embeddings is None:
+            raise ValueError("NumpyDB needs embeddings")
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        if vectors.ndim != 2 or vectors.shape[0] != len(ids):
+            raise ValueError("embeddings must be one vector per id")
+        with self.lock:
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+                with open(self.meta_path, 'w') as f:
+                    json.dump({"dim": self.dim, "dtype": self.dtype.name, "distance_space": self.distance_space}, f)
+            if vectors.shape[1] != self.dim:
+                raise ValueError(f"Embedding dimension {vectors.shape[1]} does not match collection dimensionality {self.dim}")
+            first = len(self.row_ids)
+            with open(self.vectors_path, 'ab') as f:
+                f.write(vectors.astype(self.dtype).tobytes())
+            lines = []
+            alive = np.ones(len(ids), dtype=bool)
+            self.alive = np.concatenate([self.alive, alive])
+            for i, id in enumerate(ids):
+                row = first + i
+                metadata = metadatas and metadatas[i] or None
+                document = documents and documents[i] or None
+                old = self.rows.get(id)
+                if old is not None:
+                    self.alive[old] = False
+                self.rows[id] = row
+                self.row_ids.append(id)
+                self.metadatas.append(metadata)
+                self.documents.append(document)
+                lines.append(json.dumps({"id": id, "row": row, "metadata": metadata, "document": document}) + "\n")
+            with open(self.index_path, 'a') as f:
+                f.writelines(lines)
+            self.norms = np.concatenate([self.norms, np.linalg.norm(vectors.astype(self.dtype).astype(np.float32), axis=1)])
+            if self.quantizer is not None:
+                self.append_codes(vectors)
+            elif self.quantization and len(self.row_ids) >= self.train_size:
+                self.train()
+
+    def append_codes(self, vectors):
+        codes = self.quantizer.encode(vectors)
+        with open(self.codes_path, 'ab') as f:
+            f.write(codes.tobytes())
+        self.codes = np.concatenate([self.codes, codes]) if self.codes is not None else codes
+
+    # train the quantizer on up to train_size random rows and code all rows, called by add once
+    # train_size rows exist
+    def train(self, seed=0):
+        matrix = self.get_matrix()
+        rand = np.random.default_rng(seed)
+        sample = np.asarray(matrix[np.sort(rand.choice(len(matrix), min(self.train_size, len(matrix)), replace=False))], dtype=np.float32)
+        if self.quantization == "int8":
+            quantizer = ScalarQuantizer()
+        else:
+            quantizer = ProductQuantizer(self.pq_subvectors or ProductQuantizer.default_subvectors(self.dim), self.distance_space)
+        self.quantizer = quantizer.train(sample)
+        self.codes = None
+        if os.path.exists(self.codes_path):
+            os.remove(self.codes_path)
+        for start in range(0, len(matrix), self.block_size):
+            self.append_codes(np.asarray(matrix[start:start+self.block_size], dtype=np.float32))
+        self.quantizer.save(self.quantizer_path)
+
+    def add_one(self, id, embedding=None, metadata=None, document=None):
+        embeddings = embedding and [embedding] or None
+        metadatas = metadata and [metadata] or None
+        documents = document and [document] or None
+        return self.add([id], embeddings=embeddings, metadatas=metadatas, documents=documents)
+
+    def writer(self, **kwargs):
+        return BufferedWriter(self, **kwargs)
+
+    def delete(self, ids):
+        with self.lock:
+            lines = []
+            for id in ids:
+                row = self.rows.pop(id, None)
+                if row is not None:
+                    self.alive[row] = False
+                    lines.append(json.dumps({"delete": id}) + "\n")
+            if lines:
+                with open(self.index_path, 'a') as f:
+                    f.writelines(lines)
+
+    def query(self, embedding, n_results=10, where=None):
+        return self.query_many([embedding], n_results=n_results, where=where)
+
+    # top n_results for each embedding, exact by scanning the matrix in blocks of block_size rows,
+    # or with a quantizer, a scan of the codes followed by an exact re-rank of the shortlist
+    def query_many(self, embeddings, n_results=10, where=None):
+        queries = np.asarray(embeddings, dtype=np.float32).reshape(len(embeddings), -1)
+        with self.lock:
+            matrix, alive, norms, codes = self.get_matrix(), self.alive.copy(), self.norms, self.codes
+            metadatas, row_ids, documents = self.metadatas, self.row_ids, self.documents
+        if self.dim is not None and queries.shape[1] != self.dim:
+            raise ValueError(f"Embedding dimension {queries.shape[1]} does not match collection dimensionality {self.dim}")
+        if where:
+            alive &= np.array([metadata is not None and self.matches(metadata, where) for metadata in metadatas], dtype=bool)
+        query_norms = np.linalg.norm(queries, axis=1)
+
+        if self.quantizer is not None and codes is not None and len(codes) == len(matrix):
+            shortlist, distances = self.top_k(len(queries), len(codes), alive, n_results * self.rerank,
+                lambda start, end: self.quantizer.distances(self.distance_space, codes[start:end], norms[start:end], queries, query_norms))
+            best_rows, best_distances = self.rank_exact(shortlist, distances, matrix, norms, queries, query_norms, n_results)
+        else:
+            best_rows, best_distances = self.top_k(len(queries), len(matrix), alive, n_results,
+                lambda start, end: self.distances(np.asarray(matrix[start:end], dtype=np.float32), norms[start:end], queries, query_norms))
+
+        data = {key: [] for key in self.result_keys}
+        for rows, distances in zip(best_rows, best_distances):
+            rows = [row for row, distance in zip(rows.tolist(), distances.tolist()) if distance != np.inf]
+            data["ids"].append([row_ids[row] for row in rows])
+            data["distances"].append(distances[:len(rows)].tolist())
+            data["metadatas"].append([metadatas[row] for row in rows])
+            data["documents"].append([documents[row] for row in rows])
+        return data
+
+    # (rows, distances) of the k smallest block_distances(start, end) per query, sorted,
+    # padded with inf distances when fewer than k rows are alive
+    def top_k(self, queries, count, alive, k, block_distances):
+        best_rows = np.zeros((queries, 0), dtype=np.int64)
+        best_distances = np.zeros((queries, 0), dtype=np.float32)
+        for start in range(0, count, self.block_size):
+            end = min(start + self.block_size, count)
+            distances = block_distances(start, end)
+            distances[:, ~alive[start:end]] = np.inf
+            top = np.argpartition(distances, min(k, end - start) - 1, axis=1)[:, :k]
+            rows, distances = top + start, np.take_along_axis(distances, top, axis=1)
+            rows, distances = np.concatenate([best_rows, rows], axis=1), np.concatenate([best_distances, distances], axis=1)
+            if rows.shape[1] > k:
+                top = np.argpartition(distances, k - 1, axis=1)[:, :k]
+                rows, distances = np.take_along_axis(rows, top, axis=1), np.take_along_axis(distances, top, axis=1)
+            best_rows, best_distances = rows, distances
+        order = np.argsort(best_distances, axis=1, kind='stable')
+        return np.take_along_axis(best_rows, order, axis=1), np.take_along_axis(best_distances, order, axis=1)
+
+    # exact distances for each query's shortlisted rows, reading only those rows of the matrix
+    def rank_exact(self, shortlist, shortlist_distances, matrix, norms, queries, query_norms, k):
+        best_rows = np.zeros((len(queries), k), dtype=np.int64)
+        best_distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+        for i in range(len(queries)):
+            rows = np.sort(shortlist[i][shortlist_distances[i] != np.inf])
+            if not len(rows):
+                continue
+            vectors = np.asarray(matrix[rows], dtype=np.float32)
+            distances = self.distances(vectors, norms[rows], queries[i:i+1], query_norms[i:i+1])[0]
+            order = np.argsort(distances, kind='stable')[:k]
+            best_rows[i, :len(order)] = rows[order]
+            best_distances[i, :len(order)] = distances[order]
+        return best_rows, best_distances
+
+    def distances(self, block, norms, queries, query_norms):
+        return space_distances(self.distance_space, queries @ block.T, norms, query_norms)
+
+    # bytes held in memory for searching: codes when quantized, the full matrix otherwise
+    def search_bytes(self):
+        if self.codes is not None:
+            return self.codes.nbytes
+        return len(self.row_ids) * (self.dim or 0) * self.dtype.itemsize
+
+    # chroma style where filter: {"key": value}, {"key": {"$eq"|"$ne"|"$in"|"$nin"|"$gt"|"$gte"|"$lt"|"$lte": value}},
+    # {"$and": [...]}, {"$or": [...]}
+    @classmethod
+    def matches(cls, metadata, where):
+        for key, condition in where.items():
+            if key == "$and":
+                if not all(cls.matches(metadata, w) for w in condition):
+                    return False
+            elif key == "$or":
+                if not any(cls.matches(metadata, w) for w in condition):
+                    return False
+            elif isinstance(condition, dict):
+                value = metadata.get(key)
+                for op, operand in condition.items():
+                    if not cls.operators[op](value, operand):
+                        return False
+            elif metadata.get(key) != condition:
+                return False
+        return True
+
+    operators = {
+        "$eq": lambda value, operand: value == operand,
+        "$ne": lambda value, operand: value != operand,
+        "$in": lambda value, operand: value in operand,
+        "$nin": lambda value, operand: value not in operand,
+        "$gt": lambda value, operand: value is not None and value > operand,
+        "$gte": lambda value, operand: value is not None and value >= operand,
+        "$lt": lambda value, operand: value is not None and value < operand,
+        "$lte": lambda value, operand: value is not None and value <= operand,
+    }
+
 # EoF